@@ -1,14 +1,53 @@
-from fastapi import FastAPI, UploadFile, File
-from fastapi.responses import FileResponse, HTMLResponse
-import pandas as pd
-import tempfile
+from contextlib import asynccontextmanager
+import asyncio
+import hashlib
+import hmac
+import json
 import os
-import zipfile
-import shutil
+import re
+import time
 
-from reconcile_core import reconcile
+from typing import Optional
 
-app = FastAPI(title="GeM Payment Reconciliation")
+from fastapi import Depends, FastAPI, UploadFile, File, Form, Header, HTTPException
+from fastapi.responses import (
+    FileResponse, HTMLResponse, JSONResponse, PlainTextResponse, StreamingResponse
+)
+from starlette.concurrency import run_in_threadpool
+
+from jobs import (
+    RESULT_NAME, InputError, JobQueue, QueueFull, batch_key, check_batch_headers,
+    check_headers, run_batch, run_reconcile, upload_key
+)
+from pao_ledger import DeltaAlreadyApplied, PaoLedger
+from reconcile_core import MissingColumnError
+from report_writer import FORMATS
+from run_stats import RUN_STATS_FILE
+from utils import to_paise, to_rupees
+
+# ================= CONFIG =================
+# The PAO register the server holds (see pao_ledger: one shared file for
+# every worker), so users can upload just the GeM file; also (re)loaded
+# through POST /admin/ledger. Admin endpoints are off unless ADMIN_TOKEN
+# is set (sent as X-Admin-Token).
+PAO_LEDGER_FILE = os.environ.get("PAO_LEDGER_FILE")
+ADMIN_TOKEN = os.environ.get("ADMIN_TOKEN")
+
+queue = None
+ledger = PaoLedger()
+
+
+@asynccontextmanager
+async def lifespan(app):
+    global queue
+    queue = JobQueue()
+    if PAO_LEDGER_FILE:
+        await run_in_threadpool(ledger.start, PAO_LEDGER_FILE)
+    yield
+    queue.shutdown()
+
+
+app = FastAPI(title="GeM Payment Reconciliation", lifespan=lifespan)
 
 
 # -------- HOME PAGE --------
@@ -22,8 +61,15 @@ def home():
                 <p>Invoice Excel</p>
                 <input type="file" name="invoice_file" required>
 
-                <p>Payment Excel</p>
-                <input type="file" name="payment_file" required>
+                <p>Payment Excel (leave empty to use the server's PAO ledger)</p>
+                <input type="file" name="payment_file">
+
+                <p>Report format</p>
+                <select name="output_format">
+                    <option value="xlsx">Excel workbook</option>
+                    <option value="csv">CSV</option>
+                    <option value="parquet">Parquet</option>
+                </select>
 
                 <br><br>
                 <button type="submit">Reconcile & Download</button>
@@ -33,46 +79,442 @@ def home():
     """
 
 
+# -------- UPLOADS --------
+# Uploads are copied to the job dir in fixed-size chunks (starlette has
+# already spooled them to disk past 1 MB), so memory per request stays
+# flat; they are hashed on the way for the result cache
+MAX_FILE_BYTES = int(os.environ.get("MAX_FILE_MB", 200)) * 1024 * 1024
+MAX_BATCH_FILES = int(os.environ.get("MAX_BATCH_FILES", 24))    # invoice files per batch
+MAX_REQUEST_BYTES = int(os.environ.get("MAX_REQUEST_MB", 400)) * 1024 * 1024
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+
+EXCEL_MAGIC = {
+    b"PK\x03\x04": ".xlsx",            # zip container
+    b"\xd0\xcf\x11\xe0": ".xls"        # OLE2 compound file
+}
+
+
+def copy_upload(src, job_dir, name):
+    """Chunked copy of one upload; checks its magic number and size cap. Returns (path, SHA-256)."""
+    first = src.read(UPLOAD_CHUNK_SIZE)
+    ext = EXCEL_MAGIC.get(first[:4])
+    if ext is None:
+        raise HTTPException(415, f"{name} is not an Excel workbook")
+
+    path = os.path.join(job_dir, name + ext)
+    size = 0
+    digest = hashlib.sha256()
+    with open(path, "wb") as f:
+        chunk = first
+        while chunk:
+            size += len(chunk)
+            if size > MAX_FILE_BYTES:
+                raise HTTPException(413, f"{name} is larger than {MAX_FILE_BYTES // 2**20} MB")
+            f.write(chunk)
+            digest.update(chunk)
+            chunk = src.read(UPLOAD_CHUNK_SIZE)
+    return path, digest.hexdigest()
+
+
+def check_ledger(payment_file):
+    """No payment upload means the resident ledger: it has to be loaded."""
+    if payment_file is None and not ledger.loaded():
+        raise HTTPException(400, "No payment file uploaded and no PAO ledger loaded")
+
+
+async def save_payment(payment_file, job_dir):
+    """The payment upload's path and SHA-256; (None, None) when the ledger stands in."""
+    if payment_file is None:
+        return None, None
+    return await run_in_threadpool(copy_upload, payment_file.file, job_dir, "payment")
+
+
+async def save_uploads(invoice_file, payment_file):
+    """
+    Store both uploads in a new job dir and check their header rows.
+    Returns the dir, both paths and both files' SHA-256 (payment ones
+    None without a payment upload).
+    """
+    check_ledger(payment_file)
+    job_dir = queue.new_dir()
+
+    try:
+        invoice_path, invoice_digest = await run_in_threadpool(
+            copy_upload, invoice_file.file, job_dir, "invoice"
+        )
+        payment_path, payment_digest = await save_payment(payment_file, job_dir)
+        await run_in_threadpool(check_headers, invoice_path, payment_path)
+    except InputError as e:
+        queue.remove_dir(job_dir)
+        raise HTTPException(400, str(e))
+    except HTTPException:
+        queue.remove_dir(job_dir)
+        raise
+
+    return job_dir, invoice_path, payment_path, (invoice_digest, payment_digest)
+
+
+def batch_names(filenames):
+    """Report folder per invoice upload: its file name, made safe and unique."""
+    names = []
+    for i, filename in enumerate(filenames, 1):
+        stem = os.path.splitext(os.path.basename(filename or ""))[0]
+        name = re.sub(r"[^\w.-]+", "_", stem).strip("._") or f"invoice_{i}"
+        while name in names:
+            name = f"{name}_{i}"
+        names.append(name)
+    return names
+
+
+async def save_batch_uploads(invoice_files, payment_file):
+    """
+    save_uploads for a batch: the invoice files (in upload order) and one
+    payment file. Returns the dir, the invoice paths and report names,
+    the payment path and the SHA-256s (invoice ones as a list).
+    """
+    check_ledger(payment_file)
+    job_dir = queue.new_dir()
+
+    try:
+        invoice_paths, invoice_digests = [], []
+        for i, invoice_file in enumerate(invoice_files, 1):
+            path, digest = await run_in_threadpool(
+                copy_upload, invoice_file.file, job_dir, f"invoice_{i}"
+            )
+            invoice_paths.append(path)
+            invoice_digests.append(digest)
+        payment_path, payment_digest = await save_payment(payment_file, job_dir)
+        await run_in_threadpool(check_batch_headers, invoice_paths, payment_path)
+    except InputError as e:
+        queue.remove_dir(job_dir)
+        raise HTTPException(400, str(e))
+    except HTTPException:
+        queue.remove_dir(job_dir)
+        raise
+
+    names = batch_names([f.filename for f in invoice_files])
+    return job_dir, invoice_paths, names, payment_path, (invoice_digests, payment_digest)
+
+
+class RequestSizeLimit:
+    """
+    Answers 413 for request bodies over `max_bytes`: up front from
+    Content-Length, else as soon as the streamed body passes the cap.
+    """
+
+    def __init__(self, app, max_bytes):
+        self.app = app
+        self.max_bytes = max_bytes
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        too_large = HTTPException(413, f"Request is larger than {self.max_bytes // 2**20} MB")
+        length = dict(scope["headers"]).get(b"content-length")
+        if length is not None and int(length) > self.max_bytes:
+            response = JSONResponse({"detail": too_large.detail}, too_large.status_code)
+            return await response(scope, receive, send)
+
+        received = 0
+
+        async def limited_receive():
+            nonlocal received
+            message = await receive()
+            received += len(message.get("body", b""))
+            if received > self.max_bytes:
+                raise too_large
+            return message
+
+        await self.app(scope, limited_receive, send)
+
+
+app.add_middleware(RequestSizeLimit, max_bytes=MAX_REQUEST_BYTES)
+
+
+def check_format(output_format):
+    if output_format not in FORMATS:
+        raise HTTPException(400, f"output_format must be one of {list(FORMATS)}")
+
+
+async def receive_uploads(save, *files):
+    """save(*files) (save_uploads / save_batch_uploads), timed: the upload stage of the job's Server-Timing."""
+    start = time.perf_counter()
+    saved = await save(*files)
+    upload_seconds = time.perf_counter() - start
+    queue.metrics.observe("upload", upload_seconds)
+    return (*saved, upload_seconds)
+
+
+def enqueue(job_dir, upload_seconds, key, fn, *args, pin=None):
+    """
+    Queue the job (run in the thread pool: a cache hit copies the cached
+    zip into the job dir). The same uploads in the same format share
+    one result: cached, or computed once while identical requests wait.
+    A ledger `pin` is closed once the job is done.
+    """
+    try:
+        job_id = queue.submit(job_dir, fn, *args, key=key)
+    except QueueFull as e:
+        queue.remove_dir(job_dir)
+        if pin is not None:
+            pin.close()
+        raise HTTPException(429, str(e), headers={"Retry-After": "30"})
+    job = queue.get(job_id)
+    job["upload_seconds"] = upload_seconds
+    if pin is not None:
+        job["future"].add_done_callback(lambda f: pin.close())
+    return job_id
+
+
+def payments_for(payment_path, payment_digest):
+    """
+    What the job matches against, its cache digest and a ledger pin: the
+    uploaded PAO file, or the ledger's bills as they stand now (later
+    deltas do not reach a job already queued, and its version is kept
+    until the job is done).
+    """
+    if payment_path is not None:
+        return payment_path, payment_digest, None
+    return ledger.bills()
+
+
+def submit(job_dir, invoice_path, payment_path, digests, upload_seconds, output_format):
+    invoice_digest, payment_digest = digests
+    payments, payment_digest, pin = payments_for(payment_path, payment_digest)
+    key = upload_key(invoice_digest, payment_digest, output_format)
+    return enqueue(
+        job_dir, upload_seconds, key,
+        run_reconcile, invoice_path, payments, job_dir, output_format, key,
+        pin=pin
+    )
+
+
+def submit_batch(job_dir, invoice_paths, names, payment_path, digests, upload_seconds, output_format):
+    invoice_digests, payment_digest = digests
+    payments, payment_digest, pin = payments_for(payment_path, payment_digest)
+    key = batch_key(invoice_digests, names, payment_digest, output_format)
+    return enqueue(
+        job_dir, upload_seconds, key,
+        run_batch, invoice_paths, names, payments, job_dir, output_format, key,
+        pin=pin
+    )
+
+
+# -------- TIMING --------
+def server_timing(job_id, stats):
+    """Server-Timing header value: upload, queue wait and the job's own stages."""
+    job = queue.get(job_id)
+    if "cache" in stats:
+        # the stages were timed by the run that made the result
+        return f'upload;dur={job["upload_seconds"] * 1000:.1f}, cache;desc="{stats["cache"]}"'
+    stages = {"upload": job["upload_seconds"], "queue": stats["started"] - job["submitted"]}
+    stages.update(stats["stages"])
+    return ", ".join(f"{stage};dur={seconds * 1000:.1f}" for stage, seconds in stages.items())
+
+
+def result_response(job_id):
+    """A finished job's zip; the job stays until it expires."""
+    result = queue.get(job_id)["future"].result()
+    return FileResponse(
+        result["zip"],
+        media_type="application/zip",
+        filename=RESULT_NAME,
+        headers={"Server-Timing": server_timing(job_id, result["stats"])}
+    )
+
+
+RESULT_POLL_SECONDS = 0.05
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
+
+async def follow_result(job_id, zip_path):
+    """
+    Stream the zip while the worker is still writing it (entries are
+    append-only, see jobs.AppendOnly). The job's files are removed only
+    after the last chunk is sent, or when the client goes away. A job
+    that fails mid-write aborts the response: the 200 is already out, and
+    ending it normally would hand the client a truncated zip.
+    """
+    future = queue.get(job_id)["future"]
+    try:
+        with open(zip_path, "rb") as f:
+            while True:
+                done = future.done()    # checked first: a read after it sees every byte
+                chunk = f.read(DOWNLOAD_CHUNK_SIZE)
+                if chunk:
+                    yield chunk
+                elif done:
+                    error = future.exception()
+                    if error is not None:
+                        raise RuntimeError(f"Job {job_id} failed while its result was streaming") from error
+                    break
+                else:
+                    await asyncio.sleep(RESULT_POLL_SECONDS)
+    finally:
+        queue.remove(job_id)
+
+
+def job_error(job_id):
+    error = queue.get(job_id)["future"].exception()
+    if isinstance(error, InputError):
+        return HTTPException(400, str(error))
+    return HTTPException(500, f"Reconciliation failed: {error}")
+
+
 # -------- RECONCILE API --------
+# Same as POST /jobs then waiting for the result, for the form above
 @app.post("/reconcile")
 async def reconcile_api(
     invoice_file: UploadFile = File(...),
-    payment_file: UploadFile = File(...)
+    payment_file: Optional[UploadFile] = File(None),
+    output_format: str = Form("xlsx")
 ):
-    tmpdir = tempfile.mkdtemp()
+    check_format(output_format)
+    uploads = await receive_uploads(save_uploads, invoice_file, payment_file)
+    job_dir = uploads[0]
+    job_id = await run_in_threadpool(submit, *uploads, output_format)
+    future = queue.get(job_id)["future"]
+    zip_path = os.path.join(job_dir, RESULT_NAME)
 
-    try:
-        invoice_path = os.path.join(tmpdir, "invoice.xlsx")
-        payment_path = os.path.join(tmpdir, "payment.xlsx")
+    # the archive is written only once reconciliation succeeded: start
+    # streaming when its first bytes land
+    while not future.done() and not (os.path.exists(zip_path) and os.path.getsize(zip_path)):
+        await asyncio.sleep(RESULT_POLL_SECONDS)
 
-        with open(invoice_path, "wb") as f:
-            f.write(await invoice_file.read())
+    if future.done() and future.exception() is not None:
+        error = job_error(job_id)
+        queue.remove(job_id)
+        raise error
 
-        with open(payment_path, "wb") as f:
-            f.write(await payment_file.read())
+    # stages up to the report write; the write is still under way
+    headers = {"Content-Disposition": f'attachment; filename="{RESULT_NAME}"'}
+    with open(os.path.join(job_dir, RUN_STATS_FILE)) as f:
+        headers["Server-Timing"] = server_timing(job_id, json.load(f))
 
-        invoice_df = pd.read_excel(invoice_path)
-        payment_df = pd.read_excel(payment_path)
+    return StreamingResponse(
+        follow_result(job_id, zip_path),
+        media_type="application/zip",
+        headers=headers
+    )
 
-        matched_df, unmatched_df = reconcile(invoice_df, payment_df)
 
-        zip_path = os.path.join(tmpdir, "gem_reconciliation_result.zip")
+# -------- JOBS API --------
+@app.post("/jobs", status_code=202)
+async def create_job(
+    invoice_file: UploadFile = File(...),
+    payment_file: Optional[UploadFile] = File(None),
+    output_format: str = Form("xlsx")
+):
+    check_format(output_format)
+    uploads = await receive_uploads(save_uploads, invoice_file, payment_file)
+    job_id = await run_in_threadpool(submit, *uploads, output_format)
+    return queue.status(job_id)
 
-        with zipfile.ZipFile(zip_path, "w", zipfile.ZIP_DEFLATED) as zipf:
-            matched_path = os.path.join(tmpdir, "matched.xlsx")
-            unmatched_path = os.path.join(tmpdir, "unmatched.xlsx")
 
-            matched_df.to_excel(matched_path, index=False)
-            unmatched_df.to_excel(unmatched_path, index=False)
+# Several GeM files against one PAO file: the PAO file is parsed once and
+# each GeM file only takes the bills the files before it left unpaid. The
+# zip has a folder per GeM file and the consolidated reports; fetch it
+# from /jobs/{job_id}/result
+@app.post("/batch", status_code=202)
+async def create_batch(
+    invoice_files: list[UploadFile] = File(...),
+    payment_file: Optional[UploadFile] = File(None),
+    output_format: str = Form("xlsx")
+):
+    check_format(output_format)
+    if len(invoice_files) > MAX_BATCH_FILES:
+        raise HTTPException(400, f"At most {MAX_BATCH_FILES} invoice files per batch")
+    uploads = await receive_uploads(save_batch_uploads, invoice_files, payment_file)
+    job_id = await run_in_threadpool(submit_batch, *uploads, output_format)
+    return queue.status(job_id)
 
-            zipf.write(matched_path, "matched_invoices.xlsx")
-            zipf.write(unmatched_path, "unmatched_invoices.xlsx")
 
-        return FileResponse(
-            zip_path,
-            media_type="application/zip",
-            filename="gem_reconciliation_result.zip"
-        )
+@app.get("/jobs/{job_id}")
+def job_status(job_id: str):
+    if queue.get(job_id) is None:
+        raise HTTPException(404, "Unknown or expired job")
+    return queue.status(job_id)
+
+
+@app.get("/jobs/{job_id}/result")
+def job_result(job_id: str):
+    job = queue.get(job_id)
+    if job is None:
+        raise HTTPException(404, "Unknown or expired job")
+    if not job["future"].done():
+        raise HTTPException(409, "Job not finished yet")
+    if job["future"].exception() is not None:
+        raise job_error(job_id)
+
+    return result_response(job_id)
+
+
+# -------- PAO LEDGER --------
+def require_admin(x_admin_token: Optional[str] = Header(None)):
+    if not ADMIN_TOKEN:
+        raise HTTPException(403, "Admin endpoints are disabled (set ADMIN_TOKEN)")
+    if not hmac.compare_digest((x_admin_token or "").encode(), ADMIN_TOKEN.encode()):
+        raise HTTPException(403, "Bad or missing X-Admin-Token")
 
+
+async def ledger_update(update, payment_file):
+    """update(path, name) (ledger.load / ledger.append) on the uploaded PAO export."""
+    upload_dir = queue.new_dir()
+    try:
+        path, _ = await run_in_threadpool(copy_upload, payment_file.file, upload_dir, "payment")
+        return await run_in_threadpool(update, path, payment_file.filename)
+    except MissingColumnError as e:
+        raise HTTPException(400, f"Payment file: {e}")
+    except DeltaAlreadyApplied as e:
+        raise HTTPException(409, str(e))
     finally:
-        shutil.rmtree(tmpdir)
+        queue.remove_dir(upload_dir)
+
+
+@app.post("/admin/ledger", dependencies=[Depends(require_admin)])
+async def load_ledger(payment_file: Optional[UploadFile] = File(None)):
+    """Replace the ledger with an uploaded PAO export, or reload PAO_LEDGER_FILE."""
+    if payment_file is not None:
+        return await ledger_update(ledger.load, payment_file)
+    if not PAO_LEDGER_FILE:
+        raise HTTPException(400, "No payment file uploaded and PAO_LEDGER_FILE is not set")
+    return await run_in_threadpool(ledger.load, PAO_LEDGER_FILE)
+
+
+@app.post("/admin/ledger/delta", dependencies=[Depends(require_admin)])
+async def append_ledger(payment_file: UploadFile = File(...)):
+    """Append the bills passed since the last load or delta (same layout as the full export)."""
+    if not ledger.loaded():
+        raise HTTPException(409, "No PAO ledger loaded to append to")
+    return await ledger_update(ledger.append, payment_file)
+
+
+@app.get("/ledger")
+def ledger_summary():
+    return ledger.summary()
+
+
+@app.get("/ledger/bills")
+def ledger_bills(bill_no: Optional[str] = None, fy: Optional[int] = None, amount: Optional[float] = None):
+    """Bills by bill number, or by financial year (its first year) and amount in rupees."""
+    if not ledger.loaded():
+        raise HTTPException(404, "No PAO ledger loaded")
+    if bill_no is not None:
+        bills = ledger.find_bill_no(bill_no)
+    elif fy is not None and amount is not None:
+        bills = ledger.find_amount(fy, to_paise(amount))
+    else:
+        raise HTTPException(400, "Give bill_no, or fy and amount")
+    bills = bills.assign(BILL_AMOUNT=to_rupees(bills["BILL_AMOUNT"]))
+    return json.loads(bills.to_json(orient="records", date_format="iso"))
+
+
+# -------- METRICS --------
+@app.get("/metrics", response_class=PlainTextResponse)
+def metrics():
+    """Job, stage-time and match-mode totals for this worker process (Prometheus text)."""
+    return PlainTextResponse(
+        queue.metrics.render(queue.active()),
+        media_type="text/plain; version=0.0.4"
+    )
@@ -0,0 +1,145 @@
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+import pandas as pd
+
+from run_stats import RUN_STATS_FILE
+from synthetic_data import SEED, generate
+
+# ================= CONFIG =================
+# Each engine runs as a separate process on synthetic exports, in a
+# scratch directory of its own (outputs, parse cache and ledger stay out
+# of the repo). Stage times come back through STAGE_TIMINGS_FILE; every
+# run is appended to RESULTS_FILE so runs on different commits compare.
+BENCH_DIR = "bench"
+RESULTS_FILE = os.path.join(BENCH_DIR, "results.csv")
+
+SCRIPTS = [
+    "reconcile_report_all.py",
+    "reconcile_contigency_report.py",
+    "ok_GemReconcile.py",
+    "first_gem_reconcile.py"
+]
+STAGES = ["load", "normalize", "exact", "combination", "write"]
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def git_revision():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=REPO_DIR, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ""
+
+
+# ================= RUN =================
+def run_script(script, invoice_path, payment_path, work_dir):
+    """Run one engine on the given exports; returns its stage times, search counters and total seconds."""
+    timings_path = os.path.join(work_dir, "timings.json")
+    env = dict(
+        os.environ,
+        INVOICE_FILE=os.path.abspath(invoice_path),
+        PAYMENT_FILE=os.path.abspath(payment_path),
+        STAGE_TIMINGS_FILE=timings_path
+    )
+
+    start = time.perf_counter()
+    result = subprocess.run(
+        [sys.executable, os.path.join(REPO_DIR, script)],
+        cwd=work_dir, env=env, capture_output=True, text=True
+    )
+    total = time.perf_counter() - start
+
+    if result.returncode != 0:
+        raise RuntimeError(f"{script} failed:\n{result.stderr[-2000:]}")
+    with open(timings_path) as f:
+        stages = json.load(f)
+
+    # search counters from the run's RUN_STATS, wherever the script writes its reports
+    search = {}
+    for out_dir in ("output", "reports"):
+        path = os.path.join(work_dir, out_dir, RUN_STATS_FILE)
+        if os.path.exists(path):
+            with open(path) as f:
+                search = json.load(f)["search"]
+    return stages, search, total
+
+
+def benchmark(sizes, scripts=SCRIPTS, repeat=1, fmt="xlsx", seed=SEED, warm=False):
+    """
+    Time every script on synthetic data of each size (number of bills).
+    The first run of a script parses the exports; with `warm`, later runs
+    keep its parse cache. Returns one row per run.
+    """
+    revision = git_revision()
+    rows = []
+    for n_bills in sizes:
+        data_dir = os.path.join(BENCH_DIR, "data", f"{n_bills}_{seed}_{fmt}")
+        invoice_path, payment_path, n_invoices, _ = generate(data_dir, n_bills, fmt, seed)
+
+        for script in scripts:
+            work_dir = tempfile.mkdtemp(prefix="gembench-")
+            try:
+                for run in range(1, repeat + 1):
+                    # a fresh ledger every run, or later runs find nothing unpaid
+                    for sub in ("output", "reports"):
+                        shutil.rmtree(os.path.join(work_dir, sub), ignore_errors=True)
+                    if not warm:
+                        shutil.rmtree(os.path.join(work_dir, ".cache"), ignore_errors=True)
+
+                    stages, search, total = run_script(script, invoice_path, payment_path, work_dir)
+                    rows.append({
+                        "timestamp": datetime.now().isoformat(timespec="seconds"),
+                        "revision": revision,
+                        "script": script,
+                        "bills": n_bills,
+                        "invoices": n_invoices,
+                        "format": fmt,
+                        "seed": seed,
+                        "run": run,
+                        "cache": "warm" if warm and run > 1 else "cold",
+                        **{stage: stages.get(stage) for stage in STAGES},
+                        "total": total,
+                        "combinations": search.get("combinations"),
+                        "max_combinations": search.get("max_combinations")
+                    })
+                    print(f"⏱ {script} {n_bills} bills run {run}: {total:.2f}s")
+            finally:
+                shutil.rmtree(work_dir, ignore_errors=True)
+    return pd.DataFrame(rows)
+
+
+def save_results(results, path=RESULTS_FILE):
+    """Append to the results file, so earlier revisions stay comparable."""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    if os.path.exists(path):
+        results = pd.concat([pd.read_csv(path), results], ignore_index=True)
+    results.to_csv(path, index=False)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Time the reconcile engines stage by stage.")
+    parser.add_argument("--bills", type=int, nargs="+", default=[1000, 10000])
+    parser.add_argument("--scripts", nargs="+", default=SCRIPTS)
+    parser.add_argument("--repeat", type=int, default=1)
+    parser.add_argument("--format", choices=["xlsx", "csv"], default="xlsx")
+    parser.add_argument("--seed", type=int, default=SEED)
+    parser.add_argument("--warm", action="store_true", help="keep the parse cache between runs")
+    args = parser.parse_args()
+
+    results = benchmark(args.bills, args.scripts, args.repeat, args.format, args.seed, args.warm)
+    save_results(results)
+
+    summary = results.groupby(["script", "bills", "cache"])[STAGES + ["total"]].median()
+    print(summary.round(2).to_string())
+    print(f"📂 Results appended to {RESULTS_FILE}")
@@ -0,0 +1,163 @@
+import glob
+import hashlib
+import json
+import os
+import shutil
+import time
+
+import pandas as pd
+
+# ================= CONFIG =================
+CACHE_DIR = ".cache/frames"
+CACHE_MAX_BYTES = 512 * 1024 * 1024    # oldest-used entries go past this
+CACHE_VERSION = 2                      # bump when cleaning/typing changes
+
+# Finished result zips, for repeat uploads of the same pair of files
+RESULT_CACHE_DIR = ".cache/results"
+RESULT_CACHE_MAX_BYTES = int(os.environ.get("RESULT_CACHE_MB", 1024)) * 1024 * 1024
+RESULT_CACHE_TTL_SECONDS = int(os.environ.get("RESULT_CACHE_TTL_SECONDS", 24 * 3600))
+
+CHUNK_SIZE = 1024 * 1024
+
+
+# ================= KEYS =================
+def file_digest(path):
+    """SHA-256 of a file's contents, read in chunks."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def cache_key(path, config):
+    """Key for a parsed file: its contents plus how it was normalized."""
+    digest = hashlib.sha256(file_digest(path).encode())
+    digest.update(json.dumps([CACHE_VERSION, config], sort_keys=True, default=str).encode())
+    return digest.hexdigest()
+
+
+# ================= FRAMES =================
+def cached_frame(path, config, build, cache_dir=CACHE_DIR, max_bytes=CACHE_MAX_BYTES):
+    """
+    The frame `build()` parses from `path`, stored after the first run
+    under the file's content hash and `config` (anything that changes
+    the parsed result: resolved columns, passthrough, script). A parse
+    cache: each hit skips reading and cleaning the export, but still
+    builds a new frame from the entry.
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    key = cache_key(path, config)
+
+    for ext in ("parquet", "pkl"):
+        entry = os.path.join(cache_dir, f"{key}.{ext}")
+        try:
+            os.utime(entry)    # LRU: mtime is the last use
+            return _read_frame(entry)
+        except FileNotFoundError:
+            continue    # never stored, or evicted by another process: a miss
+
+    df = build()
+    try:
+        _write_frame(df, os.path.join(cache_dir, f"{key}.parquet"))
+    except Exception:
+        # Arrow cannot hold every export as-is (e.g. a passthrough column
+        # mixing text and numbers); pickle keeps the frame exactly
+        _write_frame(df, os.path.join(cache_dir, f"{key}.pkl"))
+
+    evict(cache_dir, max_bytes)
+    return df
+
+
+def _read_frame(entry):
+    if entry.endswith(".parquet"):
+        return pd.read_parquet(entry)
+    return pd.read_pickle(entry)
+
+
+def _write_frame(df, entry):
+    # write then rename, so a concurrent reader never sees half a file
+    tmp = f"{entry}.{os.getpid()}.tmp"
+    try:
+        if entry.endswith(".parquet"):
+            df.to_parquet(tmp)
+        else:
+            df.to_pickle(tmp)
+        os.replace(tmp, entry)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+
+def evict(cache_dir=CACHE_DIR, max_bytes=CACHE_MAX_BYTES):
+    """Drop least recently used entries until the cache fits `max_bytes`."""
+    # other processes share the directory: an entry may go at any point
+    entries = []
+    for name in os.listdir(cache_dir):
+        if name.endswith(".tmp"):
+            continue
+        try:
+            stat = os.stat(os.path.join(cache_dir, name))
+        except FileNotFoundError:
+            continue
+        entries.append((stat.st_mtime, stat.st_size, name))
+
+    total = sum(size for _, size, _ in entries)
+    for _, size, name in sorted(entries):
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(os.path.join(cache_dir, name))
+        except FileNotFoundError:
+            pass
+        total -= size
+
+
+# ================= RESULTS =================
+# Entries are named <key>-<created>.zip: least recently used ones go past
+# RESULT_CACHE_MAX_BYTES (mtime is the last use, as for frames) and any
+# older than the TTL are dropped on lookup.
+
+def result_key(digests, config):
+    """Key for a result: the SHA-256 of every input file plus how it was made."""
+    digest = hashlib.sha256()
+    digest.update(json.dumps([CACHE_VERSION, list(digests), config], sort_keys=True, default=str).encode())
+    return digest.hexdigest()
+
+
+def cached_result(key, cache_dir=RESULT_CACHE_DIR, ttl=RESULT_CACHE_TTL_SECONDS):
+    """Path of the cached result for `key`, or None."""
+    for entry in glob.glob(os.path.join(cache_dir, f"{key}-*.zip")):
+        created = int(entry[:-len(".zip")].rsplit("-", 1)[1])
+        try:
+            if time.time() - created > ttl:
+                os.remove(entry)
+                continue
+            os.utime(entry)    # LRU: mtime is the last use
+        except FileNotFoundError:
+            continue    # evicted meanwhile
+        return entry
+    return None
+
+
+def store_result(key, path, cache_dir=RESULT_CACHE_DIR, max_bytes=RESULT_CACHE_MAX_BYTES):
+    """Keep the finished file at `path` as the result for `key`."""
+    os.makedirs(cache_dir, exist_ok=True)
+    entry = os.path.join(cache_dir, f"{key}-{int(time.time())}.zip")
+    tmp = f"{entry}.{os.getpid()}.tmp"
+    try:
+        link_or_copy(path, tmp)
+        os.replace(tmp, entry)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+    evict(cache_dir, max_bytes)
+    return entry
+
+
+def link_or_copy(src, dst):
+    """Hard link `src` to `dst`; a copy when they are on different file systems."""
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
@@ -1,16 +1,46 @@
 import pandas as pd
-from itertools import combinations
 import os
+import time
+
+from cache import cached_frame
+from report_writer import write_reports
+from rules import MatchState, bulk_exact_match, match_bills, with_group_ids
+from run_stats import mode_counts, run_stats, search_frame, write_run_stats
+from utils import (
+    financial_year, read_columns, read_header, safe_to_date, to_paise, to_rupees,
+    StageTimer
+)
 
 # ================= CONFIG =================
-INVOICE_FILE = "data/gem_invoices.xlsx"
-PAYMENT_FILE = "data/payments.xlsx"
+INVOICE_FILE = os.environ.get("INVOICE_FILE", "data/gem_invoices.xlsx")
+PAYMENT_FILE = os.environ.get("PAYMENT_FILE", "data/payments.xlsx")
 OUTPUT_DIR = "output"
+OUTPUT_FORMAT = "xlsx"    # or "csv" / "parquet" (one file per report)
 MAX_COMBINATION_SIZE = 3
-AMOUNT_TOLERANCE = 0.01
+AMOUNT_TOLERANCE = 0    # paise -- bill and invoices must agree to the paisa
+MATCH_WORKERS = os.cpu_count() or 1    # processes for the per-FY bill loop (1 = serial)
+
+# Search budget: a bill whose combination search runs past it is left for
+# manual review as SEARCH_BUDGET_EXCEEDED (None = no limit). Once the run
+# deadline passes, the remaining bills only get the exact match.
+SEARCH_MAX_COMBINATIONS = 1_000_000    # per bill
+SEARCH_MAX_SECONDS = 10                # per bill
+RUN_MAX_SECONDS = None                 # whole run
+
+# Columns carried into the reports besides the ones matching needs;
+# None keeps every column of the export
+INVOICE_PASSTHROUGH_COLUMNS = None
+PAYMENT_PASSTHROUGH_COLUMNS = None
+
+# Parsed-input cache entries are per script: each cleans columns its own way
+SCRIPT = os.path.basename(__file__)
 
 os.makedirs(OUTPUT_DIR, exist_ok=True)
 
+# Per-stage wall time (load, normalize, exact, combination, write)
+timer = StageTimer()
+run_deadline = None if RUN_MAX_SECONDS is None else time.time() + RUN_MAX_SECONDS
+
 # ================= HELPERS =================
 def normalize_columns(df):
     df.columns = (
@@ -29,11 +59,9 @@ def find_column(df, possible_names):
             return name
     raise KeyError(f"None of these columns found: {possible_names}")
 
-def safe_to_date(series):
-    return pd.to_datetime(series, errors="coerce", dayfirst=True)
-
 def safe_to_amount(series):
-    return (
+    # rupees in, integer paise out
+    return to_paise(
         series.astype(str)
         .str.replace(",", "", regex=False)
         .str.strip()
@@ -41,154 +69,182 @@ def safe_to_amount(series):
         .astype(float)
     )
 
-def financial_year(date):
-    if pd.isna(date):
-        return None
-    return date.year if date.month >= 4 else date.year - 1
-
-# ================= LOAD =================
-invoice_df = normalize_columns(pd.read_excel(INVOICE_FILE))
-payment_df = normalize_columns(pd.read_excel(PAYMENT_FILE))
+# ================= READ HEADERS =================
+# Header rows only, so missing columns are reported before any data is parsed
+invoice_header = normalize_columns(read_header(INVOICE_FILE))
+payment_header = normalize_columns(read_header(PAYMENT_FILE))
 
 # ================= FIND COLUMNS =================
-INVOICE_DATE_COL = find_column(invoice_df, ["INVOICE_DATE"])
-PRC_DATE_COL = find_column(invoice_df, ["PRC_DATE"])
-CRAC_AMOUNT_COL = find_column(invoice_df, ["CRAC_AMOUNT"])
-INVOICE_NO_COL = find_column(invoice_df, ["INVOICE_NUMBER"])
-
-PAO_DATE_COL = find_column(payment_df, ["PAO_PASS_DATE", "PAO_DATE"])
-BILL_AMOUNT_COL = find_column(payment_df, ["BILLAMOUNT", "BILL_AMOUNT"])
-BILL_NO_COL = find_column(payment_df, ["BILLNO", "BILL_NO"])
-
-# ================= CLEAN DATA =================
-invoice_df["INVOICE_DATE"] = safe_to_date(invoice_df[INVOICE_DATE_COL])
-invoice_df["PRC_DATE"] = safe_to_date(invoice_df[PRC_DATE_COL])
-invoice_df["ELIGIBLE_DATE"] = invoice_df[["INVOICE_DATE", "PRC_DATE"]].max(axis=1)
-invoice_df["CRAC_AMOUNT"] = safe_to_amount(invoice_df[CRAC_AMOUNT_COL])
-invoice_df["FY"] = invoice_df["ELIGIBLE_DATE"].apply(financial_year)
-
-payment_df["PAO_PASS_DATE"] = safe_to_date(payment_df[PAO_DATE_COL])
-payment_df["BILL_AMOUNT"] = safe_to_amount(payment_df[BILL_AMOUNT_COL])
-payment_df["FY"] = payment_df["PAO_PASS_DATE"].apply(financial_year)
-
-# ================= FLAGS =================
-invoice_df["PAID_FLAG"] = False
-invoice_df["MATCH_GROUP_ID"] = ""
-invoice_df["MATCH_TYPE"] = ""
-invoice_df["CONFIDENCE"] = ""
-invoice_df["PAO_PASS_DATE"] = pd.NaT
-invoice_df["BILLNO"] = ""
-invoice_df["REJECTION_REASON"] = ""
-
-matched_summary = []
-unmatched_payments = []
-group_counter = 1
-
-# ================= MATCHING =================
-for _, pay in payment_df.iterrows():
-    bill_amt = pay["BILL_AMOUNT"]
-    pay_date = pay["PAO_PASS_DATE"]
-    bill_no = pay[BILL_NO_COL]
-    pay_fy = pay["FY"]
-
-    if pd.isna(bill_amt) or pd.isna(pay_date):
-        unmatched_payments.append(
-            {"BILLNO": bill_no, "REASON": "INVALID_PAYMENT_DATA"}
-        )
-        continue
-
-    eligible = invoice_df[
-        (~invoice_df["PAID_FLAG"]) &
-        (invoice_df["ELIGIBLE_DATE"] <= pay_date) &
-        (invoice_df["FY"] == pay_fy)
-    ]
-
-    # ---- Exact match (tolerance-based) ----
-    exact = eligible[
-        (eligible["CRAC_AMOUNT"] - bill_amt).abs() < AMOUNT_TOLERANCE
-    ]
-
-    if not exact.empty:
-        idx = exact.index[0]
-        gid = f"MG{group_counter:05d}"
-        group_counter += 1
-
-        invoice_df.loc[idx, [
-            "PAID_FLAG",
-            "MATCH_GROUP_ID",
-            "MATCH_TYPE",
-            "CONFIDENCE",
-            "PAO_PASS_DATE",
-            "BILLNO"
-        ]] = [
-            True,
-            gid,
-            "AUTO_SINGLE",
-            "HIGH",
-            pay_date,
-            bill_no
-        ]
-
-        matched_summary.append({"MATCH_GROUP_ID": gid, "BILLNO": bill_no})
-        continue
-
-    # ---- Combination match ----
-    found = False
-    candidates = eligible.to_dict("records")
-
-    for r in range(2, MAX_COMBINATION_SIZE + 1):
-        for combo in combinations(candidates, r):
-            if abs(sum(x["CRAC_AMOUNT"] for x in combo) - bill_amt) < AMOUNT_TOLERANCE:
-                gid = f"MG{group_counter:05d}"
-                group_counter += 1
-
-                for x in combo:
-                    idx = invoice_df.index[
-                        invoice_df[INVOICE_NO_COL] == x[INVOICE_NO_COL]
-                    ][0]
-
-                    invoice_df.loc[idx, [
-                        "PAID_FLAG",
-                        "MATCH_GROUP_ID",
-                        "MATCH_TYPE",
-                        "CONFIDENCE",
-                        "PAO_PASS_DATE",
-                        "BILLNO"
-                    ]] = [
-                        True,
-                        gid,
-                        "AUTO_COMBINATION",
-                        "MEDIUM",
-                        pay_date,
-                        bill_no
-                    ]
-
-                matched_summary.append({"MATCH_GROUP_ID": gid, "BILLNO": bill_no})
-                found = True
-                break
-        if found:
-            break
-
-    if not found:
-        reason = "NO_MATCH_IN_SAME_FINANCIAL_YEAR"
-        unmatched_payments.append(
-            {"BILLNO": bill_no, "REASON": reason}
-        )
+INVOICE_DATE_COL = find_column(invoice_header, ["INVOICE_DATE"])
+PRC_DATE_COL = find_column(invoice_header, ["PRC_DATE"])
+CRAC_AMOUNT_COL = find_column(invoice_header, ["CRAC_AMOUNT"])
+INVOICE_NO_COL = find_column(invoice_header, ["INVOICE_NUMBER"])
+
+PAO_DATE_COL = find_column(payment_header, ["PAO_PASS_DATE", "PAO_DATE"])
+BILL_AMOUNT_COL = find_column(payment_header, ["BILLAMOUNT", "BILL_AMOUNT"])
+BILL_NO_COL = find_column(payment_header, ["BILLNO", "BILL_NO"])
+
+# ================= LOAD & CLEAN (CACHED) =================
+# Typed frames are cached under the file's content hash and the column
+# mapping, so repeat runs on the same exports skip the Excel parse
+def load_invoices():
+    df = read_columns(
+        INVOICE_FILE,
+        invoice_header,
+        [INVOICE_DATE_COL, PRC_DATE_COL, CRAC_AMOUNT_COL, INVOICE_NO_COL],
+        INVOICE_PASSTHROUGH_COLUMNS
+    )
+    timer.lap("load")
+    df["INVOICE_DATE"] = safe_to_date(df[INVOICE_DATE_COL])
+    df["PRC_DATE"] = safe_to_date(df[PRC_DATE_COL])
+    df["ELIGIBLE_DATE"] = df[["INVOICE_DATE", "PRC_DATE"]].max(axis=1)
+    df["CRAC_AMOUNT"] = safe_to_amount(df[CRAC_AMOUNT_COL])
+    df["FY"] = financial_year(df["ELIGIBLE_DATE"])
+    timer.lap("normalize")
+    return df
 
-# ================= OUTPUT =================
-invoice_df[invoice_df["PAID_FLAG"]] \
-    .sort_values("MATCH_GROUP_ID") \
-    .to_excel(f"{OUTPUT_DIR}/matched_invoices.xlsx", index=False)
+def load_payments():
+    df = read_columns(
+        PAYMENT_FILE,
+        payment_header,
+        [PAO_DATE_COL, BILL_AMOUNT_COL, BILL_NO_COL],
+        PAYMENT_PASSTHROUGH_COLUMNS
+    )
+    timer.lap("load")
+    df["PAO_PASS_DATE"] = safe_to_date(df[PAO_DATE_COL])
+    df["BILL_AMOUNT"] = safe_to_amount(df[BILL_AMOUNT_COL])
+    df["FY"] = financial_year(df["PAO_PASS_DATE"])
+    timer.lap("normalize")
+    return df
 
-invoice_df[~invoice_df["PAID_FLAG"]] \
-    .to_excel(f"{OUTPUT_DIR}/unpaid_invoices.xlsx", index=False)
+invoice_df = cached_frame(
+    INVOICE_FILE,
+    [SCRIPT, "invoices", INVOICE_DATE_COL, PRC_DATE_COL, CRAC_AMOUNT_COL, INVOICE_NO_COL,
+     INVOICE_PASSTHROUGH_COLUMNS],
+    load_invoices
+)
+payment_df = cached_frame(
+    PAYMENT_FILE,
+    [SCRIPT, "payments", PAO_DATE_COL, BILL_AMOUNT_COL, BILL_NO_COL,
+     PAYMENT_PASSTHROUGH_COLUMNS],
+    load_payments
+)
+timer.lap("load")
 
-pd.DataFrame(unmatched_payments) \
-    .to_excel(f"{OUTPUT_DIR}/unmatched_payments.xlsx", index=False)
+# ================= FLAGS =================
+# Per-invoice match results by row position; written back once at the
+# end (and once now, so the empty result columns are in place)
+state = MatchState(len(invoice_df))
+state.write_back(invoice_df)
+
+timer.lap("normalize")
+
+# ================= BULK EXACT MATCH =================
+# All one-to-one matches in a single join; the loop below only sees the
+# bills left over.
+exact_pairs = bulk_exact_match(
+    invoice_df,
+    payment_df[
+        payment_df["BILL_AMOUNT"].notna() &
+        payment_df["PAO_PASS_DATE"].notna()
+    ],
+    "BILL_AMOUNT",
+    tolerance=AMOUNT_TOLERANCE,
+    invoice_date_col="ELIGIBLE_DATE",
+    bill_date_col="PAO_PASS_DATE"
+)
+exact_bills = payment_df.loc[exact_pairs["BILL"]]
+
+state.mark(
+    exact_pairs["INVOICE"].to_numpy(),
+    exact_pairs["BILL"].to_numpy(),
+    "AUTO_SINGLE",
+    "HIGH",
+    exact_bills["PAO_PASS_DATE"].to_numpy(),
+    exact_bills[BILL_NO_COL].to_numpy()
+)
+
+timer.lap("exact")
+
+# ================= MATCHING (PER FY, IN PARALLEL) =================
+# Bills left over are matched FY by FY; results come back in bill order
+remaining = payment_df.drop(exact_pairs["BILL"])
+valid = remaining["BILL_AMOUNT"].notna() & remaining["PAO_PASS_DATE"].notna()
+
+matched, unmatched, searched = match_bills(
+    invoice_df,
+    remaining[valid],
+    "BILL_AMOUNT",
+    "PAO_PASS_DATE",
+    state.paid,
+    MAX_COMBINATION_SIZE,
+    tolerance=AMOUNT_TOLERANCE,
+    invoice_date_col="ELIGIBLE_DATE",
+    workers=MATCH_WORKERS,
+    max_combinations=SEARCH_MAX_COMBINATIONS,
+    bill_seconds=SEARCH_MAX_SECONDS,
+    deadline=run_deadline
+)
+
+for p_idx, positions, match_type in matched:
+    pay = payment_df.loc[p_idx]
+    state.mark(positions, p_idx, match_type,
+               "HIGH" if match_type == "AUTO_SINGLE" else "MEDIUM",
+               pay["PAO_PASS_DATE"], pay[BILL_NO_COL])
+
+# Unmatched bills, in processing order
+reasons = {p_idx: "INVALID_PAYMENT_DATA" for p_idx in remaining.index[~valid]}
+reasons.update({
+    p_idx: reason if reason == "SEARCH_BUDGET_EXCEEDED" else "NO_MATCH_IN_SAME_FINANCIAL_YEAR"
+    for p_idx, reason in unmatched
+})
+unmatched_payments = [
+    {"BILLNO": payment_df.at[p_idx, BILL_NO_COL], "REASON": reason}
+    for p_idx, reason in sorted(reasons.items())
+]
+
+# Candidates and combinations per searched bill, worst first
+searches = search_frame(searched, payment_df[BILL_NO_COL])
+
+timer.lap("combination")
+
+# ================= WRITE BACK (GROUP IDS IN PROCESSING ORDER) =================
+state.write_back(invoice_df)
+
+matched_bills = state.matched_bills()
+matched_summary = pd.DataFrame({
+    "MATCH_GROUP_ID": matched_bills["MATCH_GROUP_ID"].to_numpy(),
+    "BILLNO": payment_df.loc[matched_bills["BILL"], BILL_NO_COL].to_numpy()
+})
+group_counter = len(matched_summary) + 1
 
-pd.DataFrame(matched_summary) \
-    .to_excel(f"{OUTPUT_DIR}/payment_invoice_map.xlsx", index=False)
+# ================= OUTPUT =================
+# Amounts are held in paise; reports show rupees
+invoice_df["CRAC_AMOUNT"] = to_rupees(invoice_df["CRAC_AMOUNT"])
+
+# All reports in one pass (one workbook for xlsx)
+write_reports(
+    {
+        "matched_invoices": with_group_ids(
+            invoice_df[invoice_df["PAID_FLAG"]].sort_values("MATCH_GROUP_ID", kind="stable")
+        ),
+        "unpaid_invoices": with_group_ids(invoice_df[~invoice_df["PAID_FLAG"]]),
+        "unmatched_payments": pd.DataFrame(unmatched_payments),
+        "payment_invoice_map": with_group_ids(matched_summary),
+        "RUN_STATS": searches.drop(columns="BILL")
+    },
+    OUTPUT_FORMAT,
+    OUTPUT_DIR
+)
+timer.lap("write")
+
+# Stage times, bills per match mode and the worst searches
+write_run_stats(
+    run_stats(timer.laps, mode_counts(len(exact_pairs), searches, len(unmatched_payments)), searches),
+    OUTPUT_DIR
+)
 
 print("✅ Reconciliation complete")
 print(f"✔ Matched groups      : {group_counter - 1}")
 print(f"⚠ Unmatched payments : {len(unmatched_payments)}")
+timer.report()
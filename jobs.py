@@ -0,0 +1,472 @@
+import json
+import multiprocessing
+import os
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+import zipfile
+from collections import Counter, defaultdict
+from concurrent.futures import Future, ProcessPoolExecutor
+from dataclasses import asdict
+
+from cache import cached_frame, cached_result, link_or_copy, result_key, store_result
+from reconcile_core import (
+    ENGINE_VERSION, MissingColumnError, ReconcileConfig, batch_reports, batch_totals,
+    clean_invoices, clean_payments, file_reports, invoice_columns, match, match_batch,
+    normalize_columns, payment_columns
+)
+from pao_ledger import LedgerBills
+from report_writer import report_files
+from run_stats import RUN_STATS_FILE, run_stats, write_run_stats
+from utils import StageTimer, read_columns, read_header
+
+# ================= CONFIG =================
+# Set per deployment through the environment
+JOB_WORKERS = int(os.environ.get("JOB_WORKERS", os.cpu_count() or 1))
+JOB_QUEUE_LIMIT = int(os.environ.get("JOB_QUEUE_LIMIT", 16))    # queued + running
+JOB_TTL_SECONDS = int(os.environ.get("JOB_TTL_SECONDS", 3600))  # finished jobs kept this long
+
+RESULT_NAME = "gem_reconciliation_result.zip"
+
+# Same engine and settings as reconcile_report_all.py, but with only the
+# combination budget: a result is cached and served again, so it must not
+# depend on how busy the server was. Jobs already run in parallel, so each
+# one matches its bills serially
+ENGINE_CONFIG = ReconcileConfig(max_combination_size=4, workers=1)
+
+
+class InputError(ValueError):
+    """An upload the engine cannot reconcile (reported to the client as 400)."""
+
+
+class QueueFull(RuntimeError):
+    """Too many jobs queued or running (reported to the client as 429)."""
+
+
+# ================= RECONCILE (RUNS IN A WORKER PROCESS) =================
+def check_headers(invoice_path, payment_path=None):
+    """
+    Header rows only: fail on missing columns before parsing any data.
+    No payment file (None) when the bills come from the resident ledger.
+    """
+    invoice_header = normalize_columns(read_header(invoice_path))
+    try:
+        invoice_columns(invoice_header)
+    except MissingColumnError as e:
+        raise InputError(f"Invoice file: {e}")
+
+    return invoice_header, check_payment_header(payment_path)
+
+
+def check_batch_headers(invoice_paths, payment_path=None):
+    """check_headers for several invoice files; errors name the file by its place (from 1)."""
+    invoice_headers = []
+    for i, path in enumerate(invoice_paths, 1):
+        header = normalize_columns(read_header(path))
+        try:
+            invoice_columns(header)
+        except MissingColumnError as e:
+            raise InputError(f"Invoice file {i}: {e}")
+        invoice_headers.append(header)
+
+    return invoice_headers, check_payment_header(payment_path)
+
+
+def check_payment_header(payment_path):
+    if payment_path is None:
+        return None
+    payment_header = normalize_columns(read_header(payment_path))
+    try:
+        payment_columns(payment_header)
+    except MissingColumnError as e:
+        raise InputError(f"Payment file: {e}")
+    return payment_header
+
+
+def upload_key(invoice_digest, payment_digest, fmt):
+    """Result-cache key for an upload pair (SHA-256 digests) and report format."""
+    return result_key([invoice_digest, payment_digest], [ENGINE_VERSION, asdict(ENGINE_CONFIG), fmt])
+
+
+def batch_key(invoice_digests, names, payment_digest, fmt):
+    """Result-cache key for a batch upload: invoice files in order, their report names, the PAO file."""
+    return result_key(
+        [*invoice_digests, payment_digest],
+        [ENGINE_VERSION, asdict(ENGINE_CONFIG), fmt, "batch", names]
+    )
+
+
+def load_invoices(path, header):
+    # every column is kept; the ones the engine parses keep their dtype.
+    # Repeat uploads of the same workbook skip the Excel parse
+    columns = list(invoice_columns(header).values())
+    return cached_frame(path, ["app", "invoices"], lambda: read_columns(path, header, columns))
+
+
+def load_payments(path, header):
+    columns = [c for c in payment_columns(header).values() if c is not None]
+    return cached_frame(path, ["app", "payments"], lambda: read_columns(path, header, columns))
+
+
+def clean_invoice_file(path, header):
+    df = normalize_columns(load_invoices(path, header).copy(deep=False))
+    return clean_invoices(df, invoice_columns(header))
+
+
+def bill_frame(payments, header, fys=None):
+    """
+    Cleaned bills: `payments` is either a PAO workbook's path or a
+    version of the resident ledger (pao_ledger.LedgerBills), read from
+    its shared file -- only the bills of `fys`, when given.
+    """
+    if isinstance(payments, LedgerBills):
+        return payments.frame(fys)
+    df = normalize_columns(load_payments(payments, header).copy(deep=False))
+    return clean_payments(df, payment_columns(header))
+
+
+def run_reconcile(invoice_path, payments, out_dir, fmt="xlsx", key=None):
+    """
+    Reconcile an uploaded GeM workbook against `payments` (the PAO
+    workbook's path, or the resident ledger's bills) into a result zip
+    holding the reports in `fmt` (see report_writer.FORMATS) and
+    run_stats.json, kept in the result cache under `key` if given.
+    Returns {"zip": path, "stats": run stats}.
+    """
+    timer = StageTimer()
+    started = time.time()
+    payment_path = None if isinstance(payments, LedgerBills) else payments
+    invoice_header, payment_header = check_headers(invoice_path, payment_path)
+    invoice_df = clean_invoice_file(invoice_path, invoice_header)
+    # from the ledger, only bills of the invoices' years: no other bill can match
+    payment_df = bill_frame(payments, payment_header, invoice_df["FY"].dropna().unique())
+
+    timer.lap("load")
+
+    result = match(invoice_df, payment_df, ENGINE_CONFIG, timer)
+
+    stats = {"started": started, **run_stats(timer.laps, result.modes, result.searches)}
+    # in the job dir before the zip starts, for the streamed response's headers
+    write_run_stats(stats, out_dir)
+
+    def trailer():
+        timer.lap("write")
+        stats["stages"] = dict(timer.laps)
+        return {RUN_STATS_FILE: json.dumps(stats, indent=2, default=str).encode()}
+
+    zip_path = os.path.join(out_dir, RESULT_NAME)
+    write_zip(zip_path, report_files(result.reports(), fmt), trailer)
+    if key is not None:
+        store_result(key, zip_path)
+    return {"zip": zip_path, "stats": stats}
+
+
+def run_batch(invoice_paths, names, payments, out_dir, fmt="xlsx", key=None):
+    """
+    Reconcile several uploaded GeM workbooks, in order, against one PAO
+    workbook or the resident ledger's bills (parsed once; see
+    reconcile_core.match_batch) into a result zip: each file's reports
+    in a folder named from `names`, the consolidated reports and
+    run_stats.json at the top.
+    """
+    timer = StageTimer()
+    started = time.time()
+    payment_path = None if isinstance(payments, LedgerBills) else payments
+    invoice_headers, payment_header = check_batch_headers(invoice_paths, payment_path)
+
+    # the files are cleaned one at a time below, so their years are not
+    # known yet: a batch takes the whole ledger
+    payment_df = bill_frame(payments, payment_header)
+    timer.lap("load")
+
+    def invoice_files():
+        for path, header, name in zip(invoice_paths, invoice_headers, names):
+            df = clean_invoice_file(path, header)
+            timer.lap("load")
+            yield name, df
+
+    results = dict(match_batch(invoice_files(), payment_df, ENGINE_CONFIG, timer))
+
+    modes, searches = batch_totals(results)
+    stats = {"started": started, **run_stats(timer.laps, modes, searches)}
+    write_run_stats(stats, out_dir)
+
+    def trailer():
+        timer.lap("write")
+        stats["stages"] = dict(timer.laps)
+        return {RUN_STATS_FILE: json.dumps(stats, indent=2, default=str).encode()}
+
+    files = [
+        (f"{name}/{file_name}", write)
+        for name, result in results.items()
+        for file_name, write in report_files(file_reports(result), fmt)
+    ]
+    files += report_files(batch_reports(results), fmt)
+
+    zip_path = os.path.join(out_dir, RESULT_NAME)
+    write_zip(zip_path, files, trailer)
+    if key is not None:
+        store_result(key, zip_path)
+    return {"zip": zip_path, "stats": stats}
+
+
+def copy_result(src, out_dir, source):
+    """
+    A finished result zip from the cache or an identical job, linked into
+    `out_dir` with its run_stats.json; `source` ("hit" or "coalesced")
+    is recorded in the stats.
+    """
+    with zipfile.ZipFile(src) as zipf:
+        stats = json.loads(zipf.read(RUN_STATS_FILE))
+    stats["cache"] = source
+    # stats first: the zip's arrival is what starts a streamed response
+    write_run_stats(stats, out_dir)
+    zip_path = os.path.join(out_dir, RESULT_NAME)
+    link_or_copy(src, zip_path)
+    return {"zip": zip_path, "stats": stats}
+
+
+class AppendOnly:
+    """
+    A file zipfile cannot seek in: entries are then written with trailing
+    data descriptors and earlier bytes are never rewritten, so the archive
+    can be streamed to the client while it is still being written.
+    """
+
+    def __init__(self, f):
+        self.f = f
+
+    def write(self, data):
+        return self.f.write(data)
+
+    def tell(self):
+        return self.f.tell()
+
+    def flush(self):
+        self.f.flush()
+
+
+def write_zip(path, files, trailer=None):
+    """
+    Serialize the reports (report_writer.report_files pairs) straight into
+    their zip entries: no intermediate files. `trailer()`, if given,
+    returns more {name: bytes} entries, built once the reports are written.
+    """
+    with open(path, "wb") as f:
+        with zipfile.ZipFile(AppendOnly(f), "w", zipfile.ZIP_DEFLATED) as zipf:
+            for name, write in files:
+                with zipf.open(name, "w") as entry:
+                    write(entry)
+            if trailer is not None:
+                for name, data in trailer().items():
+                    zipf.writestr(name, data)
+
+
+# ================= METRICS =================
+class JobMetrics:
+    """
+    Totals over the jobs this process has run, in Prometheus text format
+    for GET /metrics: jobs by outcome, seconds per stage and bills per
+    match mode.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()    # done-callbacks run on the pool's thread
+        self.jobs = Counter()
+        self.stage_seconds = defaultdict(float)
+        self.modes = Counter()
+
+    def observe(self, stage, seconds):
+        with self.lock:
+            self.stage_seconds[stage] += seconds
+
+    def record(self, future, submitted):
+        with self.lock:
+            if future.cancelled() or future.exception() is not None:
+                self.jobs["failed"] += 1
+                return
+            stats = future.result()["stats"]
+            if "cache" in stats:
+                self.jobs[stats["cache"]] += 1    # served without running
+                return
+            self.jobs["done"] += 1
+            self.stage_seconds["queue"] += stats["started"] - submitted
+            for stage, seconds in stats["stages"].items():
+                self.stage_seconds[stage] += seconds
+            self.modes.update(stats["modes"])
+
+    def render(self, active):
+        with self.lock:
+            lines = [
+                "# HELP gem_jobs_total Reconcile jobs finished, by outcome.",
+                "# TYPE gem_jobs_total counter",
+                *(f'gem_jobs_total{{status="{s}"}} {n}' for s, n in sorted(self.jobs.items())),
+                "# HELP gem_jobs_active Reconcile jobs queued or running.",
+                "# TYPE gem_jobs_active gauge",
+                f"gem_jobs_active {active}",
+                "# HELP gem_stage_seconds_total Wall time spent per stage.",
+                "# TYPE gem_stage_seconds_total counter",
+                *(f'gem_stage_seconds_total{{stage="{s}"}} {t:.6f}'
+                  for s, t in sorted(self.stage_seconds.items())),
+                "# HELP gem_match_mode_total Bills per match mode.",
+                "# TYPE gem_match_mode_total counter",
+                *(f'gem_match_mode_total{{mode="{m}"}} {n}' for m, n in sorted(self.modes.items()))
+            ]
+        return "\n".join(lines) + "\n"
+
+
+# ================= JOB QUEUE =================
+def pool_context():
+    """
+    Start method for the job pool: never a plain fork of the server,
+    whose threads (event loop, thread pool) may hold locks mid-fork. A
+    fork server with this module preloaded starts each pool process
+    with the engine already imported; spawn where there is none.
+    """
+    if "forkserver" not in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context("spawn")
+    context = multiprocessing.get_context("forkserver")
+    context.set_forkserver_preload([__name__])
+    return context
+
+
+class JobQueue:
+    """
+    Reconcile jobs on a bounded process pool, so CPU-bound work never runs
+    on the event loop; the engine is imported with this module, so each
+    pool process loads it once, not per job. Jobs live in this process:
+    with several uvicorn workers a job is only visible to the worker that
+    accepted it.
+
+    A job submitted with a result-cache key is answered from the cache
+    (on disk, shared by every worker) when the result is there, and waits
+    on an identical job still running here rather than running again.
+    """
+
+    def __init__(self, workers=JOB_WORKERS, limit=JOB_QUEUE_LIMIT, ttl=JOB_TTL_SECONDS):
+        self.pool = ProcessPoolExecutor(max_workers=workers, mp_context=pool_context())
+        self.limit = limit
+        self.ttl = ttl
+        self.jobs = {}
+        self.running = {}    # result-cache key -> future of the job computing it
+        self.metrics = JobMetrics()
+        # submit() runs on several request threads at once: the cache and
+        # in-flight lookups, pool.submit and the registration happen under
+        # this lock, so identical jobs coalesce. Reentrant: a future that
+        # is already done runs its callbacks in the calling thread.
+        self.lock = threading.RLock()
+
+    def new_dir(self):
+        return tempfile.mkdtemp(prefix="gemjob-")
+
+    def submit(self, job_dir, fn, *args, key=None):
+        """
+        Queue fn(*args) for work files in `job_dir`; returns the job id.
+        With a result-cache `key`, fn must store its result there.
+        """
+        self.expire()
+        submitted = time.time()
+        while True:
+            with self.lock:
+                cached = cached_result(key) if key is not None else None
+                if cached is None:
+                    if key is not None and key in self.running:
+                        return self.add(job_dir, self.follow(self.running[key], key, job_dir), submitted)
+
+                    if self.active() >= self.limit:
+                        raise QueueFull(f"{self.limit} jobs already queued or running")
+
+                    future = self.pool.submit(fn, *args)
+                    if key is not None:
+                        self.running[key] = future
+                        future.add_done_callback(lambda f: self.finished(key, f))
+                    return self.add(job_dir, future, submitted)
+
+            # a hit needs no registration: the zip is linked outside the lock
+            try:
+                result = copy_result(cached, job_dir, "hit")
+            except FileNotFoundError:
+                continue    # evicted by another process since the lookup: look again
+            future = Future()
+            future.set_result(result)
+            return self.add(job_dir, future, submitted)
+
+    def finished(self, key, future):
+        with self.lock:
+            if self.running.get(key) is future:
+                del self.running[key]
+
+    def add(self, job_dir, future, submitted):
+        job_id = uuid.uuid4().hex
+        future.add_done_callback(lambda f: self.metrics.record(f, submitted))
+        with self.lock:
+            self.jobs[job_id] = {"dir": job_dir, "future": future, "submitted": submitted}
+        return job_id
+
+    def follow(self, running, key, job_dir):
+        """A future for `job_dir` that resolves with a copy of the running job's result."""
+        waiter = Future()
+        waiter.set_running_or_notify_cancel()
+
+        def done(f):
+            if f.cancelled() or f.exception() is not None:
+                waiter.set_exception(f.exception() or RuntimeError("Identical job was cancelled"))
+                return
+            try:
+                # the owner's zip may already be gone once its download finished
+                src = cached_result(key) or f.result()["zip"]
+                waiter.set_result(copy_result(src, job_dir, "coalesced"))
+            except Exception as e:
+                waiter.set_exception(e)
+
+        running.add_done_callback(done)
+        return waiter
+
+    def active(self):
+        return sum(not job["future"].done() for job in self.snapshot())
+
+    def snapshot(self):
+        """The jobs as a list, taken under the lock: other threads add and remove them."""
+        with self.lock:
+            return list(self.jobs.values())
+
+    def get(self, job_id):
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def status(self, job_id):
+        future = self.get(job_id)["future"]
+        if not future.done():
+            return {"job_id": job_id, "status": "running" if future.running() else "queued"}
+        if future.exception() is not None:
+            return {"job_id": job_id, "status": "failed", "error": str(future.exception())}
+        return {"job_id": job_id, "status": "done"}
+
+    def remove(self, job_id):
+        with self.lock:
+            job = self.jobs.pop(job_id, None)
+        if job is not None:
+            self.remove_dir(job["dir"])
+
+    def remove_dir(self, job_dir):
+        shutil.rmtree(job_dir, ignore_errors=True)
+
+    def expire(self):
+        """Drop finished jobs older than the TTL, with their files."""
+        cutoff = time.time() - self.ttl
+        with self.lock:
+            expired = [
+                job_id for job_id, job in self.jobs.items()
+                if job["future"].done() and job["submitted"] < cutoff
+            ]
+        for job_id in expired:
+            self.remove(job_id)
+
+    def shutdown(self):
+        self.pool.shutdown(cancel_futures=True)
+        with self.lock:
+            job_ids = list(self.jobs)
+        for job_id in job_ids:
+            self.remove(job_id)
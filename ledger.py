@@ -0,0 +1,257 @@
+import sqlite3
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+# ================= SCHEMA =================
+# Bills, invoices and match groups persist across runs, so each run only
+# reconciles new invoices against the bills still unpaid. Amounts are
+# integer paise, dates ISO text.
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    run_id       INTEGER PRIMARY KEY,
+    started      TEXT NOT NULL,
+    invoice_file TEXT,
+    payment_file TEXT
+);
+
+CREATE TABLE IF NOT EXISTS bills (
+    bill_id   INTEGER PRIMARY KEY,    -- insertion order
+    bill_no   TEXT,
+    fy        INTEGER,
+    amount    INTEGER,
+    pass_date TEXT,
+    status    TEXT NOT NULL DEFAULT 'UNPAID',
+    run_id    INTEGER REFERENCES runs (run_id),
+    group_id  TEXT
+);
+CREATE INDEX IF NOT EXISTS bills_fy_amount ON bills (fy, amount);
+CREATE INDEX IF NOT EXISTS bills_bill_no ON bills (bill_no, pass_date, amount);
+CREATE INDEX IF NOT EXISTS bills_unpaid ON bills (bill_id) WHERE status = 'UNPAID';
+
+CREATE TABLE IF NOT EXISTS invoices (
+    invoice_key TEXT PRIMARY KEY,
+    fy          INTEGER,
+    amount      INTEGER,
+    prc_date    TEXT,
+    status      TEXT NOT NULL DEFAULT 'UNPAID',
+    run_id      INTEGER REFERENCES runs (run_id),
+    group_id    TEXT,
+    bill_id     INTEGER REFERENCES bills (bill_id)
+);
+CREATE INDEX IF NOT EXISTS invoices_fy_amount ON invoices (fy, amount);
+
+CREATE TABLE IF NOT EXISTS match_groups (
+    run_id     INTEGER REFERENCES runs (run_id),
+    group_id   TEXT,
+    bill_id    INTEGER REFERENCES bills (bill_id),
+    match_type TEXT,
+    PRIMARY KEY (run_id, group_id)
+);
+"""
+
+
+def _text(value):
+    return None if pd.isna(value) else str(value)
+
+
+def _int(value):
+    return None if pd.isna(value) else int(value)
+
+
+def _texts(values):
+    """A column as a list of str (None for missing), as _text gives one value."""
+    values = pd.Series(values).reset_index(drop=True)
+    return values.astype(str).astype(object).where(values.notna(), None).tolist()
+
+
+def _ints(values):
+    values = pd.Series(values).reset_index(drop=True).astype("Int64")
+    return values.astype(object).where(values.notna(), None).tolist()
+
+
+class Ledger:
+    """SQLite-backed reconciliation state shared by successive runs."""
+
+    def __init__(self, path):
+        self.db = sqlite3.connect(path)
+        self.db.executescript(SCHEMA)
+
+    def close(self):
+        self.db.close()
+
+    def start_run(self, invoice_file, payment_file):
+        with self.db:
+            cur = self.db.execute(
+                "INSERT INTO runs (started, invoice_file, payment_file) VALUES (?, ?, ?)",
+                (datetime.now().isoformat(timespec="seconds"), str(invoice_file), str(payment_file))
+            )
+        return cur.lastrowid
+
+    # ---------------- bills ----------------
+    def add_bills(self, bill_nos, fys, amounts, pass_dates, statuses=None):
+        """
+        Register the bills not held yet -- a bill is its (bill no, pass
+        date, amount) -- in the given order, and return the bill_id of
+        every row. A status column from an old _updated PAO file seeds
+        the status of new bills.
+        """
+        if statuses is None:
+            statuses = ["UNPAID"] * len(bill_nos)
+
+        rows = list(zip(
+            range(len(bill_nos)),
+            _texts(bill_nos),
+            _ints(fys),
+            _ints(amounts),
+            _texts(pd.to_datetime(pd.Series(pass_dates)).dt.strftime("%Y-%m-%d %H:%M:%S")),
+            _texts(statuses)
+        ))
+        same_bill = (
+            "b.bill_no IS i.bill_no AND b.pass_date IS i.pass_date AND b.amount IS i.amount"
+        )
+        with self.db:
+            self.db.execute(
+                "CREATE TEMP TABLE IF NOT EXISTS incoming "
+                "(seq INTEGER PRIMARY KEY, bill_no TEXT, fy INTEGER, amount INTEGER, "
+                "pass_date TEXT, status TEXT)"
+            )
+            self.db.execute("DELETE FROM incoming")
+            self.db.executemany("INSERT INTO incoming VALUES (?, ?, ?, ?, ?, ?)", rows)
+            # the first row of each bill not held yet, in file order
+            self.db.execute(
+                f"""
+                INSERT INTO bills (bill_no, fy, amount, pass_date, status)
+                SELECT bill_no, fy, amount, pass_date, status FROM incoming i
+                WHERE seq IN (SELECT MIN(seq) FROM incoming GROUP BY bill_no, pass_date, amount)
+                  AND NOT EXISTS (SELECT 1 FROM bills b WHERE {same_bill})
+                ORDER BY seq
+                """
+            )
+            ids = self.db.execute(
+                f"SELECT (SELECT MIN(bill_id) FROM bills b WHERE {same_bill}) "
+                "FROM incoming i ORDER BY seq"
+            ).fetchall()
+        return np.array([bill_id for (bill_id,) in ids], dtype=np.int64)
+
+    def unpaid_bills(self, order=()):
+        """
+        Unpaid bills indexed by bill_id, in processing order: the bill ids
+        of `order` first, as listed (this run's PAO export), then any
+        others by bill_id.
+        """
+        df = pd.read_sql_query(
+            "SELECT bill_id, bill_no, fy, amount, pass_date FROM bills "
+            "WHERE status = 'UNPAID' ORDER BY bill_id",
+            self.db,
+            index_col="bill_id"
+        )
+        listed = pd.Series(np.arange(len(order)), index=np.asarray(order, dtype=np.int64))
+        listed = listed[~listed.index.duplicated()]
+        rank = listed.reindex(df.index).fillna(len(order)).to_numpy()
+        df = df.iloc[np.argsort(rank, kind="stable")]
+        return pd.DataFrame({
+            "BILL_NO": df["bill_no"],
+            "FY": df["fy"].astype("Int16"),
+            "AMOUNT": df["amount"].astype("Int64"),
+            "PASS_DATE": pd.to_datetime(df["pass_date"])
+        })
+
+    def bills(self):
+        """Every bill with its status, for reports."""
+        return pd.read_sql_query(
+            "SELECT * FROM bills ORDER BY bill_id", self.db, index_col="bill_id"
+        )
+
+    # ---------------- invoices ----------------
+    def add_invoices(self, keys, fys, amounts, prc_dates):
+        """Register invoices not seen before, keyed on their GeM number."""
+        rows = [
+            (_text(key), _int(fy), _int(amt), _text(date))
+            for key, fy, amt, date in zip(keys, fys, amounts, prc_dates)
+            if not pd.isna(key)
+        ]
+        with self.db:
+            self.db.executemany(
+                "INSERT OR IGNORE INTO invoices (invoice_key, fy, amount, prc_date) "
+                "VALUES (?, ?, ?, ?)",
+                rows
+            )
+
+    def settled_invoices(self, keys):
+        """
+        How the ledger settled each of `keys`, one row per key in order:
+        GROUP_ID, MATCH_TYPE, BILL_NO and PASS_DATE of the bill that paid
+        it, missing for invoices not paid yet.
+        """
+        keys = [_text(k) for k in keys]
+        with self.db:
+            self.db.execute(
+                "CREATE TEMP TABLE IF NOT EXISTS lookup (seq INTEGER PRIMARY KEY, invoice_key TEXT)"
+            )
+            self.db.execute("DELETE FROM lookup")
+            self.db.executemany("INSERT INTO lookup VALUES (?, ?)", enumerate(keys))
+            df = pd.read_sql_query(
+                "SELECT l.seq, i.group_id, g.match_type, b.bill_no, b.pass_date "
+                "FROM lookup l "
+                "JOIN invoices i ON i.invoice_key = l.invoice_key AND i.status = 'PAID' "
+                "JOIN bills b ON b.bill_id = i.bill_id "
+                "LEFT JOIN match_groups g ON g.run_id = i.run_id AND g.group_id = i.group_id",
+                self.db,
+                index_col="seq"
+            )
+        df = df.reindex(range(len(keys)))
+        return pd.DataFrame({
+            "GROUP_ID": df["group_id"],
+            "MATCH_TYPE": df["match_type"],
+            "BILL_NO": df["bill_no"],
+            "PASS_DATE": pd.to_datetime(df["pass_date"])
+        })
+
+    # ---------------- results ----------------
+    def next_group(self):
+        """Group number for this run's first match: group ids run on across runs."""
+        (last,) = self.db.execute(
+            "SELECT MAX(CAST(SUBSTR(group_id, 3) AS INTEGER)) FROM match_groups"
+        ).fetchone()
+        return (last or 0) + 1
+
+    def record(self, run_id, groups, invoice_keys):
+        """
+        Store a run's matches in one transaction. `groups` has BILL (bill_id),
+        MATCH_TYPE and MATCH_GROUP_ID; `invoice_keys` has INVOICE_KEY, BILL
+        and MATCH_GROUP_ID for every matched invoice.
+        """
+        with self.db:
+            self.db.executemany(
+                "INSERT INTO match_groups (run_id, group_id, bill_id, match_type) "
+                "VALUES (?, ?, ?, ?)",
+                [
+                    (run_id, gid, int(bill), mtype)
+                    for bill, mtype, gid in zip(
+                        groups["BILL"], groups["MATCH_TYPE"], groups["MATCH_GROUP_ID"]
+                    )
+                ]
+            )
+            self.db.executemany(
+                "UPDATE bills SET status = 'FULLY_PAID', run_id = ?, group_id = ? "
+                "WHERE bill_id = ?",
+                [
+                    (run_id, gid, int(bill))
+                    for bill, gid in zip(groups["BILL"], groups["MATCH_GROUP_ID"])
+                ]
+            )
+            self.db.executemany(
+                "UPDATE invoices SET status = 'PAID', run_id = ?, group_id = ?, bill_id = ? "
+                "WHERE invoice_key = ?",
+                [
+                    (run_id, gid, int(bill), _text(key))
+                    for key, bill, gid in zip(
+                        invoice_keys["INVOICE_KEY"],
+                        invoice_keys["BILL"],
+                        invoice_keys["MATCH_GROUP_ID"]
+                    )
+                    if not pd.isna(key)
+                ]
+            )
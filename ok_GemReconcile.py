@@ -1,24 +1,59 @@
 
 
 
+import numpy as np
 import pandas as pd
-from itertools import combinations 
 import os  
+import time
+
+from cache import cached_frame
+from ledger import Ledger
+from report_writer import write_reports
+from rules import MatchState, bulk_exact_match, match_bills, format_group_ids, with_group_ids
+from run_stats import mode_counts, run_stats, search_frame, write_run_stats
+from utils import (
+    financial_year, read_columns, read_header, safe_to_date, to_paise, to_rupees,
+    StageTimer
+)
 
 # ================= CONFIG =================
-GEM_INVOICE_FILE = "data/gem_reports_bulk_payment.xlsx"  
-PAO_PAYMENT_FILE = "data/ContingencyBillsPassedbyPAO.xlsx" 
+GEM_INVOICE_FILE = os.environ.get("INVOICE_FILE", "data/gem_reports_bulk_payment.xlsx")
+PAO_PAYMENT_FILE = os.environ.get("PAYMENT_FILE", "data/ContingencyBillsPassedbyPAO.xlsx")
 OUTPUT_DIR = "reports"
+OUTPUT_FORMAT = "xlsx"    # or "csv" / "parquet" (one file per report)
 
 MAX_COMBINATION_SIZE = 6  
-AMOUNT_TOLERANCE = 0.01   # ₹ tolerance
+AMOUNT_TOLERANCE = 1      # paise (₹0.01) tolerance
+MATCH_WORKERS = os.cpu_count() or 1    # processes for the per-FY bill loop (1 = serial)
+
+# Search budget: a bill whose combination search runs past it is left for
+# manual review as SEARCH_BUDGET_EXCEEDED (None = no limit). Once the run
+# deadline passes, the remaining bills only get the exact match.
+SEARCH_MAX_COMBINATIONS = 1_000_000    # per bill
+SEARCH_MAX_SECONDS = 10                # per bill
+RUN_MAX_SECONDS = None                 # whole run
+
+# Columns carried into the reports besides the ones matching needs;
+# None keeps every column of the export
+GEM_PASSTHROUGH_COLUMNS = None
+PAO_PASSTHROUGH_COLUMNS = None
+
+# Reconciliation state persists here between runs, so only new invoices
+# and still-unpaid bills are reconciled. EXPORT_PAO_STATUS also reports
+# the ledger's bill status (what the old _updated PAO workbook held).
+LEDGER_FILE = f"{OUTPUT_DIR}/reconciliation_ledger.sqlite"
+EXPORT_PAO_STATUS = False
+
+# Parsed-input cache entries are per script: each cleans columns its own way
+SCRIPT = os.path.basename(__file__)
 
 os.makedirs(OUTPUT_DIR, exist_ok=True) 
 
-## ================= HELPERS =================
+# Per-stage wall time (load, normalize, exact, combination, write)
+timer = StageTimer()
+run_deadline = None if RUN_MAX_SECONDS is None else time.time() + RUN_MAX_SECONDS
 
-def read_file(file):
-    return pd.read_excel(file)
+## ================= HELPERS =================
 
 def normalize_columns(df):
     df.columns = (
@@ -36,12 +71,10 @@ def find_any(df, possible_column_name):
             return name
     raise KeyError(f"None of these columns found : {possible_column_name}")
 
-def safe_to_date(series):
-    return pd.to_datetime(series, errors="coerce", dayfirst=True)
-
 def safe_to_amount(series):
-    if series is None: return 0.0
-    return (
+    # rupees in, integer paise out
+    if series is None: return 0
+    return to_paise(
         series.astype(str)
         .str.replace(r"[^\d.-]", "", regex=True)
         .str.strip()
@@ -49,200 +82,318 @@ def safe_to_amount(series):
         .astype(float)
     )
 
-def financial_year(date):
-    if pd.isna(date):
-        return None
-    return date.year if date.month >= 4 else date.year - 1
-
 def is_acb_dcb(bill_no):
     if pd.isna(bill_no):
         return False
     b = str(bill_no).strip().upper()
     return b.startswith("ACB") or b.startswith("DCB")
 
-# ================= LOAD & PREPARE FILES =================
-
-gem_invoice_df = normalize_columns(read_file(GEM_INVOICE_FILE))
-pao_payment_df = normalize_columns(read_file(PAO_PAYMENT_FILE))
-
-# Process newest records first (your idea — kept)
-gem_invoice_df = gem_invoice_df.iloc[::1].reset_index(drop=True)
-pao_payment_df = pao_payment_df.iloc[::-1].reset_index(drop=True)
+# ================= READ HEADERS =================
+# Header rows only: columns are resolved, and missing ones reported,
+# before any data is parsed
+gem_invoice_header = normalize_columns(read_header(GEM_INVOICE_FILE))
+pao_payment_header = normalize_columns(read_header(PAO_PAYMENT_FILE))
 
 # ================= MAP REQUIRED COLUMNS =================
 
 # ----- GEM (Invoice) -----
-GEM_PRC_DATE_COL = find_any(gem_invoice_df, ["PRC DATE", "PRC_DATE"])
-GEM_CRAC_AMOUNT_COL = find_any(gem_invoice_df, ["CRAC AMOUNT", "CRAC_AMOUNT"])
-
-gem_invoice_df["GEM_PRC_DATE"] = safe_to_date(gem_invoice_df[GEM_PRC_DATE_COL])
-gem_invoice_df["CRAC_AMOUNT"] = safe_to_amount(gem_invoice_df[GEM_CRAC_AMOUNT_COL])
-gem_invoice_df["FY"] = gem_invoice_df["GEM_PRC_DATE"].apply(financial_year)
+GEM_PRC_DATE_COL = find_any(gem_invoice_header, ["PRC DATE", "PRC_DATE"])
+GEM_CRAC_AMOUNT_COL = find_any(gem_invoice_header, ["CRAC AMOUNT", "CRAC_AMOUNT"])
+# optional: lets the ledger recognise invoices settled by an earlier run
+GEM_INVOICE_KEY_COL = next(
+    (c for c in ["CRAC NUMBER", "INVOICE NUMBER"] if c in gem_invoice_header.columns), None
+)
 
 # ----- PAO (Payment) -----
-PAO_BILL_PASS_DATE_COL = find_any(pao_payment_df, ["PAO PASS DATE", "BILL DATE", "PASS DATE"])
-PAO_BILL_AMOUNT_COL = find_any(pao_payment_df, ["BILLAMOUNT", "BILL AMOUNT"])
-PAO_BILL_NO_COL = find_any(pao_payment_df, ["BILLNO", "BILL NO"])
+PAO_BILL_PASS_DATE_COL = find_any(pao_payment_header, ["PAO PASS DATE", "BILL DATE", "PASS DATE"])
+PAO_BILL_AMOUNT_COL = find_any(pao_payment_header, ["BILLAMOUNT", "BILL AMOUNT"])
+PAO_BILL_NO_COL = find_any(pao_payment_header, ["BILLNO", "BILL NO"])
+
+# ================= LOAD & PREPARE FILES (CACHED) =================
+# Typed frames are cached under the file's content hash and the column
+# mapping, so repeat runs on the same exports skip the Excel parse
+
+def load_gem_invoices():
+    df = read_columns(
+        GEM_INVOICE_FILE,
+        gem_invoice_header,
+        [GEM_PRC_DATE_COL, GEM_CRAC_AMOUNT_COL] + [GEM_INVOICE_KEY_COL] * (GEM_INVOICE_KEY_COL is not None),
+        GEM_PASSTHROUGH_COLUMNS
+    )
+    timer.lap("load")
+    df = df.iloc[::1].reset_index(drop=True)
 
-pao_payment_df["PAO_BILL_PASS_DATE"] = safe_to_date(pao_payment_df[PAO_BILL_PASS_DATE_COL])
-pao_payment_df["PAO_BILL_AMOUNT"] = safe_to_amount(pao_payment_df[PAO_BILL_AMOUNT_COL])
-pao_payment_df["PAO_BILL_NO"] = pao_payment_df[PAO_BILL_NO_COL].astype(str).str.strip()
-pao_payment_df["FY"] = pao_payment_df["PAO_BILL_PASS_DATE"].apply(financial_year)
+    df["GEM_PRC_DATE"] = safe_to_date(df[GEM_PRC_DATE_COL])
+    df["CRAC_AMOUNT"] = safe_to_amount(df[GEM_CRAC_AMOUNT_COL])
+    df["FY"] = financial_year(df["GEM_PRC_DATE"])
+    timer.lap("normalize")
+    return df
+
+def load_pao_payments():
+    df = read_columns(
+        PAO_PAYMENT_FILE,
+        pao_payment_header,
+        [PAO_BILL_PASS_DATE_COL, PAO_BILL_AMOUNT_COL, PAO_BILL_NO_COL],
+        # a previous run's _updated file brings its paid flags along
+        None if PAO_PASSTHROUGH_COLUMNS is None else PAO_PASSTHROUGH_COLUMNS + ["PAO_PAID_STATUS"]
+    )
+    timer.lap("load")
+    # Process newest records first (your idea — kept)
+    df = df.iloc[::-1].reset_index(drop=True)
+
+    df["PAO_BILL_PASS_DATE"] = safe_to_date(df[PAO_BILL_PASS_DATE_COL])
+    df["PAO_BILL_AMOUNT"] = safe_to_amount(df[PAO_BILL_AMOUNT_COL])
+    df["PAO_BILL_NO"] = df[PAO_BILL_NO_COL].astype(str).str.strip()
+    df["FY"] = financial_year(df["PAO_BILL_PASS_DATE"])
+    timer.lap("normalize")
+    return df
+
+gem_invoice_df = cached_frame(
+    GEM_INVOICE_FILE,
+    [SCRIPT, "invoices", GEM_PRC_DATE_COL, GEM_CRAC_AMOUNT_COL, GEM_INVOICE_KEY_COL,
+     GEM_PASSTHROUGH_COLUMNS],
+    load_gem_invoices
+)
+pao_payment_df = cached_frame(
+    PAO_PAYMENT_FILE,
+    [SCRIPT, "payments", PAO_BILL_PASS_DATE_COL, PAO_BILL_AMOUNT_COL, PAO_BILL_NO_COL,
+     PAO_PASSTHROUGH_COLUMNS],
+    load_pao_payments
+)
+timer.lap("load")
 
 # ========== NEW: PAO STATE FLAG (LIGHTWEIGHT, SAFE) ==========
+# An old _updated PAO file still carries its flags into the ledger
 if "PAO_PAID_STATUS" not in pao_payment_df.columns:
-    pao_payment_df["PAO_PAID_STATUS"] = "UNPAID"
+    pao_payment_df["PAO_PAID_STATUS"] = pd.Categorical.from_codes(np.zeros(len(pao_payment_df), dtype=np.int8), ["UNPAID"])
 
 # Remove ACB / DCB from consideration (your rule #6)
-pao_payment_df = pao_payment_df[~pao_payment_df["PAO_BILL_NO"].apply(is_acb_dcb)].copy()
+pao_payment_df = pao_payment_df[~pao_payment_df["PAO_BILL_NO"].apply(is_acb_dcb)]
+
+# ================= LEDGER =================
+ledger = Ledger(LEDGER_FILE)
+run_id = ledger.start_run(GEM_INVOICE_FILE, PAO_PAYMENT_FILE)
+
+# Bills join the ledger once (a bill is its number, pass date and
+# amount). The engine sees every bill still unpaid, in this export's order
+# as before the ledger (bills it no longer lists go last), labelled by
+# position; their ledger ids are kept for recording the matches.
+export_bill_ids = ledger.add_bills(
+    pao_payment_df["PAO_BILL_NO"],
+    pao_payment_df["FY"],
+    pao_payment_df["PAO_BILL_AMOUNT"],
+    pao_payment_df["PAO_BILL_PASS_DATE"],
+    pao_payment_df["PAO_PAID_STATUS"]
+)
+unpaid_bills = ledger.unpaid_bills(order=export_bill_ids)
+bill_ids = unpaid_bills.index.to_numpy()    # engine label -> ledger bill_id
+unpaid_bills = unpaid_bills.reset_index(drop=True)
+pao_payment_df = pd.DataFrame({
+    "PAO_BILL_NO": unpaid_bills["BILL_NO"],
+    "PAO_BILL_AMOUNT": unpaid_bills["AMOUNT"],
+    "PAO_BILL_PASS_DATE": unpaid_bills["PASS_DATE"],
+    "FY": unpaid_bills["FY"]
+})
+
+# Invoices settled by an earlier run are left out of matching; the
+# reports show them again as the ledger holds them
+settled_df = gem_invoice_df.iloc[:0]
+if GEM_INVOICE_KEY_COL is not None:
+    ledger.add_invoices(
+        gem_invoice_df[GEM_INVOICE_KEY_COL],
+        gem_invoice_df["FY"],
+        gem_invoice_df["CRAC_AMOUNT"],
+        gem_invoice_df["GEM_PRC_DATE"]
+    )
+    settled = ledger.settled_invoices(gem_invoice_df[GEM_INVOICE_KEY_COL])
+    earlier = settled["GROUP_ID"].notna().to_numpy()
+    settled = settled[earlier].reset_index(drop=True)
+    settled_df = gem_invoice_df[earlier].set_axis(earlier.nonzero()[0])
+    open_rows = (~earlier).nonzero()[0]    # position in the export of each row matched now
+    gem_invoice_df = gem_invoice_df[~earlier].reset_index(drop=True)
+    invoice_keys = gem_invoice_df[GEM_INVOICE_KEY_COL].to_numpy()
+else:
+    open_rows = np.arange(len(gem_invoice_df))
+    invoice_keys = np.full(len(gem_invoice_df), None)    # matched invoices not tracked
 
 # ================= INITIAL FLAGS (GEM SIDE) =================
-gem_invoice_df["PAID_FLAG"] = False
-gem_invoice_df["MATCH_GROUP_ID"] = ""
-gem_invoice_df["MATCH_TYPE"] = ""
-gem_invoice_df["CONFIDENCE"] = ""
-gem_invoice_df["PAO_BILL_PASS_DATE_FINAL"] = pd.NaT  
-gem_invoice_df["PAO_BILL_NO_FINAL"] = ""             
-gem_invoice_df["REJECTION_REASON"] = ""
+# Per-invoice match results by row position; written back once at the
+# end (and once now, so the empty result columns are in place). Group
+# ids carry on from the ledger's last run.
+state = MatchState(len(gem_invoice_df), first_group=ledger.next_group())
+state.write_back(gem_invoice_df, "PAO_BILL_PASS_DATE_FINAL", "PAO_BILL_NO_FINAL")
 
 unmatched_payments = []
-group_counter = 1
-
-# ================= MATCHING ENGINE =================
-
-for p_idx, pay in pao_payment_df.iterrows():
-    bill_no = pay["PAO_BILL_NO"]
-    bill_amt = pay["PAO_BILL_AMOUNT"]
-    pay_date = pay["PAO_BILL_PASS_DATE"]
-    pay_fy = pay["FY"]
-
-    # Skip already fully paid PAO bills
-    if pay["PAO_PAID_STATUS"] == "FULLY_PAID":
-        continue
-
-    # Basic Data Validation
-    if pd.isna(bill_amt) or pd.isna(pay_date):
-        unmatched_payments.append({
-            "BILLNO": bill_no,
-            "REASON": "MISSING_DATE_OR_AMOUNT"
-        })
-        continue
-
-    # -------- ELIGIBILITY FILTER (FY + DATE RULE) --------
-    mask = (
-        (~gem_invoice_df["PAID_FLAG"]) & 
-        (gem_invoice_df["FY"] == pay_fy) &           # SAME FINANCIAL YEAR
-        (gem_invoice_df["GEM_PRC_DATE"] <= pay_date) # INVOICE DATE <= PAYMENT DATE
-    )
-    eligible = gem_invoice_df[mask].copy()
-
-    if eligible.empty:
-        unmatched_payments.append({
-            "BILLNO": bill_no,
-            "AMOUNT": bill_amt,
-            "DATE": pay_date,
-            "REASON": "NO_ELIGIBLE_INVOICES_IN_SAME_FY"
-        })
-        continue
-
-    # ================= PRIORITY 1: STRICT EXACT MATCH =================
-    exact = eligible[
-        (eligible["CRAC_AMOUNT"] - bill_amt).abs() <= AMOUNT_TOLERANCE
-    ]
-
-    matched_ids = []
-    matched_sum = 0.0
-    match_type = None
-
-    if not exact.empty:
-        matched_ids = [exact.index[0]]
-        matched_sum = exact.iloc[0]["CRAC_AMOUNT"]
-        match_type = "AUTO_SINGLE"
-
-    # ================= PRIORITY 2: STRICT COMBINATION MATCH =================
-    if not matched_ids:
-        candidates = eligible.index.tolist()
+paid_bills = []
+
+timer.lap("normalize")
+
+# ================= PRIORITY 1 (BULK): STRICT EXACT MATCH =================
+# All one-to-one matches in a single join; the engine below only sees
+# the bills this pass could not settle.
+exact_pairs = bulk_exact_match(
+    gem_invoice_df,
+    pao_payment_df[
+        pao_payment_df["PAO_BILL_AMOUNT"].notna() &
+        pao_payment_df["PAO_BILL_PASS_DATE"].notna()
+    ],
+    "PAO_BILL_AMOUNT",
+    tolerance=AMOUNT_TOLERANCE,
+    invoice_date_col="GEM_PRC_DATE",
+    bill_date_col="PAO_BILL_PASS_DATE"
+)
+exact_bills = pao_payment_df.loc[exact_pairs["BILL"]]
+
+state.mark(
+    exact_pairs["INVOICE"].to_numpy(),
+    exact_pairs["BILL"].to_numpy(),
+    "AUTO_SINGLE",
+    "HIGH",
+    exact_bills["PAO_BILL_PASS_DATE"].to_numpy(),
+    exact_bills["PAO_BILL_NO"].to_numpy()
+)
+paid_bills.extend(exact_pairs["BILL"])
+
+timer.lap("exact")
+
+# ================= MATCHING ENGINE (PER FY, IN PARALLEL) =================
+# Bills left over are matched FY by FY; results come back in PAO order
+remaining = pao_payment_df.drop(exact_pairs["BILL"])
+
+# Basic Data Validation
+invalid = remaining["PAO_BILL_AMOUNT"].isna() | remaining["PAO_BILL_PASS_DATE"].isna()
+
+# PRIORITY 1: STRICT EXACT MATCH, then PRIORITY 2: STRICT COMBINATION MATCH
+# Same FY, INVOICE DATE <= PAYMENT DATE, amount within tolerance
+matched, unmatched, searched = match_bills(
+    gem_invoice_df,
+    remaining[~invalid],
+    "PAO_BILL_AMOUNT",
+    "PAO_BILL_PASS_DATE",
+    state.paid,
+    MAX_COMBINATION_SIZE,
+    tolerance=AMOUNT_TOLERANCE,
+    invoice_date_col="GEM_PRC_DATE",
+    workers=MATCH_WORKERS,
+    max_combinations=SEARCH_MAX_COMBINATIONS,
+    bill_seconds=SEARCH_MAX_SECONDS,
+    deadline=run_deadline
+)
 
-        for r in range(2, MAX_COMBINATION_SIZE + 1):
-            for combo in combinations(candidates, r):
-                combo_sum = gem_invoice_df.loc[list(combo), "CRAC_AMOUNT"].sum()
+crac_amounts = gem_invoice_df["CRAC_AMOUNT"].to_numpy("int64", na_value=0)
+reasons = {p_idx: "MISSING_DATE_OR_AMOUNT" for p_idx in remaining.index[invalid]}
+unmatched_reasons = {
+    "NO_CANDIDATES": "NO_ELIGIBLE_INVOICES_IN_SAME_FY",
+    "NO_MATCH": "NO_FULL_MATCH_FOUND",
+    "SEARCH_BUDGET_EXCEEDED": "SEARCH_BUDGET_EXCEEDED"
+}
+reasons.update({p_idx: unmatched_reasons[reason] for p_idx, reason in unmatched})
 
-                if abs(combo_sum - bill_amt) <= AMOUNT_TOLERANCE:
-                    matched_ids = list(combo)
-                    matched_sum = combo_sum
-                    match_type = "AUTO_COMBINATION"
-                    break
-            if matched_ids:
-                break
+for p_idx, matched_ids, match_type in matched:
+    pay = pao_payment_df.loc[p_idx]
 
     # ================= STRICT RULE: NO PART PAYMENT =================
-    if not matched_ids:
-        unmatched_payments.append({
-            "BILLNO": bill_no,
-            "AMOUNT": bill_amt,
-            "DATE": pay_date,
-            "REASON": "NO_FULL_MATCH_FOUND"
-        })
+    # If sum != full bill amount → REJECT completely
+    if abs(crac_amounts[matched_ids].sum() - pay["PAO_BILL_AMOUNT"]) > AMOUNT_TOLERANCE:
+        reasons[p_idx] = "PARTIAL_MATCH_NOT_ALLOWED"
         continue
 
-    # If sum != full bill amount → REJECT completely
-    if abs(matched_sum - bill_amt) > AMOUNT_TOLERANCE:
+    # ================= ACCEPT MATCH (FULL ONLY) =================
+    state.mark(matched_ids, p_idx, match_type,
+               "HIGH" if match_type == "AUTO_SINGLE" else "MEDIUM",
+               pay["PAO_BILL_PASS_DATE"], pay["PAO_BILL_NO"])
+
+    # Settled in the ledger at the end of the run
+    paid_bills.append(p_idx)
+
+# Unmatched bills, in PAO processing order
+for p_idx, reason in sorted(reasons.items()):
+    pay = pao_payment_df.loc[p_idx]
+    if reason == "MISSING_DATE_OR_AMOUNT":
+        unmatched_payments.append({"BILLNO": pay["PAO_BILL_NO"], "REASON": reason})
+    else:
         unmatched_payments.append({
-            "BILLNO": bill_no,
-            "AMOUNT": bill_amt,
-            "DATE": pay_date,
-            "REASON": "PARTIAL_MATCH_NOT_ALLOWED"
+            "BILLNO": pay["PAO_BILL_NO"],
+            "AMOUNT": to_rupees(pay["PAO_BILL_AMOUNT"]),
+            "DATE": pay["PAO_BILL_PASS_DATE"],
+            "REASON": reason
         })
-        continue
 
-    # ================= ACCEPT MATCH (FULL ONLY) =================
-    gid = f"MG{group_counter:05d}"
-    group_counter += 1
-
-    gem_invoice_df.loc[matched_ids, [
-        "PAID_FLAG",
-        "MATCH_GROUP_ID",
-        "MATCH_TYPE",
-        "CONFIDENCE",
-        "PAO_BILL_PASS_DATE_FINAL",
-        "PAO_BILL_NO_FINAL"
-    ]] = [True, gid, match_type, 
-          "HIGH" if match_type == "AUTO_SINGLE" else "MEDIUM",
-          pay_date, bill_no]
-
-    # Update PAO payment file state (lightweight flag)
-    pao_payment_df.loc[p_idx, "PAO_PAID_STATUS"] = "FULLY_PAID"
+# Candidates and combinations per searched bill, worst first
+searches = search_frame(searched, pao_payment_df["PAO_BILL_NO"])
+
+timer.lap("combination")
+
+# ================= WRITE BACK (GROUP IDS IN PAO PROCESSING ORDER) =================
+state.write_back(gem_invoice_df, "PAO_BILL_PASS_DATE_FINAL", "PAO_BILL_NO_FINAL")
+group_counter = len(paid_bills) + 1
+
+# ================= LEDGER UPDATE (ONE TRANSACTION) =================
+groups = with_group_ids(state.matched_bills())
+groups["BILL"] = bill_ids[groups["BILL"]]
+ledger.record(
+    run_id,
+    groups,
+    pd.DataFrame({
+        "INVOICE_KEY": invoice_keys[state.paid],
+        "BILL": bill_ids[state.bill[state.paid]],
+        "MATCH_GROUP_ID": format_group_ids(gem_invoice_df["MATCH_GROUP_ID"].to_numpy()[state.paid])
+    })
+)
+
+# ================= EARLIER RUNS (FROM THE LEDGER) =================
+# Invoices of this export settled by an earlier run go back in their
+# place, with the group, bill and match type the ledger recorded
+if len(settled_df):
+    group_numbers = settled["GROUP_ID"].str[2:].astype("int32").to_numpy()
+    earlier_state = MatchState(len(settled_df))
+    for match_type, rows in settled.groupby("MATCH_TYPE").indices.items():
+        earlier_state.mark(
+            rows, group_numbers[rows], match_type,
+            "HIGH" if match_type == "AUTO_SINGLE" else "MEDIUM",
+            settled["PASS_DATE"].to_numpy()[rows],
+            settled["BILL_NO"].to_numpy()[rows]
+        )
+    earlier_state.write_back(settled_df, "PAO_BILL_PASS_DATE_FINAL", "PAO_BILL_NO_FINAL")
+    settled_df["MATCH_GROUP_ID"] = group_numbers
+
+    gem_invoice_df.index = open_rows
+    gem_invoice_df = pd.concat([gem_invoice_df, settled_df]).sort_index().reset_index(drop=True)
 
 # ================= OUTPUT FILES =================
 
-# Format dates nicely for Excel
-final_report = gem_invoice_df[gem_invoice_df["PAID_FLAG"]].copy()
+# Amounts are held in paise; reports show rupees
+gem_invoice_df["CRAC_AMOUNT"] = to_rupees(gem_invoice_df["CRAC_AMOUNT"])
 
-final_report["PAO_BILL_PASS_DATE_FINAL"] = final_report["PAO_BILL_PASS_DATE_FINAL"].dt.date
-final_report["GEM_PRC_DATE"] = final_report["GEM_PRC_DATE"].dt.date
+# Dates keep native Excel date formats (set by the report writer)
+final_report = with_group_ids(gem_invoice_df[gem_invoice_df["PAID_FLAG"]])
 
 ## uncomment  if you want sorted by MATCH_GROUP_ID
-'''
-final_report.sort_values("MATCH_GROUP_ID").to_excel(
-    f"{OUTPUT_DIR}/matched_invoices.xlsx", index=False
-)
-'''
-
-#no sort based on "MATCH_GROUP_ID"
-final_report.to_excel(
-    f"{OUTPUT_DIR}/matched_invoices.xlsx", index=False
-)
-
-gem_invoice_df[~gem_invoice_df["PAID_FLAG"]] \
-    .to_excel(f"{OUTPUT_DIR}/unpaid_invoices.xlsx", index=False)
-
-pd.DataFrame(unmatched_payments).to_excel(
-    f"{OUTPUT_DIR}/unmatched_payments.xlsx", index=False
-)
-
-# Save updated PAO file (so next GEM file sees progress)
-pao_payment_df.to_excel(
-    f"{OUTPUT_DIR}/ContingencyBillsPassedbyPAO_updated.xlsx", index=False
+# final_report = final_report.sort_values("MATCH_GROUP_ID", kind="stable")
+
+reports = {
+    "matched_invoices": final_report,    # no sort based on "MATCH_GROUP_ID"
+    "unpaid_invoices": with_group_ids(gem_invoice_df[~gem_invoice_df["PAID_FLAG"]]),
+    "unmatched_payments": pd.DataFrame(unmatched_payments),
+    "RUN_STATS": searches.drop(columns="BILL")
+}
+
+# PAO bill status is kept in the ledger; written out only on request
+if EXPORT_PAO_STATUS:
+    pao_status = ledger.bills().rename(columns=str.upper)
+    pao_status["AMOUNT"] = to_rupees(pao_status["AMOUNT"])
+    reports["pao_bill_status"] = pao_status
+
+# All reports in one pass (one workbook for xlsx)
+write_reports(reports, OUTPUT_FORMAT, OUTPUT_DIR)
+
+ledger.close()
+timer.lap("write")
+
+# Stage times, bills per match mode and the worst searches
+write_run_stats(
+    run_stats(timer.laps, mode_counts(len(exact_pairs), searches, len(unmatched_payments)), searches),
+    OUTPUT_DIR
 )
 
 print("---")
@@ -250,6 +401,7 @@ print(f"✅ Reconciliation Complete!")
 print(f"📂 Reports saved in: {OUTPUT_DIR}/")
 print(f"✔ Successfully Matched: {group_counter - 1} bills")
 print(f"⚠ Unmatched/Invalid:    {len(unmatched_payments)} bills")
+timer.report()
 
 
 '''
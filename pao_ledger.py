@@ -0,0 +1,403 @@
+import bisect
+import hashlib
+import json
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from typing import NamedTuple
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+
+try:
+    import fcntl
+except ImportError:    # no flock (Windows): run a single server process
+    fcntl = None
+
+from cache import file_digest
+from reconcile_core import clean_payments, normalize_columns, payment_columns
+from utils import read_columns, read_header
+
+# ================= RESIDENT PAO LEDGER =================
+# The web server keeps the PAO contingency-bill register, cleaned and
+# indexed, so users upload only the GeM file. The register only ever
+# grows: a delta upload is a PAO export of the rows added since, appended
+# after the bills already held (processing order is load order) with the
+# indexes merged in. Only the engine's columns are kept.
+#
+# The register lives in LEDGER_DIR as an Arrow IPC file that every
+# uvicorn worker memory-maps read-only for lookups, so the page cache
+# holds one copy however many workers read it. A job reads the same file
+# and converts only the bills it can use to a frame of its own: those of
+# its invoices' financial years, found on the mapped file (a copy of
+# those rows, without re-parsing the export). A load or delta writes a
+# new file and swaps the CURRENT pointer to it (os.replace: atomic); a
+# delta reuses the published record batches and adds its own, without a
+# pass through pandas. Each process picks the new version up on its next
+# request. Published files never change; past the newest LEDGER_KEEP they
+# are removed, except those a queued or running job has pinned (pin(): a
+# shared flock held until the job is done).
+LEDGER_DIR = os.environ.get("LEDGER_DIR", ".cache/ledger")
+LEDGER_KEEP = 3
+LEDGER_COLUMNS = ["BILLNO", "BILL_AMOUNT", "BILL_DATE", "HEAD_OF_ACCOUNT", "FY"]
+
+# Heads of account as one dictionary type, whatever categories (if any)
+# an export had, so a delta's batches line up with the published ones
+HEAD_TYPE = pa.dictionary(pa.int32(), pa.string())
+
+# Indexes are stored as columns next to the bills: bill labels sorted by
+# (FY, amount) key, with the keys, and bill labels sorted by bill number
+NO_KEY = np.iinfo(np.int64).max    # bills without FY or amount sort last
+
+
+class DeltaAlreadyApplied(ValueError):
+    """A delta upload identical to one the ledger already holds."""
+
+
+def read_bills(path):
+    """A PAO export's bills, cleaned (reconcile_core.clean_payments), engine columns only."""
+    header = normalize_columns(read_header(path))
+    columns = payment_columns(header)
+    df = read_columns(path, header, [c for c in columns.values() if c is not None], passthrough=[])
+    return clean_payments(df, columns)[LEDGER_COLUMNS]
+
+
+# ================= INDEXES =================
+def fy_amount_keys(fys, amounts):
+    """One int64 key per (FY, paise amount) pair."""
+    return np.asarray(fys, dtype=np.int64) * 10**13 + np.asarray(amounts, dtype=np.int64)
+
+
+def bill_keys(bills):
+    valid = (bills["FY"].notna() & bills["BILL_AMOUNT"].notna()).to_numpy()
+    keys = fy_amount_keys(
+        bills["FY"].to_numpy("int64", na_value=0),
+        bills["BILL_AMOUNT"].to_numpy("int64", na_value=0)
+    )
+    return np.where(valid, keys, NO_KEY)
+
+
+def merge_sorted(keys, labels, new_keys, new_labels):
+    """
+    Sorted (keys, labels) with the new ones merged in at their sorted
+    place; labels of equal keys stay in load order.
+    """
+    order = np.argsort(new_keys, kind="stable")
+    new_keys, new_labels = new_keys[order], new_labels[order]
+    at = np.searchsorted(keys, new_keys, side="right")
+    return np.insert(keys, at, new_keys), np.insert(labels, at, new_labels)
+
+
+def column(table, name):
+    """A numeric column as a NumPy array: a view of the mapped file, not a copy."""
+    return table[name].combine_chunks().to_numpy()
+
+
+def bill_table(bills):
+    """Cleaned bills (a frame, or an Arrow table of LEDGER_COLUMNS) as an Arrow table to publish."""
+    if isinstance(bills, pd.DataFrame):
+        bills = pa.Table.from_pandas(bills, preserve_index=False)
+    at = bills.schema.get_field_index("HEAD_OF_ACCOUNT")
+    return bills.set_column(at, "HEAD_OF_ACCOUNT", bills["HEAD_OF_ACCOUNT"].cast(HEAD_TYPE))
+
+
+def take_bills(table, labels):
+    """The bills at `labels` (load positions) as a frame labelled by them."""
+    rows = table.select(LEDGER_COLUMNS).take(pa.array(labels, type=pa.int64())).to_pandas()
+    rows.index = labels
+    return rows
+
+
+class Taken:
+    """values[order[i]] as a sequence, for bisect over an Arrow column."""
+
+    def __init__(self, values, order):
+        self.values = values
+        self.order = order
+
+    def __len__(self):
+        return len(self.order)
+
+    def __getitem__(self, i):
+        return self.values[int(self.order[i])].as_py()
+
+
+# ================= PUBLISHED FILES =================
+class LedgerBills(NamedTuple):
+    """
+    One published version of the register, as handed to a job: cheap to
+    pickle, and read from the shared file in the job's own process.
+    """
+    path: str
+    version: str
+
+    def frame(self, fys=None):
+        """
+        The bills as a cleaned frame (labels in load order), copied out of
+        the file. With `fys` only the bills of those financial years are
+        taken, plus undated ones for the invalid-data report: a bill only
+        ever pays invoices of its own year.
+        """
+        table, _ = read_snapshot(self.path)
+        if fys is None:
+            return table.select(LEDGER_COLUMNS).to_pandas()
+        fy = table["FY"]
+        keep = pc.or_(pc.is_in(fy, value_set=pa.array(list(fys), fy.type)), pc.is_null(fy))
+        return take_bills(table, np.flatnonzero(keep.to_numpy(zero_copy_only=False)))
+
+
+def read_snapshot(path):
+    """(table, metadata) of a published file, memory-mapped: pages are read as they are used."""
+    with pa.memory_map(path) as source:
+        table = pa.ipc.open_file(source).read_all()
+    return table, json.loads(table.schema.metadata[b"ledger"])
+
+
+def write_snapshot(directory, bills, index, meta):
+    """Publish the register (`bills`: an Arrow table) as a new file, then point CURRENT at it."""
+    table = bills
+    for name, values in index.items():
+        table = table.append_column(name, pa.array(values))
+    table = table.replace_schema_metadata({
+        **table.schema.metadata,
+        b"ledger": json.dumps(meta).encode()
+    })
+
+    name = f"ledger-{meta['version'][:16]}.arrow"
+    tmp = os.path.join(directory, f".{uuid.uuid4().hex}.tmp")
+    with pa.OSFile(tmp, "wb") as sink:
+        with pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+    os.replace(tmp, os.path.join(directory, name))
+
+    tmp = os.path.join(directory, f".{uuid.uuid4().hex}.tmp")
+    with open(tmp, "w") as f:
+        f.write(name)
+    os.replace(tmp, os.path.join(directory, "CURRENT"))
+    prune(directory, keep=name)
+
+
+def prune(directory, keep):
+    """
+    Drop published files past the newest LEDGER_KEEP, unless a job has
+    them pinned (processes mapping one keep their view).
+    """
+    files = sorted(
+        (entry for entry in os.scandir(directory) if entry.name.startswith("ledger-")),
+        key=lambda entry: entry.stat().st_mtime_ns,
+        reverse=True
+    )
+    for entry in files[LEDGER_KEEP:]:
+        if entry.name == keep:
+            continue
+        try:
+            if fcntl is None:
+                os.remove(entry.path)    # refused while a job holds the file open
+                continue
+            with open(entry.path, "rb") as f:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                os.remove(entry.path)
+        except (BlockingIOError, PermissionError, FileNotFoundError):
+            pass    # pinned (the next publish tries again), or another process removed it
+
+
+def pin(path):
+    """
+    Keep a published file from being pruned until the returned file is
+    closed; None if it is already gone.
+    """
+    try:
+        f = open(path, "rb")
+    except FileNotFoundError:
+        return None
+    if fcntl is not None:
+        fcntl.flock(f, fcntl.LOCK_SH)
+        if os.fstat(f.fileno()).st_nlink == 0:    # removed before the lock was ours
+            f.close()
+            return None
+    return f
+
+
+# ================= LEDGER =================
+class PaoLedger:
+    """
+    This process's view of the published register, and the way to change
+    it: load() and append() publish a new version under a file lock, so
+    server processes never interleave their updates.
+    """
+
+    def __init__(self, directory=LEDGER_DIR):
+        self.directory = directory
+        self.lock = threading.Lock()            # this process's view
+        self.publish_lock = threading.Lock()    # this process's updates (flock covers the others)
+        self.pointer = None    # CURRENT's (inode, mtime) when last read
+        self.path = None
+        self.table = None
+        self.meta = None
+
+    # ---- reading ----
+    def refresh(self):
+        """Map the current version if CURRENT moved since the last call (one stat otherwise)."""
+        try:
+            st = os.stat(os.path.join(self.directory, "CURRENT"))
+        except FileNotFoundError:
+            return
+        pointer = (st.st_ino, st.st_mtime_ns)
+        with self.lock:
+            if pointer == self.pointer:
+                return
+            with open(os.path.join(self.directory, "CURRENT")) as f:
+                path = os.path.join(self.directory, f.read().strip())
+            self.table, self.meta = read_snapshot(path)
+            self.path, self.pointer = path, pointer
+
+    def current(self):
+        self.refresh()
+        with self.lock:
+            return self.path, self.table, self.meta
+
+    def loaded(self):
+        return self.current()[1] is not None
+
+    def bills(self):
+        """
+        The current version for a job, its version (for result-cache keys)
+        and its pin: close that once the job is done.
+        """
+        path = None
+        while True:
+            previous = path
+            path, _, meta = self.current()
+            held = pin(path)
+            if held is not None:
+                return LedgerBills(path, meta["version"]), meta["version"], held
+            if path == previous:
+                raise FileNotFoundError(f"Published ledger file is missing: {path}")
+            # pruned since this process mapped it: CURRENT has moved on
+
+    def find_bill_no(self, bill_no):
+        _, table, _ = self.current()
+        if table is None:
+            return pd.DataFrame(columns=LEDGER_COLUMNS)
+        order = column(table, "BILLNO_BILL")
+        keys = Taken(table["BILLNO"], order)
+        bill_no = str(bill_no).strip()
+        lo = bisect.bisect_left(keys, bill_no)
+        hi = bisect.bisect_right(keys, bill_no, lo)
+        return take_bills(table, order[lo:hi])
+
+    def find_amount(self, fy, amount):
+        """Bills of FY `fy` (its first year) for `amount` paise."""
+        _, table, _ = self.current()
+        if table is None:
+            return pd.DataFrame(columns=LEDGER_COLUMNS)
+        keys = column(table, "FY_AMOUNT_KEY")
+        key = fy_amount_keys([fy], [amount])[0]
+        lo = np.searchsorted(keys, key, "left")
+        hi = np.searchsorted(keys, key, "right")
+        return take_bills(table, column(table, "FY_AMOUNT_BILL")[lo:hi])
+
+    def summary(self):
+        _, table, meta = self.current()
+        if table is None:
+            return {"version": None, "bills": 0, "deltas": 0, "sources": []}
+        return {
+            "version": meta["version"],
+            "bills": table.num_rows,
+            "deltas": len(meta["sources"]) - 1,
+            "sources": meta["sources"]
+        }
+
+    # ---- publishing ----
+    @contextmanager
+    def publishing(self):
+        """Exclusive across server processes and threads while a new version is written."""
+        os.makedirs(self.directory, exist_ok=True)
+        with self.publish_lock, open(os.path.join(self.directory, "lock"), "w") as f:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                self.refresh()
+                yield
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+
+    def start(self, path):
+        """
+        At server start: the published register if it grew from `path`
+        (deltas included), else a fresh load. The first worker loads;
+        the others wait on the lock and find it published.
+        """
+        digest = file_digest(path)
+        with self.publishing():
+            _, table, meta = self.current()
+            if table is None or meta["sources"][0]["digest"] != digest:
+                self._publish(read_bills(path), os.path.basename(path), digest)
+        return self.summary()
+
+    def load(self, path, name=None):
+        """Replace the register with a full PAO export (`name`: the file name to record)."""
+        bills = read_bills(path)
+        digest = file_digest(path)
+        with self.publishing():
+            self._publish(bills, name or os.path.basename(path), digest)
+        return self.summary()
+
+    def append(self, path, name=None):
+        """Append a delta export's bills; raises DeltaAlreadyApplied for a repeat upload."""
+        digest = file_digest(path)
+        bills = read_bills(path)    # parsed before the lock: lookups and other updates go on
+        with self.publishing():
+            _, table, meta = self.current()
+            if any(source["digest"] == digest for source in meta["sources"]):
+                raise DeltaAlreadyApplied("This delta is already in the ledger")
+            self._publish(bills, name or os.path.basename(path), digest, base=(table, meta))
+        return self.summary()
+
+    def _publish(self, bills, name, digest, base=None):
+        """Write `bills` as a new version: on their own, or appended to `base` (table, metadata)."""
+        start = base[0].num_rows if base else 0
+        labels = np.arange(start, start + len(bills), dtype=np.int64)
+        keys = bill_keys(bills)
+
+        if base:
+            table, meta = base
+            keys, key_labels = merge_sorted(
+                column(table, "FY_AMOUNT_KEY"), column(table, "FY_AMOUNT_BILL"), keys, labels
+            )
+            # the published record batches as they are, then the delta's;
+            # each part has categories of its own
+            published = bill_table(table.select(LEDGER_COLUMNS))
+            bills = pa.concat_tables([
+                published, bill_table(bills).cast(published.schema)
+            ]).unify_dictionaries()
+            bill_no_labels = pc.sort_indices(bills["BILLNO"]).to_numpy()    # stable: ties in load order
+            sources, version = meta["sources"], meta["version"]
+        else:
+            order = np.argsort(keys, kind="stable")
+            keys, key_labels = keys[order], labels[order]
+            bill_no_labels = labels[np.argsort(bills["BILLNO"].to_numpy(object), kind="stable")]
+            bills = bill_table(bills)
+            sources, version = [], ""
+
+        sources = sources + [{
+            "file": name,
+            "digest": digest,
+            "rows": len(labels),
+            "loaded": time.time()
+        }]
+        # a load or delta changes every result: cached ones are keyed on this
+        version = hashlib.sha256((version + digest).encode()).hexdigest()
+
+        write_snapshot(
+            self.directory,
+            bills,
+            {"FY_AMOUNT_KEY": keys, "FY_AMOUNT_BILL": key_labels, "BILLNO_BILL": bill_no_labels},
+            {"version": version, "sources": sources}
+        )
+        self.refresh()
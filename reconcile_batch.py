@@ -0,0 +1,142 @@
+import os
+import sys
+import time
+
+from cache import cached_frame
+from reconcile_core import (
+    ReconcileConfig, batch_reports, batch_totals, clean_invoices, clean_payments,
+    file_reports, invoice_columns, match_batch, normalize_columns, payment_columns
+)
+from report_writer import write_reports
+from run_stats import run_stats, write_run_stats
+from utils import read_columns, read_header, StageTimer
+
+# ================= CONFIG =================
+# Several GeM exports against one PAO export: the PAO file is parsed and
+# cleaned once, then each GeM file is matched in the order given against
+# the bills the files before it left unpaid.
+#
+#   python reconcile_batch.py data/gem_april.xlsx data/gem_may.xlsx ...
+INVOICE_FILES = sys.argv[1:] or [
+    path for path in os.environ.get("INVOICE_FILES", "data/gem_reports_bulk_payment.xlsx").split(os.pathsep)
+    if path
+]
+PAYMENT_FILE = os.environ.get("PAYMENT_FILE", "data/ContingencyBillsPassedbyPAO.xlsx")   # can be .csv or .xlsx
+OUTPUT_DIR = os.path.join("output", "batch")    # consolidated reports; one sub-folder per GeM file
+OUTPUT_FORMAT = "xlsx"    # or "csv" / "parquet" (one file per report)
+
+MAX_COMBINATION_SIZE = 4
+AMOUNT_TOLERANCE = 0    # paise -- bill and invoices must agree to the paisa
+MATCH_WORKERS = os.cpu_count() or 1    # processes for the per-FY bill loop (1 = serial)
+
+# Search budget, as in reconcile_report_all.py; the run deadline covers
+# the whole batch
+SEARCH_MAX_COMBINATIONS = 1_000_000    # per bill
+SEARCH_MAX_SECONDS = 10                # per bill
+RUN_MAX_SECONDS = None                 # whole run
+
+INVOICE_PASSTHROUGH_COLUMNS = None
+PAYMENT_PASSTHROUGH_COLUMNS = None
+
+# Same cleaning as reconcile_report_all.py, so its parse cache is shared
+SCRIPT = "reconcile_report_all.py"
+
+os.makedirs(OUTPUT_DIR, exist_ok=True)
+
+timer = StageTimer()
+run_deadline = None if RUN_MAX_SECONDS is None else time.time() + RUN_MAX_SECONDS
+
+config = ReconcileConfig(
+    max_combination_size=MAX_COMBINATION_SIZE,
+    amount_tolerance=AMOUNT_TOLERANCE,
+    workers=MATCH_WORKERS,
+    search_max_combinations=SEARCH_MAX_COMBINATIONS,
+    search_max_seconds=SEARCH_MAX_SECONDS
+)
+
+
+def file_name(path):
+    return os.path.splitext(os.path.basename(path))[0]
+
+
+if len({file_name(path) for path in INVOICE_FILES}) < len(INVOICE_FILES):
+    raise SystemExit("❌ GeM file names must differ: each one's reports go to a folder of that name")
+
+# ================= READ HEADERS =================
+# Every header first: a missing column fails the batch before any parse
+invoice_headers = {path: normalize_columns(read_header(path)) for path in INVOICE_FILES}
+invoice_cols = {path: invoice_columns(header) for path, header in invoice_headers.items()}
+payment_header = normalize_columns(read_header(PAYMENT_FILE))
+payment_cols = payment_columns(payment_header)
+
+
+# ================= LOAD & CLEAN (CACHED) =================
+def load_payments():
+    df = read_columns(
+        PAYMENT_FILE,
+        payment_header,
+        [c for c in payment_cols.values() if c is not None],
+        PAYMENT_PASSTHROUGH_COLUMNS
+    )
+    timer.lap("load")
+    df = clean_payments(df, payment_cols)
+    timer.lap("normalize")
+    return df
+
+
+def load_invoices(path):
+    df = read_columns(
+        path,
+        invoice_headers[path],
+        list(invoice_cols[path].values()),
+        INVOICE_PASSTHROUGH_COLUMNS
+    )
+    timer.lap("load")
+    df = clean_invoices(df, invoice_cols[path])
+    timer.lap("normalize")
+    return df
+
+
+def invoice_files():
+    """Each GeM file, parsed only when its turn comes."""
+    for path in INVOICE_FILES:
+        df = cached_frame(
+            path,
+            [SCRIPT, "invoices", *invoice_cols[path].values(), INVOICE_PASSTHROUGH_COLUMNS],
+            lambda: load_invoices(path)
+        )
+        timer.lap("load")
+        yield file_name(path), df
+
+
+# The PAO file: parsed once for the whole batch
+payment_df = cached_frame(
+    PAYMENT_FILE,
+    [SCRIPT, "payments", *payment_cols.values(), PAYMENT_PASSTHROUGH_COLUMNS],
+    load_payments
+)
+timer.lap("load")
+
+# ================= MATCHING ENGINE =================
+# One file at a time; its reports are written before the next is read
+results = {}
+for name, result in match_batch(invoice_files(), payment_df, config, timer, deadline=run_deadline):
+    file_dir = os.path.join(OUTPUT_DIR, name)
+    os.makedirs(file_dir, exist_ok=True)
+    write_reports(file_reports(result), OUTPUT_FORMAT, file_dir)
+    timer.lap("write")
+    results[name] = result
+    print(f"✔ {name}: {len(result.matched)} invoices paid by {len(result.paid_bills)} bills")
+
+# ================= OUTPUT FILES =================
+write_reports(batch_reports(results), OUTPUT_FORMAT, OUTPUT_DIR)
+timer.lap("write")
+
+modes, searches = batch_totals(results)
+write_run_stats(run_stats(timer.laps, modes, searches), OUTPUT_DIR)
+
+print("✅ Batch reconciliation complete")
+print(f"✔ GeM files           : {len(results)}")
+print(f"✔ Matched groups      : {sum(len(r.paid_bills) for r in results.values())}")
+print(f"⚠ Unmatched payments : {modes['UNMATCHED']}")
+timer.report()
@@ -1,28 +1,411 @@
+import time
+from dataclasses import dataclass
+from typing import NamedTuple, Optional
+
+import numpy as np
 import pandas as pd
 
+from rules import MatchState, bulk_exact_match, match_bills, with_group_ids
+from run_stats import mode_counts, search_frame
+from utils import financial_year, safe_to_date, to_paise, to_rupees
+
+# ================= ENGINE =================
+# The GeM bulk-payment / PAO contingency-bill reconciliation behind
+# reconcile_report_all.py, reconcile_contigency_report.py and the web
+# app, importable without side effects: nothing is read, written or
+# printed until reconcile() is called.
+#
+#   result = reconcile(invoice_df, payment_df, ReconcileConfig(max_combination_size=4))
+#   result.matched, result.unpaid, result.unmatched, result.payment_map
+#
+# reconcile_batch() takes several GeM exports against one PAO export.
+
+ENGINE_VERSION = 1    # bump when matching rules or report layout change; keys cached results
+
+
+@dataclass(frozen=True)
+class ReconcileConfig:
+    max_combination_size: int = 4
+    amount_tolerance: int = 0                         # paise
+    workers: int = 1                                  # processes for the per-FY bill loop
+    search_max_combinations: Optional[int] = 1_000_000    # per bill; None = no limit
+    # Time limits make a result depend on the machine's load, so none by
+    # default: results are cached by input (jobs.upload_key)
+    search_max_seconds: Optional[float] = None            # per bill; None = no limit
+    run_max_seconds: Optional[float] = None               # whole reconcile() call
+
+
+class ReconcileResult(NamedTuple):
+    matched: pd.DataFrame        # paid invoices, by match group (MATCH_GROUP_ID numbers)
+    unpaid: pd.DataFrame         # invoices no bill took
+    unmatched: pd.DataFrame      # bills left for manual review, with a reason
+    payment_map: pd.DataFrame    # one row per matched bill and its group
+    paid_bills: np.ndarray       # labels of the matched bills
+    searches: pd.DataFrame       # per-bill search counters (run_stats.search_frame)
+    modes: dict                  # bills per match mode (run_stats.mode_counts)
+
+    def reports(self):
+        """The reports as {sheet: frame}, in workbook order, group ids formatted."""
+        return {
+            "matched_invoices": with_group_ids(self.matched),
+            "unpaid_invoices": with_group_ids(self.unpaid),
+            "unmatched_payments": self.unmatched,
+            "payment_invoice_map": with_group_ids(self.payment_map),
+            "RUN_STATS": self.searches.drop(columns="BILL")
+        }
+
+
+class MissingColumnError(ValueError):
+    """An export lacks a column the engine needs."""
+
+
+# ================= COLUMNS =================
+INVOICE_COLUMNS = {
+    "PRC_DATE": ["PRC DATE", "PRC_DATE"],
+    "CRAC_AMOUNT": ["CRAC AMOUNT", "CRAC_AMOUNT"],
+    "PAID_AMOUNT": ["PAID AMOUNT", "PAID_AMOUNT"]
+}
+PAYMENT_COLUMNS = {
+    "BILLNO": ["BILL NO.", "BILLNO", "BILL NO", "BILLNO."],
+    "BILL_AMOUNT": ["BILLAMOUNT", "BILL AMOUNT"],
+    "BILL_DATE": [
+        "BILLDATE",
+        "BILL DATE",
+        "PAO PASS DATE",
+        "PAO_PASS_DATE",
+        "PAO PASSING DATE",
+        "DDO APPROVAL DATE"
+    ],
+    "HEAD_OF_ACCOUNT": ["HEAD OF ACCCOUNT", "HEAD OF ACCOUNT"]
+}
+# Reported when the export has it, left blank otherwise
+OPTIONAL_PAYMENT_FIELDS = {"HEAD_OF_ACCOUNT"}
+
+
+# "cleanup crew" for pandas DataFrame column names.
+def normalize_columns(df):
+    df.columns = (
+        df.columns.astype(str)
+        .str.strip()
+        .str.replace(r"\s+", " ", regex=True)  #"one or more whitespace characters" and collapses them into a single space
+        .str.replace("\n", " ")
+        .str.upper()
+    )
+    return df
+
+
+def find_any(df, possible_names):
+    for name in possible_names:
+        if name in df.columns:
+            return name
+    raise MissingColumnError(
+        f"None of these columns found: {possible_names} (available: {list(df.columns)})"
+    )
+
+
+def invoice_columns(header):
+    """Export column for each invoice field, from a normalized header."""
+    return {field: find_any(header, names) for field, names in INVOICE_COLUMNS.items()}
+
+
+def payment_columns(header):
+    """Export column for each bill field (None for a missing optional one), from a normalized header."""
+    columns = {}
+    for field, names in PAYMENT_COLUMNS.items():
+        try:
+            columns[field] = find_any(header, names)
+        except MissingColumnError:
+            if field not in OPTIONAL_PAYMENT_FIELDS:
+                raise
+            columns[field] = None
+    return columns
+
+
+# ================= CLEAN =================
+def safe_to_amount(series):
+    # ---- NEW: handle case where user accidentally passes a string ----
+    if isinstance(series, str):
+        series = pd.Series([series])
+
+    # rupees in, integer paise out
+    return to_paise(
+        series.astype(str)
+        .str.replace(",", "", regex=False)
+        .str.strip()
+        .replace("", "0")
+        .astype(float)
+    )
+
+
+def clean_invoices(df, columns):
+    """Typed invoice fields (dates, paise amounts, FY) next to the export's columns."""
+    df["PRC_DATE"] = safe_to_date(df[columns["PRC_DATE"]])
+    df["CRAC_AMOUNT"] = safe_to_amount(df[columns["CRAC_AMOUNT"]])
+    df["PAID_AMOUNT"] = safe_to_amount(df[columns["PAID_AMOUNT"]])
+
+    df["FY"] = financial_year(df["PRC_DATE"])
+    return df
+
+
+def clean_payments(df, columns):
+    """Typed bill fields (bill number, paise amount, date, FY) next to the export's columns."""
+    df["BILLNO"] = df[columns["BILLNO"]].astype(str).str.strip()
+    df["BILL_AMOUNT"] = safe_to_amount(df[columns["BILL_AMOUNT"]])
+    df["BILL_DATE"] = safe_to_date(df[columns["BILL_DATE"]])
+    if columns["HEAD_OF_ACCOUNT"]:
+        df["HEAD_OF_ACCOUNT"] = df[columns["HEAD_OF_ACCOUNT"]].astype("category")
+    else:
+        df["HEAD_OF_ACCOUNT"] = pd.Categorical.from_codes(np.full(len(df), -1), [])
+
+    df["FY"] = financial_year(df["BILL_DATE"])
+    return df
+
+
+def is_blacklisted_bill(bill_no):
+    if pd.isna(bill_no):
+        return False
+    bill_no = str(bill_no).upper().strip()
+    return bill_no.startswith("ACB") or bill_no.startswith("DCB")
+
+
+# ================= RECONCILE =================
+def reconcile(invoices: pd.DataFrame, payments: pd.DataFrame,
+              config: ReconcileConfig = ReconcileConfig(), timer=None) -> ReconcileResult:
+    """
+    Reconcile a GeM bulk-payment export against a PAO contingency-bill
+    export, both as read (any of the accepted header spellings). Raises
+    MissingColumnError if either lacks a column. The input frames are
+    not modified.
+    """
+    invoices = normalize_columns(invoices.copy(deep=False))
+    payments = normalize_columns(payments.copy(deep=False))
+    invoice_df = clean_invoices(invoices, invoice_columns(invoices))
+    payment_df = clean_payments(payments, payment_columns(payments))
+    return match(invoice_df, payment_df, config, timer)
+
+
+def match(invoice_df: pd.DataFrame, payment_df: pd.DataFrame,
+          config: ReconcileConfig = ReconcileConfig(), timer=None,
+          deadline: Optional[float] = None, first_group: int = 1) -> ReconcileResult:
+    """
+    Reconcile cleaned frames (clean_invoices / clean_payments). `timer`
+    (utils.StageTimer), if given, gets the normalize, exact and
+    combination laps; `deadline` (time.time()) overrides the one
+    config.run_max_seconds sets from now. Match groups are numbered
+    from `first_group`.
+    """
+    lap = timer.lap if timer is not None else (lambda stage: None)
+    if deadline is None and config.run_max_seconds is not None:
+        deadline = time.time() + config.run_max_seconds
+    invoice_df = invoice_df.copy(deep=False)
+
+    # ================= INITIAL FLAGS =================
+    # Per-invoice match results by row position; written back once at the
+    # end (and once now, so the empty result columns are in place)
+    state = MatchState(len(invoice_df), first_group)
+    state.write_back(invoice_df)
+
+    lap("normalize")
+
+    # ================= PRIORITY 1 (BULK): EXACT MATCH =================
+    # All one-to-one matches in a single join (same FY, amounts within
+    # the tolerance); the engine below only sees the bills left over.
+    exact_pairs = bulk_exact_match(
+        invoice_df,
+        payment_df[
+            ~payment_df["BILLNO"].apply(is_blacklisted_bill) &
+            payment_df["BILL_AMOUNT"].notna() &
+            payment_df["BILL_DATE"].notna()
+        ],
+        "BILL_AMOUNT",
+        tolerance=config.amount_tolerance
+    )
+    exact_bills = payment_df.loc[exact_pairs["BILL"]]
+
+    state.mark(
+        exact_pairs["INVOICE"].to_numpy(),
+        exact_pairs["BILL"].to_numpy(),
+        "AUTO_SINGLE",
+        "HIGH",
+        exact_bills["BILL_DATE"].to_numpy(),
+        exact_bills["BILLNO"].to_numpy()
+    )
+
+    lap("exact")
+
+    # ================= MATCHING ENGINE (PER FY, IN PARALLEL) =================
+    # Bills left over are matched FY by FY; results come back in bill order
+    remaining = payment_df.drop(exact_pairs["BILL"])
+    blacklisted = remaining["BILLNO"].apply(is_blacklisted_bill)
+    invalid = remaining["BILL_AMOUNT"].isna() | remaining["BILL_DATE"].isna()
+
+    # ========== PRIORITY 1: EXACT MATCH / PRIORITY 2: COMBINATION MATCH ==========
+    # Same Financial Year only
+    matched, unmatched, searched = match_bills(
+        invoice_df,
+        remaining[~blacklisted & ~invalid],
+        "BILL_AMOUNT",
+        "BILL_DATE",
+        state.paid,
+        config.max_combination_size,
+        tolerance=config.amount_tolerance,
+        workers=config.workers,
+        max_combinations=config.search_max_combinations,
+        bill_seconds=config.search_max_seconds,
+        deadline=deadline
+    )
+
+    for p_idx, positions, match_type in matched:
+        pay = payment_df.loc[p_idx]
+        state.mark(positions, p_idx, match_type,
+                   "HIGH" if match_type == "AUTO_SINGLE" else "MEDIUM",
+                   pay["BILL_DATE"], pay["BILLNO"])
+
+    # Unmatched bills, in processing order
+    reasons = {
+        p_idx: reason if reason == "SEARCH_BUDGET_EXCEEDED" else "NO_MATCH_IN_SAME_FINANCIAL_YEAR"
+        for p_idx, reason in unmatched
+    }
+    reasons.update({p_idx: "INVALID_PAYMENT_DATA" for p_idx in remaining.index[invalid]})
+    reasons.update({p_idx: "IGNORED_ACB_DCB_BILL" for p_idx in remaining.index[blacklisted]})
+    unmatched_payments = pd.DataFrame([
+        {
+            "BILLNO": payment_df.at[p_idx, "BILLNO"],
+            "REASON": reason,
+            "HEAD_OF_ACCOUNT": payment_df.at[p_idx, "HEAD_OF_ACCOUNT"]
+        }
+        for p_idx, reason in sorted(reasons.items())
+    ])
+
+    # Candidates and combinations per searched bill, worst first
+    searches = search_frame(searched, payment_df["BILLNO"])
+
+    lap("combination")
+
+    # ================= WRITE BACK (GROUP IDS IN PROCESSING ORDER) =================
+    state.write_back(invoice_df)
+
+    matched_bills = state.matched_bills()
+    matched_summary = pd.DataFrame({
+        "MATCH_GROUP_ID": matched_bills["MATCH_GROUP_ID"].to_numpy(),
+        "BILLNO": payment_df.loc[matched_bills["BILL"], "BILLNO"].to_numpy(),
+        "MATCH_MODE": matched_bills["MATCH_TYPE"].map(
+            {"AUTO_SINGLE": "EXACT", "AUTO_COMBINATION": "COMBINATION"}
+        ).to_numpy(),
+        "HEAD_OF_ACCOUNT": payment_df.loc[matched_bills["BILL"], "HEAD_OF_ACCOUNT"].to_numpy()
+    })
+
+    # Amounts are held in paise; reports show rupees
+    invoice_df["CRAC_AMOUNT"] = to_rupees(invoice_df["CRAC_AMOUNT"])
+    invoice_df["PAID_AMOUNT"] = to_rupees(invoice_df["PAID_AMOUNT"])
+
+    return ReconcileResult(
+        matched=invoice_df[invoice_df["PAID_FLAG"]].sort_values("MATCH_GROUP_ID", kind="stable"),
+        unpaid=invoice_df[~invoice_df["PAID_FLAG"]],
+        unmatched=unmatched_payments,
+        payment_map=matched_summary,
+        paid_bills=matched_bills["BILL"].to_numpy(),
+        searches=searches,
+        modes=mode_counts(len(exact_pairs), searches, len(unmatched_payments))
+    )
+
+
+# ================= BATCH =================
+# Several GeM exports (one per month, say) against the same PAO export:
+# the bills are read and cleaned once, and each file is matched in turn
+# against the bills the files before it left unpaid -- a bill pays
+# invoices in one file at most. Group numbers run on across the files.
+def reconcile_batch(invoices: dict, payments: pd.DataFrame,
+                    config: ReconcileConfig = ReconcileConfig(), timer=None) -> dict:
+    """
+    reconcile() for {name: GeM export as read}, in order, against one
+    PAO export; returns {name: ReconcileResult}. Raises
+    MissingColumnError if any export lacks a column.
+    """
+    payments = normalize_columns(payments.copy(deep=False))
+    payment_df = clean_payments(payments, payment_columns(payments))
+
+    def cleaned():
+        for name, df in invoices.items():
+            df = normalize_columns(df.copy(deep=False))
+            yield name, clean_invoices(df, invoice_columns(df))
+
+    return dict(match_batch(cleaned(), payment_df, config, timer))
+
+
+def match_batch(invoice_dfs, payment_df: pd.DataFrame,
+                config: ReconcileConfig = ReconcileConfig(), timer=None,
+                deadline: Optional[float] = None):
+    """
+    match() for each (name, cleaned invoice frame) of `invoice_dfs`, in
+    order, against the bills still unpaid; yields (name, ReconcileResult)
+    as each file is done, so files can be loaded one at a time.
+    """
+    if deadline is None and config.run_max_seconds is not None:
+        deadline = time.time() + config.run_max_seconds
+    first_group = 1
+    for name, invoice_df in invoice_dfs:
+        result = match(invoice_df, payment_df, config, timer, deadline, first_group)
+        payment_df = payment_df.drop(result.paid_bills)
+        first_group += len(result.paid_bills)
+        yield name, result
+
 
-def reconcile(invoice_df: pd.DataFrame, payment_df: pd.DataFrame):
-    # ---- NORMALIZE COLUMNS ----
-    invoice_df.columns = [c.strip().upper() for c in invoice_df.columns]
-    payment_df.columns = [c.strip().upper() for c in payment_df.columns]
+def file_reports(result: ReconcileResult):
+    """
+    One file's reports in a batch: its invoices and the bills it matched
+    (bills left unpaid are reported once, in batch_reports).
+    """
+    reports = result.reports()
+    del reports["unmatched_payments"]
+    return reports
 
-    # ---- FIND AMOUNT COLUMN ----
-    amount_col = None
-    for c in ["PAID AMOUNT", "CRAC AMOUNT", "INVOICE AMOUNT"]:
-        if c in invoice_df.columns:
-            amount_col = c
-            break
 
-    if amount_col is None:
-        raise ValueError("No invoice amount column found")
+def batch_reports(results: dict):
+    """
+    The whole batch as {sheet: frame}: every file's rows tagged with
+    SOURCE_FILE, the bills no file paid, and a per-file summary.
+    """
+    per_file = {name: file_reports(result) for name, result in results.items()}
+    last = results[list(results)[-1]]
 
-    # ---- SIMPLE MATCH LOGIC ----
-    max_payment = payment_df["BILLAMOUNT"].max()
+    def combined(sheet):
+        df = pd.concat(
+            [reports[sheet].assign(SOURCE_FILE=name) for name, reports in per_file.items()],
+            ignore_index=True
+        )
+        return df[["SOURCE_FILE", *df.columns.drop("SOURCE_FILE")]]
 
-    matched_df = invoice_df[invoice_df[amount_col] <= max_payment].copy()
-    unmatched_df = invoice_df[invoice_df[amount_col] > max_payment].copy()
+    summary = pd.DataFrame([
+        {
+            "SOURCE_FILE": name,
+            "INVOICES": len(result.matched) + len(result.unpaid),
+            "PAID_INVOICES": len(result.matched),
+            "MATCHED_BILLS": len(result.paid_bills),
+            **{f"{mode}_BILLS": n for mode, n in result.modes.items() if mode != "UNMATCHED"}
+        }
+        for name, result in results.items()
+    ])
+    return {
+        "matched_invoices": combined("matched_invoices"),
+        "unpaid_invoices": combined("unpaid_invoices"),
+        # the last file was matched against every bill still unpaid
+        "unmatched_payments": last.unmatched,
+        "payment_invoice_map": combined("payment_invoice_map"),
+        "batch_summary": summary,
+        "RUN_STATS": combined("RUN_STATS")
+    }
 
-    matched_df["MATCH_TYPE"] = "AUTO_SIMPLE"
-    unmatched_df["MATCH_TYPE"] = "UNMATCHED"
 
-    return matched_df, unmatched_df
+def batch_totals(results: dict):
+    """
+    (modes, searches) over the batch, for run_stats: matches summed over
+    the files, UNMATCHED and BUDGET_EXCEEDED the bills no file paid, and
+    every file's searches, worst first.
+    """
+    last = results[list(results)[-1]].modes
+    modes = {mode: sum(r.modes[mode] for r in results.values()) for mode in last}
+    modes["UNMATCHED"] = last["UNMATCHED"]
+    modes["BUDGET_EXCEEDED"] = last["BUDGET_EXCEEDED"]
+    searches = pd.concat([r.searches for r in results.values()], ignore_index=True)
+    return modes, searches.sort_values(["COMBINATIONS", "SECONDS"], ascending=False, kind="stable")
@@ -1,271 +1,121 @@
-import pandas as pd
-from itertools import combinations
 import os
+import time
+
+from cache import cached_frame
+from reconcile_core import (
+    ReconcileConfig, clean_invoices, clean_payments, invoice_columns, match,
+    normalize_columns, payment_columns
+)
+from report_writer import write_reports
+from run_stats import run_stats, write_run_stats
+from utils import read_columns, read_header, StageTimer
 
 # ================= CONFIG =================
-INVOICE_FILE = "data/gem_reports_bulk_payment.xlsx"      # can be .csv or .xlsx
-PAYMENT_FILE = "data/ContingencyBillsPassedbyPAO.xlsx"   # can be .csv or .xlsx
+INVOICE_FILE = os.environ.get("INVOICE_FILE", "data/gem_reports_bulk_payment.xlsx")    # can be .csv or .xlsx
+PAYMENT_FILE = os.environ.get("PAYMENT_FILE", "data/ContingencyBillsPassedbyPAO.xlsx")   # can be .csv or .xlsx
 OUTPUT_DIR = "output"
+OUTPUT_FORMAT = "xlsx"    # or "csv" / "parquet" (one file per report)
 
 MAX_COMBINATION_SIZE = 4
-AMOUNT_TOLERANCE = 0.01
-
-os.makedirs(OUTPUT_DIR, exist_ok=True)    # no error if dir exist   xist_ok=True
-
-# ================= HELPERS =================
-def read_file(path):
-    if path.lower().endswith(".csv"):
-        return pd.read_csv(path, encoding="utf-8-sig")
-    elif path.lower().endswith((".xls", ".xlsx")):
-        return pd.read_excel(path)
-    else:
-        raise ValueError(f"Unsupported file format: {path}")
-
-# "cleanup crew" for pandas DataFrame column names.
-def normalize_columns(df):
-    df.columns = (
-        df.columns.astype(str)
-        .str.strip()
-        .str.replace(r"\s+", " ", regex=True)  #"one or more whitespace characters" and collapses them into a single space
-        .str.replace("\n", " ")
-        .str.upper()
-    )
-    return df
-
+AMOUNT_TOLERANCE = 0    # paise -- bill and invoices must agree to the paisa
+MATCH_WORKERS = os.cpu_count() or 1    # processes for the per-FY bill loop (1 = serial)
 
-def find_any(df, possible_names):
-    for name in possible_names:
-        if name in df.columns:
-            print(f"✔ Using column: {name}")
-            return name
-    print("Available columns:", list(df.columns))
-    raise KeyError(f"None of these columns found: {possible_names}")
+# Search budget: a bill whose combination search runs past it is left for
+# manual review as SEARCH_BUDGET_EXCEEDED (None = no limit). Once the run
+# deadline passes, the remaining bills only get the exact match.
+SEARCH_MAX_COMBINATIONS = 1_000_000    # per bill
+SEARCH_MAX_SECONDS = 10                # per bill
+RUN_MAX_SECONDS = None                 # whole run
 
-def safe_to_date(series):
-    return pd.to_datetime(series, errors="coerce", dayfirst=True)
-
-def safe_to_amount(series):
-    # ---- NEW: handle case where user accidentally passes a string ----
-    if isinstance(series, str):
-        series = pd.Series([series])
-
-    return (
-        series.astype(str)
-        .str.replace(",", "", regex=False)
-        .str.strip()
-        .replace("", "0")
-        .astype(float)
-    )
+# Columns carried into the reports besides the ones matching needs;
+# None keeps every column of the export
+INVOICE_PASSTHROUGH_COLUMNS = None
+PAYMENT_PASSTHROUGH_COLUMNS = None
 
-def financial_year(date):
-    if pd.isna(date):
-        return None
-    return date.year if date.month >= 4 else date.year - 1
+# Parsed-input cache entries are per script: each cleans columns its own way
+SCRIPT = os.path.basename(__file__)
 
-def is_blacklisted_bill(bill_no):
-    if pd.isna(bill_no):
-        return False
-    bill_no = str(bill_no).upper().strip()
-    return bill_no.startswith("ACB") or bill_no.startswith("DCB")
+os.makedirs(OUTPUT_DIR, exist_ok=True)    # no error if dir exist   xist_ok=True
 
+# Per-stage wall time (load, normalize, exact, combination, write)
+timer = StageTimer()
+run_deadline = None if RUN_MAX_SECONDS is None else time.time() + RUN_MAX_SECONDS
+
+# The engine itself lives in reconcile_core (shared with the web app)
+config = ReconcileConfig(
+    max_combination_size=MAX_COMBINATION_SIZE,
+    amount_tolerance=AMOUNT_TOLERANCE,
+    workers=MATCH_WORKERS,
+    search_max_combinations=SEARCH_MAX_COMBINATIONS,
+    search_max_seconds=SEARCH_MAX_SECONDS
+)
 
-# ================= LOAD FILES =================
-invoice_df = normalize_columns(read_file(INVOICE_FILE))
-payment_df = normalize_columns(read_file(PAYMENT_FILE))
+# ================= READ HEADERS =================
+# Header rows only: columns are resolved, and missing ones reported,
+# before any data is parsed
+invoice_header = normalize_columns(read_header(INVOICE_FILE))
+payment_header = normalize_columns(read_header(PAYMENT_FILE))
 
 # ================= MAP REQUIRED COLUMNS =================
-# ---- Invoice (GEM Bulk Payment) ----
-PRC_DATE_COL = find_any(invoice_df, ["PRC DATE", "PRC_DATE"])
-CRAC_AMOUNT_COL = find_any(invoice_df, ["CRAC AMOUNT", "CRAC_AMOUNT"])
-PAID_AMOUNT_COL = find_any(invoice_df, ["PAID AMOUNT", "PAID_AMOUNT"])
-
-invoice_df["PRC_DATE"] = safe_to_date(invoice_df[PRC_DATE_COL])
-invoice_df["CRAC_AMOUNT"] = safe_to_amount(invoice_df[CRAC_AMOUNT_COL])
-invoice_df["PAID_AMOUNT"] = safe_to_amount(invoice_df[PAID_AMOUNT_COL])
-
-invoice_df["FY"] = invoice_df["PRC_DATE"].apply(financial_year)
-
-# ---- Payment (PAO Bills) ----
-BILL_NO_COL = find_any(
-    payment_df,
-    ["BILL NO.", "BILLNO", "BILL NO", "BILLNO."]
-)
+# ---- Invoice (GEM Bulk Payment) / Payment (PAO Bills) ----
+invoice_cols = invoice_columns(invoice_header)
+payment_cols = payment_columns(payment_header)
+for name in [*invoice_cols.values(), *payment_cols.values()]:
+    if name is not None:
+        print(f"✔ Using column: {name}")
+
+# ================= LOAD & CLEAN (CACHED) =================
+# Typed frames are cached under the file's content hash and the column
+# mapping, so repeat runs on the same exports skip the Excel parse
+def load_invoices():
+    df = read_columns(
+        INVOICE_FILE,
+        invoice_header,
+        list(invoice_cols.values()),
+        INVOICE_PASSTHROUGH_COLUMNS
+    )
+    timer.lap("load")
+    df = clean_invoices(df, invoice_cols)
+    timer.lap("normalize")
+    return df
 
-BILL_AMOUNT_COL = find_any(
-    payment_df,
-    ["BILLAMOUNT", "BILL AMOUNT"]
-)
+def load_payments():
+    df = read_columns(
+        PAYMENT_FILE,
+        payment_header,
+        [c for c in payment_cols.values() if c is not None],
+        PAYMENT_PASSTHROUGH_COLUMNS
+    )
+    timer.lap("load")
+    df = clean_payments(df, payment_cols)
+    timer.lap("normalize")
+    return df
 
-BILL_DATE_COL = find_any(
-    payment_df,
-    [
-        "BILLDATE",
-        "BILL DATE",
-        "PAO PASS DATE",
-        "PAO_PASS_DATE",
-        "PAO PASSING DATE",
-        "DDO APPROVAL DATE"
-    ]
+invoice_df = cached_frame(
+    INVOICE_FILE,
+    [SCRIPT, "invoices", *invoice_cols.values(), INVOICE_PASSTHROUGH_COLUMNS],
+    load_invoices
 )
-
-HEAD_OF_ACCOUNT_COL = find_any(
-    payment_df,
-    ["HEAD OF ACCCOUNT", "HEAD OF ACCOUNT"]
+payment_df = cached_frame(
+    PAYMENT_FILE,
+    [SCRIPT, "payments", *payment_cols.values(), PAYMENT_PASSTHROUGH_COLUMNS],
+    load_payments
 )
-
-payment_df["BILLNO"] = payment_df[BILL_NO_COL].astype(str).str.strip()
-payment_df["BILL_AMOUNT"] = safe_to_amount(payment_df[BILL_AMOUNT_COL])
-payment_df["BILL_DATE"] = safe_to_date(payment_df[BILL_DATE_COL])
-payment_df["HEAD_OF_ACCOUNT"] = payment_df[HEAD_OF_ACCOUNT_COL]
-
-payment_df["FY"] = payment_df["BILL_DATE"].apply(financial_year)
-
-# ================= INITIAL FLAGS =================
-invoice_df["PAID_FLAG"] = False
-invoice_df["MATCH_GROUP_ID"] = ""
-invoice_df["MATCH_TYPE"] = ""
-invoice_df["CONFIDENCE"] = ""
-invoice_df["PAO_PASS_DATE"] = pd.NaT
-invoice_df["BILLNO"] = ""
-invoice_df["REJECTION_REASON"] = ""
-
-matched_summary = []
-unmatched_payments = []
-group_counter = 1
+timer.lap("load")
 
 # ================= MATCHING ENGINE =================
-for _, pay in payment_df.iterrows():
-
-    bill_no = pay["BILLNO"]
-    bill_amt = pay["BILL_AMOUNT"]
-    pay_date = pay["BILL_DATE"]
-    pay_fy = pay["FY"]
-    head_of_account = pay["HEAD_OF_ACCOUNT"]
-
-    # ---- Ignore ACB / DCB bills ----
-    if is_blacklisted_bill(bill_no):
-        unmatched_payments.append({
-            "BILLNO": bill_no,
-            "REASON": "IGNORED_ACB_DCB_BILL",
-            "HEAD_OF_ACCOUNT": head_of_account
-        })
-        continue
-
-    if pd.isna(bill_amt) or pd.isna(pay_date):
-        unmatched_payments.append({
-            "BILLNO": bill_no,
-            "REASON": "INVALID_PAYMENT_DATA",
-            "HEAD_OF_ACCOUNT": head_of_account
-        })
-        continue
-
-    # Same Financial Year only
-    eligible = invoice_df[
-        (~invoice_df["PAID_FLAG"]) &
-        (invoice_df["FY"] == pay_fy)
-    ]
-
-    # ========== PRIORITY 1: EXACT MATCH ==========
-    exact = eligible[
-        (eligible["CRAC_AMOUNT"] - bill_amt).abs() < AMOUNT_TOLERANCE
-    ]
-
-    if not exact.empty:
-        idx = exact.index[0]
-        gid = f"MG{group_counter:05d}"
-        group_counter += 1
-
-        invoice_df.loc[idx, [
-            "PAID_FLAG",
-            "MATCH_GROUP_ID",
-            "MATCH_TYPE",
-            "CONFIDENCE",
-            "PAO_PASS_DATE",
-            "BILLNO"
-        ]] = [
-            True,
-            gid,
-            "AUTO_SINGLE",
-            "HIGH",
-            pay_date,
-            bill_no
-        ]
-
-        matched_summary.append({
-            "MATCH_GROUP_ID": gid,
-            "BILLNO": bill_no,
-            "MATCH_MODE": "EXACT",
-            "HEAD_OF_ACCOUNT": head_of_account
-        })
-        continue
-
-    # ========== PRIORITY 2: COMBINATION MATCH ==========
-    found = False
-    candidates = eligible.to_dict("records")
-
-    for r in range(2, MAX_COMBINATION_SIZE + 1):
-        for combo in combinations(candidates, r):
-            total = sum(x["CRAC_AMOUNT"] for x in combo)
-
-            if abs(total - bill_amt) < AMOUNT_TOLERANCE:
-                gid = f"MG{group_counter:05d}"
-                group_counter += 1
-
-                for x in combo:
-                    idx = invoice_df.index[
-                        (invoice_df["CRAC_AMOUNT"] == x["CRAC_AMOUNT"]) &
-                        (invoice_df["PRC_DATE"] == x["PRC_DATE"])
-                    ][0]
-
-                    invoice_df.loc[idx, [
-                        "PAID_FLAG",
-                        "MATCH_GROUP_ID",
-                        "MATCH_TYPE",
-                        "CONFIDENCE",
-                        "PAO_PASS_DATE",
-                        "BILLNO"
-                    ]] = [
-                        True,
-                        gid,
-                        "AUTO_COMBINATION",
-                        "MEDIUM",
-                        pay_date,
-                        bill_no
-                    ]
-
-                matched_summary.append({
-                    "MATCH_GROUP_ID": gid,
-                    "BILLNO": bill_no,
-                    "MATCH_MODE": "COMBINATION",
-                    "HEAD_OF_ACCOUNT": head_of_account
-                })
-
-                found = True
-                break
-        if found:
-            break
-
-    if not found:
-        unmatched_payments.append({
-            "BILLNO": bill_no,
-            "REASON": "NO_MATCH_IN_SAME_FINANCIAL_YEAR",
-            "HEAD_OF_ACCOUNT": head_of_account
-        })
+# Bulk exact join, then the per-FY exact / combination loop
+result = match(invoice_df, payment_df, config, timer, deadline=run_deadline)
 
 # ================= OUTPUT FILES =================
-invoice_df[invoice_df["PAID_FLAG"]] \
-    .sort_values("MATCH_GROUP_ID") \
-    .to_excel(f"{OUTPUT_DIR}/matched_invoices.xlsx", index=False)
-
-invoice_df[~invoice_df["PAID_FLAG"]] \
-    .to_excel(f"{OUTPUT_DIR}/unpaid_invoices.xlsx", index=False)
-
-pd.DataFrame(unmatched_payments) \
-    .to_excel(f"{OUTPUT_DIR}/unmatched_payments.xlsx", index=False)
+# All reports in one pass (one workbook for xlsx)
+write_reports(result.reports(), OUTPUT_FORMAT, OUTPUT_DIR)
+timer.lap("write")
 
-pd.DataFrame(matched_summary) \
-    .to_excel(f"{OUTPUT_DIR}/payment_invoice_map.xlsx", index=False)
+# Stage times, bills per match mode and the worst searches
+write_run_stats(run_stats(timer.laps, result.modes, result.searches), OUTPUT_DIR)
 
 print("✅ Reconciliation complete")
-print(f"✔ Matched groups      : {group_counter - 1}")
-print(f"⚠ Unmatched payments : {len(unmatched_payments)}")
+print(f"✔ Matched groups      : {len(result.payment_map)}")
+print(f"⚠ Unmatched payments : {len(result.unmatched)}")
+timer.report()
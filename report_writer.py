@@ -0,0 +1,157 @@
+import io
+import os
+
+import numpy as np
+import pandas as pd
+
+try:
+    import xlsxwriter
+except ImportError:
+    xlsxwriter = None
+    from openpyxl import Workbook
+    from openpyxl.cell import WriteOnlyCell
+    from openpyxl.styles import Font
+
+# ================= CONFIG =================
+FORMATS = ("xlsx", "csv", "parquet")
+REPORT_NAME = "reconciliation_report"
+
+DATE_FORMAT = "yyyy-mm-dd"
+DATETIME_FORMAT = "yyyy-mm-dd hh:mm:ss"
+
+
+# ================= CELLS =================
+def _is_date_only(series):
+    """Datetime column whose values all fall on midnight."""
+    values = series.dropna()
+    return bool((values == values.dt.normalize()).all())
+
+
+def _columns(df):
+    """
+    Each column as a list of plain cell values (None for missing) plus its
+    number format. Date columns stay datetimes and get a date format.
+    """
+    values, formats = [], []
+    for name in df.columns:
+        s = df[name]
+        fmt = None
+        if pd.api.types.is_datetime64_any_dtype(s):
+            fmt = DATE_FORMAT if _is_date_only(s) else DATETIME_FORMAT
+        values.append(s.astype(object).where(s.notna(), None).tolist())
+        formats.append(fmt)
+    return values, formats
+
+
+def _formula_text(df):
+    """
+    Row positions, per column position, of text cells starting with "=":
+    a spreadsheet would run them as formulas.
+    """
+    found = {}
+    for c, name in enumerate(df.columns):
+        s = df[name]
+        if not (pd.api.types.is_object_dtype(s) or pd.api.types.is_string_dtype(s)):
+            continue
+        try:
+            rows = np.flatnonzero(s.str.startswith("=", na=False).to_numpy(bool))
+        except AttributeError:    # an object column without any text
+            continue
+        if len(rows):
+            found[c] = rows
+    return found
+
+
+# ================= WRITERS =================
+def write_workbook(f, reports):
+    """
+    All reports as sheets of one workbook, written row by row in a single
+    pass: xlsxwriter in constant-memory mode, or openpyxl's write-only
+    mode when xlsxwriter is not installed.
+    """
+    if xlsxwriter is not None:
+        wb = xlsxwriter.Workbook(f, {
+            "constant_memory": True,
+            "strings_to_urls": False,       # hyperlinks are capped per sheet; keep them as text
+            "strings_to_formulas": False    # export text is never run as a formula
+        })
+        bold = wb.add_format({"bold": True})
+        cell_formats = {}
+        for sheet, df in reports.items():
+            ws = wb.add_worksheet(sheet)
+            ws.write_row(0, 0, [str(c) for c in df.columns], bold)
+            values, formats = _columns(df)
+            formats = [
+                cell_formats.setdefault(fmt, wb.add_format({"num_format": fmt})) if fmt else None
+                for fmt in formats
+            ]
+            for r, row in enumerate(zip(*values), start=1):
+                for c, value in enumerate(row):
+                    if value is not None:
+                        ws.write(r, c, value, formats[c])
+        wb.close()
+        return
+
+    wb = Workbook(write_only=True)
+    for sheet, df in reports.items():
+        ws = wb.create_sheet(sheet)
+        header = []
+        for c in df.columns:
+            cell = WriteOnlyCell(ws, value=str(c))
+            cell.font = Font(bold=True)
+            header.append(cell)
+        ws.append(header)
+        values, formats = _columns(df)
+        # openpyxl writes any string starting with "=" as a formula
+        for c, rows in _formula_text(df).items():
+            for r in rows:
+                values[c][r] = WriteOnlyCell(ws, value=values[c][r])
+                values[c][r].data_type = "s"
+        dated = [c for c, fmt in enumerate(formats) if fmt]
+        for row in zip(*values):
+            if dated:
+                row = list(row)
+                for c in dated:
+                    if row[c] is not None:
+                        row[c] = WriteOnlyCell(ws, value=row[c])
+                        row[c].number_format = formats[c]
+            ws.append(row)
+    wb.save(f)
+
+
+def write_csv(f, df):
+    text = io.TextIOWrapper(f, encoding="utf-8-sig", newline="")
+    df.to_csv(text, index=False)
+    text.flush()
+    text.detach()
+
+
+def write_parquet(f, df):
+    df.to_parquet(f, index=False)
+
+
+# ================= REPORTS =================
+def report_files(reports, fmt, name=REPORT_NAME):
+    """
+    (file name, writer) pairs for `reports` ({sheet: frame}) in `fmt`: one
+    workbook for xlsx, one file per report for csv and parquet. Each
+    writer takes a binary file object.
+    """
+    if fmt == "xlsx":
+        return [(f"{name}.xlsx", lambda f: write_workbook(f, reports))]
+    if fmt == "csv":
+        return [(f"{sheet}.csv", lambda f, df=df: write_csv(f, df)) for sheet, df in reports.items()]
+    if fmt == "parquet":
+        return [(f"{sheet}.parquet", lambda f, df=df: write_parquet(f, df)) for sheet, df in reports.items()]
+    raise ValueError(f"Unsupported report format: {fmt} (use one of {FORMATS})")
+
+
+def write_reports(reports, fmt, out_dir, name=REPORT_NAME):
+    """Write `reports` to `out_dir`; returns the paths written."""
+    paths = []
+    for file_name, write in report_files(reports, fmt, name):
+        path = os.path.join(out_dir, file_name)
+        with open(path, "wb") as f:
+            write(f)
+        paths.append(path)
+    return paths
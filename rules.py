@@ -0,0 +1,668 @@
+import multiprocessing
+import time
+from bisect import bisect_left, insort
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+
+# ================= COMBINATION MATCH (SUBSET SUM) =================
+# All amounts here are integer paise, so sums are exact and hashable.
+#
+# The result is the same group the old loop
+#
+#     for r in range(2, MAX_COMBINATION_SIZE + 1):
+#         for combo in combinations(candidates, r):
+#
+# would stop on: the smallest group size wins, and within one size the
+# first group in candidate order wins. A sorted meet-in-the-middle pass
+# first decides whether any group of size r exists at all (the common
+# "no match" case never walks the candidates in file order); only then
+# is the first group in file order searched for, with branches pruned by
+# the smallest/largest sums the remaining candidates can still reach
+# and its last two members looked up with numpy for all leads at once.
+#
+# Before any of that the candidates are narrowed: with no negative
+# amounts nothing above target + tolerance can be part of a group, and a
+# size whose smallest (largest) possible sum is already above (below)
+# the window is skipped outright.
+#
+# A SearchCounter passed in tallies every partial group the search
+# extends, which is what blows up on pathological bills, and stops the
+# search with SearchBudgetExceeded once its combination budget or its
+# deadline is spent.
+
+class SearchBudgetExceeded(Exception):
+    """A combination search ran past its budget; the bill goes to manual review."""
+
+
+class SearchCounter:
+    """Combinations (partial groups) evaluated by find_combination."""
+
+    CLOCK_EVERY = 1024    # combinations between deadline checks
+
+    def __init__(self, max_combinations=None, deadline=None):
+        self.count = 0
+        self.max_combinations = max_combinations
+        self.deadline = deadline    # a time.time() value
+        self._clock_at = self.CLOCK_EVERY
+
+    def tick(self, n=1):
+        self.count += n
+        if self.max_combinations is not None and self.count > self.max_combinations:
+            raise SearchBudgetExceeded(f"more than {self.max_combinations} combinations")
+        if self.deadline is not None and self.count >= self._clock_at:
+            self._clock_at = self.count + self.CLOCK_EVERY
+            if time.time() > self.deadline:
+                raise SearchBudgetExceeded("deadline passed")
+
+
+def find_combination(amounts, target, max_size, min_size=2, tolerance=0, counter=None):
+    """
+    Return the positions (into `amounts`) of the first group of
+    `min_size`..`max_size` amounts summing to `target` +/- `tolerance`,
+    or None when no such group exists.
+    """
+    if counter is None:
+        counter = SearchCounter()
+    amounts = [int(a) for a in amounts]
+    lo, hi = target - tolerance, target + tolerance
+
+    positions = range(len(amounts))
+    if amounts and min(amounts) >= 0:
+        positions = [pos for pos, value in enumerate(amounts) if value <= hi]
+        amounts = [amounts[pos] for pos in positions]
+
+    ordered = sorted(amounts)
+    prefix = [0]
+    for value in ordered:
+        prefix.append(prefix[-1] + value)
+
+    for size in range(min_size, min(max_size, len(amounts)) + 1):
+        if prefix[size] > hi or prefix[-1] - prefix[-1 - size] < lo:
+            continue    # even the `size` smallest / largest amounts miss the window
+        if _group_exists(ordered, prefix, size, lo, hi, counter):
+            return [positions[pos] for pos in _first_group(amounts, size, lo, hi, counter)]
+    return None
+
+
+def _max_table(values):
+    """Sparse table over `values`: row l holds the max of values[x : x + 2**l]."""
+    rows = [values]
+    width = 1
+    while 2 * width <= len(values):
+        prev = rows[-1]
+        rows.append(np.maximum(prev[:-width], prev[width:]))
+        width *= 2
+    table = np.zeros((len(rows), len(values)), dtype=values.dtype)
+    for level, row in enumerate(rows):
+        table[level, :len(row)] = row
+    return table
+
+
+def _range_max(table, start, stop):
+    """max(values[start:stop]) for every (non-empty) range, from _max_table(values)."""
+    level = np.frexp(stop - start)[1] - 1
+    return np.maximum(table[level, start], table[level, stop - (1 << level)])
+
+
+def _subset_sums(vals, prefix, start, stop, k, lo, hi, counter, acc=0):
+    """
+    Yield `acc` + sum of every k-subset of the sorted slice vals[start:stop]
+    that lands inside [lo, hi]. Branches that cannot reach the window are cut.
+    """
+    if k == 0:
+        if lo <= acc <= hi:
+            yield acc
+        return
+
+    top = prefix[stop] - prefix[stop - k + 1]    # k-1 largest in the slice
+    start = bisect_left(vals, lo - acc - top, start, stop - k + 1)    # too small to reach lo
+    for i in range(start, stop - k + 1):
+        if acc + prefix[i + k] - prefix[i] > hi:
+            break                                # only gets bigger from here
+        counter.tick()
+        yield from _subset_sums(
+            vals, prefix, i + 1, stop, k - 1, lo, hi, counter, acc + vals[i]
+        )
+
+
+def _group_exists(vals, prefix, k, lo, hi, counter):
+    """Meet-in-the-middle: is there any k-subset of sorted `vals` in [lo, hi]?"""
+    m = len(vals)
+    if k > m:
+        return False
+    if k == 1:
+        i = bisect_left(vals, lo)
+        return i < m and vals[i] <= hi
+
+    # Split every group into a left half (its k1 smallest members) and a
+    # right half. Walking p = first member of the right half keeps the two
+    # halves disjoint: left halves are built from vals[:p] only.
+    k1 = k // 2
+    k2 = k - k1
+
+    left_min = prefix[k1]
+    right_max = prefix[m] - prefix[m - k2]
+
+    left_sums = set()
+    for p in range(k1, m - k2 + 1):
+        right_min = prefix[p + k2] - prefix[p]   # k2 smallest of vals[p:]; grows with p
+        if left_min + right_min > hi:
+            break                                # every later right half is bigger
+        left_max = prefix[p] - prefix[p - k1]    # k1 largest of vals[:p]
+        last = vals[p - 1]
+        left_sums.update(_subset_sums(
+            vals, prefix, 0, p - 1, k1 - 1,
+            lo - right_max, hi - right_min, counter, last
+        ))
+        if not left_sums:
+            continue
+
+        for right in _subset_sums(
+            vals, prefix, p + 1, m, k2 - 1,
+            lo - left_max, hi - left_min, counter, vals[p]
+        ):
+            for need in range(lo - right, hi - right + 1):
+                if need in left_sums:
+                    return True
+    return False
+
+
+def _first_group(amounts, k, lo, hi, counter):
+    """First k-group in candidate order (as `combinations` yields it) in [lo, hi]."""
+    n = len(amounts)
+    values = np.array(amounts, dtype=np.int64)
+
+    # positions of every amount, for O(1) lookup of the closing members
+    positions = defaultdict(list)
+    for pos, value in enumerate(amounts):
+        positions[value].append(pos)
+
+    # The last two members are found with numpy: every amount sorted,
+    # with a sparse table giving the latest position any amount in a
+    # window of values sits at.
+    order = np.argsort(values)
+    sorted_values, latest = values[order], _max_table(order)
+
+    # min_sum[q][j] / max_sum[q][j]: smallest / largest sum of j amounts
+    # taken from amounts[q:] (a pair never needs them)
+    min_sum = [None] * (n + 1)
+    max_sum = [None] * (n + 1)
+    smallest, largest = [], []
+    min_sum[n] = max_sum[n] = [0]
+    for q in range(n - 1, -1, -1) if k > 2 else ():
+        insort(smallest, amounts[q])
+        insort(largest, amounts[q])
+        del smallest[k:]
+        del largest[:-k]
+        mins, maxs = [0], [0]
+        for j in range(len(smallest)):
+            mins.append(mins[-1] + smallest[j])
+            maxs.append(maxs[-1] + largest[-1 - j])
+        min_sum[q], max_sum[q] = mins, maxs
+
+    def first_at_or_after(start, low, high):
+        best = None
+        for value in range(low, high + 1):
+            found = positions.get(value)
+            if not found:
+                continue
+            i = bisect_left(found, start)
+            if i < len(found) and (best is None or found[i] < best):
+                best = found[i]
+        return best
+
+    def first_pair(start, acc):
+        """First i >= start that a later amount completes, or None."""
+        leads = np.arange(start, n - 1)
+        counter.tick(len(leads))
+        rest = acc + values[leads]
+        begin = np.searchsorted(sorted_values, lo - rest)
+        end = np.searchsorted(sorted_values, hi - rest, side="right")
+        ok = np.flatnonzero(begin < end)
+        if len(ok):
+            ok = ok[_range_max(latest, begin[ok], end[ok]) > leads[ok]]
+        return int(leads[ok[0]]) if len(ok) else None
+
+    def search(start, need, acc):
+        if need == 1:
+            pos = first_at_or_after(start, lo - acc, hi - acc)
+            return None if pos is None else [pos]
+        if need == 2:
+            i = first_pair(start, acc)
+            return None if i is None else [i] + search(i + 1, 1, acc + amounts[i])
+
+        for i in range(start, n - need + 1):
+            counter.tick()
+            total = acc + amounts[i]
+            rest = need - 1
+            if total + min_sum[i + 1][rest] > hi:
+                continue
+            if total + max_sum[i + 1][rest] < lo:
+                continue
+            tail = search(i + 1, rest, total)
+            if tail is not None:
+                return [i] + tail
+        return None
+
+    return search(0, k, 0)
+
+
+# ================= EXACT MATCH INDEX =================
+# Built once per run instead of masking the whole invoice frame for every
+# bill. Each FY holds its unpaid invoices as (paise amount, row position)
+# pairs in sorted order, so an exact match is a bisect and the first row
+# position found for an amount is the first unpaid invoice in file order.
+
+class AmountIndex:
+    def __init__(self, positions, fys, amounts):
+        self._by_fy = defaultdict(list)
+        self._keys = {}
+        for pos, fy, amount in zip(positions, fys, amounts):
+            self._by_fy[fy].append((amount, pos))
+            self._keys[pos] = (fy, amount)
+        for entries in self._by_fy.values():
+            entries.sort()
+
+    @classmethod
+    def from_frame(cls, df, mask=None, amount_col="CRAC_AMOUNT", fy_col="FY"):
+        """Index the rows of `df` (within `mask`) that have an FY and an amount."""
+        valid = df[fy_col].notna() & df[amount_col].notna()
+        if mask is not None:
+            valid &= mask
+        valid = valid.to_numpy()
+        return cls(
+            valid.nonzero()[0].tolist(),
+            df.loc[valid, fy_col].tolist(),
+            df.loc[valid, amount_col].astype("int64").tolist()
+        )
+
+    def find(self, fy, amount, tolerance=0, accept=None):
+        """
+        Row position of the first unpaid invoice in `fy` whose amount is
+        within `tolerance` paise of `amount` (and passes `accept`, if
+        given), or None.
+        """
+        entries = self._by_fy.get(fy)
+        if not entries:
+            return None
+
+        best = None
+        i = bisect_left(entries, (amount - tolerance, -1))
+        while i < len(entries) and entries[i][0] <= amount + tolerance:
+            value, pos = entries[i]
+            if best is None or pos < best:
+                if accept is not None and not accept(pos):
+                    i += 1
+                    continue
+                best = pos
+            # the rest of this amount sits later in file order
+            i = bisect_left(entries, (value + 1, -1), i)
+        return best
+
+    def mark_paid(self, pos):
+        key = self._keys.pop(pos, None)
+        if key is None:
+            return
+        fy, amount = key
+        entries = self._by_fy[fy]
+        del entries[bisect_left(entries, (amount, pos))]
+
+
+# ================= BULK EXACT MATCH =================
+# Settles every one-to-one match in a single join instead of one loop
+# iteration per bill. Bills and invoices are ranked inside each
+# (FY, paise amount) key, bills in processing order and invoices in file
+# order, and the k-th bill takes the k-th invoice -- what the serial
+# loop does when every bill takes the first unpaid invoice of its amount.
+#
+# Anything the join cannot settle exactly like the serial loop is left
+# to it: keys that have a neighbouring amount within `tolerance`, and,
+# under the invoice-date <= payment-date rule, every bill of a key from
+# the first pair that breaks the rule onwards.
+
+def bulk_exact_match(invoice_df, bill_df, bill_amount_col, tolerance=0,
+                     invoice_date_col=None, bill_date_col=None):
+    """
+    Return a frame of (BILL index label, INVOICE row position) pairs, in
+    bill order. Both frames need an FY column; invoices are matched on
+    CRAC_AMOUNT. Amounts are integer paise.
+    """
+    keys = ["FY", "AMOUNT"]
+
+    valid = (invoice_df["FY"].notna() & invoice_df["CRAC_AMOUNT"].notna()).to_numpy()
+    invoices = pd.DataFrame({
+        "FY": invoice_df["FY"][valid].astype("int64").to_numpy(),
+        "AMOUNT": invoice_df["CRAC_AMOUNT"][valid].astype("int64").to_numpy(),
+        "INVOICE": valid.nonzero()[0]
+    })
+
+    bills = bill_df.loc[
+        bill_df["FY"].notna() & bill_df[bill_amount_col].notna(), ["FY"]
+    ]
+    bills["FY"] = bills["FY"].astype("int64")
+    bills["AMOUNT"] = bill_df.loc[bills.index, bill_amount_col].astype("int64")
+    bills["BILL"] = bills.index
+
+    if invoice_date_col is not None:
+        invoices["INVOICE_DATE"] = invoice_df[invoice_date_col].to_numpy()[valid]
+        bills["BILL_DATE"] = bill_df.loc[bills.index, bill_date_col]
+
+    if tolerance:
+        present = pd.concat([invoices[keys], bills[keys]]).drop_duplicates()
+        shifted = pd.concat([
+            present.assign(AMOUNT=present["AMOUNT"] + step)
+            for step in range(-tolerance, tolerance + 1) if step
+        ])
+        crowded = shifted.merge(present, on=keys)[keys].drop_duplicates()
+        invoices = _drop_keys(invoices, crowded, keys)
+        bills = _drop_keys(bills, crowded, keys)
+
+    invoices["RANK"] = invoices.groupby(keys).cumcount()
+    bills["RANK"] = bills.groupby(keys).cumcount()
+    pairs = bills.merge(invoices, on=keys + ["RANK"])
+
+    if invoice_date_col is not None:
+        in_time = pairs["INVOICE_DATE"] <= pairs["BILL_DATE"]
+        pairs = pairs[in_time.groupby([pairs["FY"], pairs["AMOUNT"]]).cummin()]
+
+    return pairs[["BILL", "INVOICE"]].reset_index(drop=True)
+
+
+def _drop_keys(df, keys_df, keys):
+    hit = df[keys].merge(keys_df, on=keys, how="left", indicator=True)
+    return df[(hit["_merge"] == "left_only").to_numpy()]
+
+
+def number_groups(bills):
+    """Group numbers (int32, from 1) for matched bill labels, in processing order."""
+    return pd.Series(bills).rank(method="dense").to_numpy("int32")
+
+
+def format_group_ids(numbers):
+    """MG00001-style ids for group numbers, "" for 0 (no group): done only for reports."""
+    numbers = pd.Series(np.asarray(numbers))
+    ids = "MG" + numbers.astype(str).str.zfill(5)
+    return ids.where(numbers > 0, "").to_numpy(object)
+
+
+def with_group_ids(df, col="MATCH_GROUP_ID"):
+    """`df` with its group numbers in `col` formatted as ids."""
+    return df.assign(**{col: format_group_ids(df[col])})
+
+
+# ================= MATCH STATE =================
+# While the engine runs, match results live in plain arrays indexed by
+# invoice row position; they go into the invoice frame in one write at
+# the end instead of one DataFrame.loc write per accepted match. Match
+# type and confidence are small codes (categoricals in the frame) and
+# groups are int32 numbers, formatted as MG00001 only for reports.
+
+MATCH_TYPES = ["", "AUTO_SINGLE", "AUTO_COMBINATION"]
+CONFIDENCES = ["", "HIGH", "MEDIUM"]
+
+
+class MatchState:
+    def __init__(self, n, first_group=1):
+        self.first_group = first_group                # MATCH_GROUP_ID of the first bill matched
+        self.paid = np.zeros(n, dtype=bool)
+        self.bill = np.full(n, -1, dtype=np.int64)    # matched bill's label
+        self.match_type = np.zeros(n, dtype=np.int8)  # codes into MATCH_TYPES
+        self.confidence = np.zeros(n, dtype=np.int8)  # codes into CONFIDENCES
+        self.pay_date = np.full(n, np.datetime64("NaT"), dtype="datetime64[ns]")
+        self.bill_no = np.full(n, "", dtype=object)
+
+    def mark(self, positions, bill, match_type, confidence, pay_date, bill_no):
+        """Record invoice rows `positions` as paid (bill, pay date and bill no may be one per row)."""
+        self.paid[positions] = True
+        self.bill[positions] = bill
+        self.match_type[positions] = MATCH_TYPES.index(match_type)
+        self.confidence[positions] = CONFIDENCES.index(confidence)
+        self.pay_date[positions] = pay_date
+        self.bill_no[positions] = bill_no
+
+    def matched_bills(self):
+        """One row per matched bill (BILL, MATCH_TYPE, MATCH_GROUP_ID number), in processing order."""
+        rows = self.paid.nonzero()[0]
+        bills = pd.DataFrame({
+            "BILL": self.bill[rows],
+            "MATCH_TYPE": pd.Categorical.from_codes(self.match_type[rows], MATCH_TYPES)
+        }).drop_duplicates("BILL").sort_values("BILL", kind="stable")
+        bills["MATCH_GROUP_ID"] = number_groups(bills["BILL"]) + np.int32(self.first_group - 1)
+        return bills.reset_index(drop=True)
+
+    def write_back(self, df, pay_date_col="PAO_PASS_DATE", bill_no_col="BILLNO"):
+        """
+        The result columns, in report order; called once up front too, so
+        they sit together after the export's own columns.
+        """
+        groups = np.zeros(len(self.paid), dtype=np.int32)
+        groups[self.paid] = number_groups(self.bill[self.paid]) + np.int32(self.first_group - 1)
+
+        df["PAID_FLAG"] = self.paid
+        df["MATCH_GROUP_ID"] = groups
+        df["MATCH_TYPE"] = pd.Categorical.from_codes(self.match_type, MATCH_TYPES)
+        df["CONFIDENCE"] = pd.Categorical.from_codes(self.confidence, CONFIDENCES)
+        df[pay_date_col] = self.pay_date
+        df[bill_no_col] = self.bill_no
+        df["REJECTION_REASON"] = pd.Categorical.from_codes(np.zeros(len(self.paid), dtype=np.int8), [""])
+
+
+# ================= PARTITIONED BILL LOOP =================
+# Every match stays inside one financial year, so each FY is a problem of
+# its own: its bills only ever see its own invoices. The bill loop (exact
+# matches for every bill, then combinations for the rest) runs once per
+# partition, on a process pool when there are several, and the results
+# are merged by bill
+# label -- the same matches, and so the same MATCH_GROUP_ID numbering, as
+# one serial pass over all bills.
+#
+# Workers are forked: the reconcile scripts run at module level, and a
+# spawned worker would re-run the whole script on import. Where fork is
+# not available the partitions run one after another.
+
+def match_bills(invoice_df, bill_df, bill_amount_col, bill_date_col, paid, max_size,
+                tolerance=0, invoice_date_col=None, keys=("FY",), workers=1,
+                max_combinations=None, bill_seconds=None, deadline=None):
+    """
+    Match the bills of `bill_df` (valid amount and date, in processing
+    order) against the invoices not yet `paid` (row-position mask), one
+    partition per value of `keys` -- columns both frames carry. With
+    `invoice_date_col`, an invoice is eligible only up to the bill's date.
+    Every bill gets its exact match first; combinations are searched for
+    the bills left open afterwards.
+
+    Returns (matched, unmatched, searches), all in bill order: matched
+    holds (bill label, invoice row positions, match type), unmatched
+    holds (bill label, reason) with reason NO_CANDIDATES (no eligible
+    invoice at all), NO_MATCH or SEARCH_BUDGET_EXCEEDED, and searches
+    holds one (bill label, mode, candidates, combinations evaluated,
+    seconds) per bill, mode being EXACT, COMBINATION, NONE or
+    BUDGET_EXCEEDED.
+
+    A bill's combination search gives up after `max_combinations` or
+    `bill_seconds`, and none starts once the run `deadline` (a time.time()
+    value) has passed; exact matches are still tried. Only the
+    combination budget gives the same result on every run.
+    """
+    keys = list(keys)
+    open_rows = (~paid).nonzero()[0]
+    invoices = invoice_df.iloc[open_rows]
+
+    has_amount = invoices["CRAC_AMOUNT"].notna().to_numpy()
+    amounts = invoices["CRAC_AMOUNT"].to_numpy("int64", na_value=0)
+    dates = None if invoice_date_col is None else invoices[invoice_date_col].to_numpy("datetime64[ns]")
+
+    invoice_groups = invoices.groupby(keys, sort=False).indices
+    parts = []
+    for key, bill_rows in bill_df.groupby(keys, sort=False).indices.items():
+        rows = invoice_groups.get(key, np.array([], dtype=np.int64))
+        bills = bill_df.iloc[bill_rows]
+        parts.append({
+            "positions": open_rows[rows],
+            "amounts": amounts[rows],
+            "has_amount": has_amount[rows],
+            "dates": None if dates is None else dates[rows],
+            "bills": bills.index.to_numpy(),
+            "bill_amounts": bills[bill_amount_col].to_numpy("int64"),
+            "bill_dates": bills[bill_date_col].to_numpy("datetime64[ns]"),
+            "max_size": max_size,
+            "tolerance": tolerance,
+            "max_combinations": max_combinations,
+            "bill_seconds": bill_seconds,
+            "deadline": deadline
+        })
+
+    pool = _fork_pool(workers) if len(parts) > 1 else None
+    if pool is None:
+        results = [_match_partition(part) for part in parts]
+    else:
+        with pool:
+            # largest partitions first, so one long FY does not start last
+            order = sorted(range(len(parts)), key=lambda i: -len(parts[i]["bills"]))
+            done = dict(zip(order, pool.map(_match_partition, [parts[i] for i in order])))
+            results = [done[i] for i in range(len(parts))]
+
+    matched = sorted((m for found, _, _ in results for m in found), key=lambda m: m[0])
+    unmatched = sorted((u for _, missed, _ in results for u in missed), key=lambda u: u[0])
+    searches = sorted((b for _, _, bills in results for b in bills), key=lambda b: b[0])
+    return matched, unmatched, searches
+
+
+def _fork_pool(workers):
+    if workers <= 1:
+        return None
+    try:
+        context = multiprocessing.get_context("fork")
+    except ValueError:
+        return None
+    return ProcessPoolExecutor(max_workers=workers, mp_context=context)
+
+
+class DateWindow:
+    """
+    Unpaid invoices of a partition dated on or before the current bill
+    (all unpaid invoices without dates). A pointer over the invoices in
+    date order moves to each bill's date and adds -- or, when bill dates
+    go back, drops -- only the invoices it passes, so bills arriving in
+    date order (either direction) cost amortized O(1) each instead of a
+    pass over every invoice. Bills are still taken in processing order.
+    """
+
+    def __init__(self, dates, n):
+        self.paid = np.zeros(n, dtype=bool)
+        self.open = np.full(n, dates is None)
+        self.count = n if dates is None else 0
+        self.dated = dates is not None
+        if self.dated:
+            self.order = np.argsort(dates, kind="stable")    # NaT last, never reached
+            self.sorted_dates = dates[self.order]
+            self.rank = np.empty(n, dtype=np.int64)
+            self.rank[self.order] = np.arange(n)
+            self.edge = 0    # invoices order[:edge] are dated on or before the bill
+
+    def move_to(self, date):
+        if not self.dated:
+            return
+        edge = int(np.searchsorted(self.sorted_dates, date, side="right"))
+        if edge > self.edge:
+            rows = self.order[self.edge:edge]
+            self.open[rows] = ~self.paid[rows]
+            self.count += int(self.open[rows].sum())
+        elif edge < self.edge:
+            rows = self.order[edge:self.edge]
+            self.count -= int(self.open[rows].sum())
+            self.open[rows] = False
+        self.edge = edge
+
+    def covers(self, pos):
+        """Invoice `pos` is dated on or before the current bill."""
+        return not self.dated or self.rank[pos] < self.edge
+
+    def pay(self, rows):
+        self.paid[rows] = True
+        self.count -= int(self.open[rows].sum())
+        self.open[rows] = False
+
+    def eligible(self):
+        """Row positions of the window, in file order."""
+        return self.open.nonzero()[0]
+
+
+def _bill_deadline(part):
+    """The sooner of the bill's time budget and the run deadline, or None."""
+    deadlines = [part["deadline"]]
+    if part["bill_seconds"] is not None:
+        deadlines.append(time.time() + part["bill_seconds"])
+    deadlines = [d for d in deadlines if d is not None]
+    return min(deadlines) if deadlines else None
+
+
+def _match_partition(part):
+    """The per-bill loop over one partition; positions are mapped back to the full frame."""
+    positions, amounts, has_amount, dates = (
+        part["positions"], part["amounts"], part["has_amount"], part["dates"]
+    )
+    tolerance = part["tolerance"]
+
+    local = has_amount.nonzero()[0]
+    index = AmountIndex(local.tolist(), [0] * len(local), amounts[local].tolist())
+    window = DateWindow(dates, len(positions))
+    accept = None if dates is None else window.covers
+
+    # Exact matches for every bill first, then combinations for the bills
+    # still open: a combination never takes an invoice a later bill
+    # matches exactly, the same as for the bills bulk_exact_match settles
+    matched, unmatched, searches, open_bills = [], [], [], []
+    for bill, amount, date in zip(part["bills"], part["bill_amounts"], part["bill_dates"]):
+        start = time.perf_counter()
+        window.move_to(date)
+        pos = index.find(0, amount, tolerance=tolerance, accept=accept)
+        if pos is None:
+            open_bills.append((bill, amount, date, time.perf_counter() - start))
+            continue
+        index.mark_paid(pos)
+        window.pay([pos])
+        matched.append((bill, positions[[pos]], "AUTO_SINGLE"))
+        searches.append((bill, "EXACT", 0, 0, time.perf_counter() - start))
+
+    for bill, amount, date, spent in open_bills:
+        start = time.perf_counter() - spent
+        window.move_to(date)
+        if window.count == 0:
+            unmatched.append((bill, "NO_CANDIDATES"))
+            searches.append((bill, "NONE", 0, 0, time.perf_counter() - start))
+            continue
+
+        eligible = window.eligible()
+        candidates = eligible[has_amount[eligible]]
+        counter = SearchCounter(part["max_combinations"], _bill_deadline(part))
+        try:
+            if counter.deadline is not None and time.time() > counter.deadline:
+                raise SearchBudgetExceeded("deadline passed")
+            combo = find_combination(
+                amounts[candidates], amount, part["max_size"], tolerance=tolerance, counter=counter
+            )
+        except SearchBudgetExceeded:
+            # left for manual review; its invoices stay open for later bills
+            unmatched.append((bill, "SEARCH_BUDGET_EXCEEDED"))
+            searches.append((
+                bill, "BUDGET_EXCEEDED", len(candidates), counter.count, time.perf_counter() - start
+            ))
+            continue
+
+        if combo:
+            group = candidates[combo]
+            window.pay(group)
+            matched.append((bill, positions[group], "AUTO_COMBINATION"))
+        else:
+            unmatched.append((bill, "NO_MATCH"))
+        searches.append((
+            bill, "COMBINATION" if combo else "NONE",
+            len(candidates), counter.count, time.perf_counter() - start
+        ))
+
+    return matched, unmatched, searches
@@ -0,0 +1,77 @@
+import json
+import os
+
+import pandas as pd
+
+# ================= CONFIG =================
+# Every run leaves a RUN_STATS report (one row per bill the per-bill
+# search looked at, most combinations first) and run_stats.json (stage
+# times, bills per match mode, search totals and the worst bills) next
+# to the other reports.
+RUN_STATS_FILE = "run_stats.json"
+WORST_BILLS = 20
+
+
+# ================= PER-BILL SEARCHES =================
+def search_frame(searches, bill_nos):
+    """
+    Frame of rules.match_bills searches, worst first. `bill_nos` maps
+    bill labels to bill numbers.
+    """
+    df = pd.DataFrame(
+        searches, columns=["BILL", "MATCH_MODE", "CANDIDATES", "COMBINATIONS", "SECONDS"]
+    )
+    df.insert(1, "BILLNO", bill_nos.loc[df["BILL"]].to_numpy())
+    return df.sort_values(["COMBINATIONS", "SECONDS"], ascending=False, kind="stable")
+
+
+def mode_counts(bulk_exact, searches, unmatched):
+    """
+    Bills per match mode: bulk join, per-bill exact, combination,
+    unmatched, and of those the ones whose search ran out of budget.
+    """
+    modes = searches["MATCH_MODE"].value_counts()
+    return {
+        "BULK_EXACT": int(bulk_exact),
+        "EXACT": int(modes.get("EXACT", 0)),
+        "COMBINATION": int(modes.get("COMBINATION", 0)),
+        "UNMATCHED": int(unmatched),
+        "BUDGET_EXCEEDED": int(modes.get("BUDGET_EXCEEDED", 0))
+    }
+
+
+# ================= SUMMARY =================
+def run_stats(stages, modes, searches):
+    """Everything a run measured, as plain JSON-ready values."""
+    combinations = searches["COMBINATIONS"]
+    candidates = searches["CANDIDATES"]
+    worst = searches.head(WORST_BILLS)
+    return {
+        "stages": {stage: round(seconds, 4) for stage, seconds in stages.items()},
+        "modes": modes,
+        "search": {
+            "bills": len(searches),
+            "seconds": round(float(searches["SECONDS"].sum()), 4),
+            "combinations": int(combinations.sum()),
+            "max_combinations": int(combinations.max()) if len(searches) else 0,
+            "max_candidates": int(candidates.max()) if len(searches) else 0,
+            "mean_candidates": round(float(candidates.mean()), 1) if len(searches) else 0
+        },
+        "worst_bills": [
+            {
+                "BILLNO": str(row.BILLNO),
+                "MATCH_MODE": row.MATCH_MODE,
+                "CANDIDATES": int(row.CANDIDATES),
+                "COMBINATIONS": int(row.COMBINATIONS),
+                "SECONDS": round(float(row.SECONDS), 4)
+            }
+            for row in worst.itertuples()
+        ]
+    }
+
+
+def write_run_stats(stats, out_dir):
+    path = os.path.join(out_dir, RUN_STATS_FILE)
+    with open(path, "w") as f:
+        json.dump(stats, f, indent=2, default=str)
+    return path
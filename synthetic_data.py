@@ -0,0 +1,246 @@
+import argparse
+import os
+
+import numpy as np
+import pandas as pd
+
+from report_writer import write_workbook
+
+# ================= CONFIG =================
+# Synthetic GeM bulk-payment and PAO contingency-bill exports with the
+# real column layout, for benchmarks and scale tests. Every bill is built
+# with a known answer: paid by one invoice, by a 2-6 invoice combination,
+# or by nothing at all.
+SEED = 7
+FIRST_FY = 2017
+LAST_FY = 2025
+
+SINGLE_SHARE = 0.6          # bills paid by exactly one invoice
+COMBINATION_SHARE = 0.25    # bills paid by 2..MAX_COMBINATION_SIZE invoices
+MAX_COMBINATION_SIZE = 6
+DUPLICATE_SHARE = 0.2       # bills drawn from a small pool of common amounts
+ACB_DCB_SHARE = 0.01        # abstract / detailed contingency bills (never matched)
+UNPAID_INVOICE_SHARE = 0.1  # extra invoices no bill pays, per bill
+
+COMMON_AMOUNTS = [500, 1250, 1350, 2400, 5000, 12000, 24000, 25000]
+EXCEL_MAX_ROWS = 1048575    # data rows below the header
+
+# Alternate header spellings every reconcile script accepts; --aliases
+# picks one per column so header resolution is exercised too
+HEADER_ALIASES = {
+    "PRC Date": ["PRC DATE", "PRC_DATE"],
+    "CRAC Amount": ["CRAC AMOUNT", "CRAC_AMOUNT"],
+    "Paid Amount": ["PAID AMOUNT", "PAID_AMOUNT"],
+    "Invoice Number": ["INVOICE NUMBER", " Invoice  Number "],
+    "BillNo": ["Bill No", "BILLNO"],
+    "BillAmount": ["Bill Amount", "BILLAMOUNT"],
+    "Pao Pass Date": ["PAO PASS DATE", "Pao  Pass Date"],
+    "Head of Account": ["HEAD OF ACCOUNT", "Head of Acccount"]
+}
+
+
+# ================= BILLS =================
+def _fy_dates(rng, fys, low_day=5):
+    """A random day inside each financial year (Apr 1 .. Mar 31)."""
+    start = pd.to_datetime(fys.astype(str) + "-04-01").to_numpy()
+    days = rng.integers(low_day, 365, len(fys))
+    return start + days.astype("timedelta64[D]"), start
+
+
+def make_bills(rng, n_bills, first_fy=FIRST_FY, last_fy=LAST_FY, single_share=SINGLE_SHARE,
+               combination_share=COMBINATION_SHARE, duplicate_share=DUPLICATE_SHARE,
+               acb_dcb_share=ACB_DCB_SHARE):
+    """One row per PAO bill with its kind (single / combination / unpaid / acb_dcb) and size."""
+    if single_share + combination_share > 1:
+        raise ValueError("single_share + combination_share must not exceed 1")
+
+    fys = rng.integers(first_fy, last_fy + 1, n_bills)
+    pass_dates, fy_start = _fy_dates(rng, fys)
+
+    amounts = rng.integers(500, 200000, n_bills)
+    common = rng.random(n_bills) < duplicate_share
+    amounts[common] = rng.choice(COMMON_AMOUNTS, common.sum())
+
+    kind = rng.choice(
+        ["single", "combination", "unpaid"],
+        n_bills,
+        p=[single_share, combination_share, 1 - single_share - combination_share]
+    ).astype(object)
+    kind[rng.random(n_bills) < acb_dcb_share] = "acb_dcb"
+
+    size = np.where(kind == "single", 1, 0)
+    combination = kind == "combination"
+    size[combination] = rng.integers(2, MAX_COMBINATION_SIZE + 1, combination.sum())
+
+    return pd.DataFrame({
+        "FY": fys,
+        "AMOUNT": amounts,
+        "PASS_DATE": pass_dates,
+        "FY_START": fy_start,
+        "KIND": kind,
+        "SIZE": size
+    })
+
+
+# ================= INVOICES =================
+def _split(rng, amounts, sizes):
+    """Split each amount into `size` positive whole-rupee parts."""
+    owner = np.repeat(np.arange(len(amounts)), sizes)
+    weights = rng.random(len(owner)) + 0.2
+    starts = np.concatenate([[0], np.cumsum(sizes)[:-1]])
+    totals = np.add.reduceat(weights, starts)
+
+    # every weight is over a sixth of its group's total, so with bills of
+    # 500+ rupees no part rounds down to nothing
+    parts = np.floor(amounts[owner] * weights / totals[owner]).astype(np.int64)
+    last = starts + sizes - 1
+    parts[last] += amounts - np.add.reduceat(parts, starts)
+    return owner, parts
+
+
+def make_invoices(rng, bills):
+    """Invoices paying each bill, dated on or before it in the same FY, plus unpaid noise."""
+    paid = bills[bills["SIZE"] > 0]
+    owner, parts = _split(rng, paid["AMOUNT"].to_numpy(), paid["SIZE"].to_numpy())
+
+    pass_dates = paid["PASS_DATE"].to_numpy()[owner]
+    fy_start = paid["FY_START"].to_numpy()[owner]
+    lag = rng.integers(1, 60, len(owner)).astype("timedelta64[D]")
+    prc_dates = np.maximum(pass_dates - lag, fy_start)
+
+    n_noise = int(len(bills) * UNPAID_INVOICE_SHARE)
+    noise_fy = rng.integers(bills["FY"].min(), bills["FY"].max() + 1, n_noise)
+    noise_dates, _ = _fy_dates(rng, noise_fy, low_day=0)
+
+    invoices = pd.DataFrame({
+        "AMOUNT": np.concatenate([parts, rng.integers(100, 50000, n_noise)]),
+        "PRC_DATE": np.concatenate([prc_dates, noise_dates])
+    })
+    # GeM exports come roughly in shipment order, not bill order
+    return invoices.sample(frac=1, random_state=rng.integers(2**31)).reset_index(drop=True)
+
+
+# ================= EXPORT LAYOUT =================
+def gem_export(rng, invoices):
+    n = len(invoices)
+    demand = 511687700000000 + np.arange(n) * 7 + rng.integers(0, 7, n)
+    prc = invoices["PRC_DATE"]
+    invoice_date = prc - pd.to_timedelta(rng.integers(0, 3 * 86400, n), unit="s")
+    shipment = pd.Series(demand).astype(str) + "-1"
+
+    return pd.DataFrame({
+        "Demand Number": pd.Series(demand).astype(str),
+        "Shipment Number": shipment,
+        "Contract Number": "GEMC-" + pd.Series(demand).astype(str),
+        "Offering Type": "goods",
+        "Payment Mode": "Offline",
+        "Order Summary Page": "https://mkp.gem.gov.in/dashboard#!/products/order/" + pd.Series(demand).astype(str),
+        "Order Date": (invoice_date - pd.Timedelta(days=5)).dt.strftime("%d.%m.%Y %H:%M"),
+        "Seller Name": rng.choice(["SHRI SAI ENTERPRISES", "ADVIK TRADERS", "ANKUSH TRADERS", "MOULYA TRADING COMPANY"], n),
+        "Invoice Number": "GEM-" + pd.Series(40000000 + np.arange(n)).astype(str),
+        "Invoice Date": invoice_date,
+        "PRC Number": 20000000 + np.arange(n),
+        "PRC Date": prc.dt.strftime("%d-%m-%Y"),
+        "CRAC Number": "GEMCRAC-1-" + shipment,
+        "CRAC Date": (prc + pd.Timedelta(days=5)).dt.strftime("%d-%m-%Y"),
+        "CRAC Amount": invoices["AMOUNT"],
+        "Bill Number": shipment + "B1",
+        "Bill Details Page": "https://mkp.gem.gov.in/finance#!/process_bill/" + shipment,
+        "Paid Amount": invoices["AMOUNT"],
+        "Deduction": 0,
+        "Payment Date": "yyyymmdd"
+    })
+
+
+def pao_export(rng, bills):
+    n = len(bills)
+    prefix = np.where(bills["KIND"] == "acb_dcb", rng.choice(["ACB", "DCB"], n), "CB")
+    bill_type = pd.Series(prefix).map(
+        {"CB": "CONTINGENCY", "ACB": "ABSTRACT CONTINGENCY", "DCB": "DC CONTINGENCY"}
+    )
+    pass_date = bills["PASS_DATE"]
+    approval = pass_date - pd.to_timedelta(rng.integers(0, 5, n), unit="D")
+
+    return pd.DataFrame({
+        "Sr No.": np.arange(1, n + 1),
+        "BillType": bill_type,
+        "BillNo": pd.Series(prefix) + "-" + pd.Series(np.arange(1, n + 1)).astype(str) + "  ",
+        "BillAmount": bills["AMOUNT"],
+        "DDO Approval Date": approval.dt.strftime("%d/%m/%Y"),
+        "Pao Pass": "Passed",
+        "Pao Pass Date": pass_date.dt.strftime("%d/%m/%Y"),
+        "No. of Days": (pass_date - approval).dt.days,
+        "DDO Code": 32605,
+        "PAONo.": 8,
+        "Head of Account": rng.choice(["2052-00-090", "2235-60-200", "2070-00-800"], n)
+    })
+
+
+def use_aliases(rng, df):
+    return df.rename(columns={
+        name: rng.choice(aliases) for name, aliases in HEADER_ALIASES.items() if name in df.columns
+    })
+
+
+# ================= WRITE =================
+def write_export(df, path):
+    if path.lower().endswith(".csv"):
+        df.to_csv(path, index=False, encoding="utf-8-sig")
+        return
+    if len(df) > EXCEL_MAX_ROWS:
+        raise ValueError(f"{len(df)} rows do not fit one Excel sheet; write {path} as .csv")
+    with open(path, "wb") as f:
+        write_workbook(f, {"Sheet1": df})
+
+
+def generate(out_dir, n_bills, fmt="xlsx", seed=SEED, aliases=False, **shares):
+    """
+    Write gem_invoices.<fmt> and pao_bills.<fmt> for `n_bills` bills to
+    `out_dir`; returns their paths, the invoice count and how many bills
+    of each kind were built. `shares` go to make_bills (FY range and
+    bill mix).
+    """
+    rng = np.random.default_rng(seed)
+    bills = make_bills(rng, n_bills, **shares)
+    invoices = make_invoices(rng, bills)
+
+    gem = gem_export(rng, invoices)
+    pao = pao_export(rng, bills)
+    if aliases:
+        gem, pao = use_aliases(rng, gem), use_aliases(rng, pao)
+
+    os.makedirs(out_dir, exist_ok=True)
+    invoice_path = os.path.join(out_dir, f"gem_invoices.{fmt}")
+    payment_path = os.path.join(out_dir, f"pao_bills.{fmt}")
+    write_export(gem, invoice_path)
+    write_export(pao, payment_path)
+    return invoice_path, payment_path, len(gem), bills["KIND"].value_counts().to_dict()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Write synthetic GeM / PAO exports.")
+    parser.add_argument("--bills", type=int, default=1000, help="PAO bills (1k to 1M)")
+    parser.add_argument("--out", default="bench/data")
+    parser.add_argument("--format", choices=["xlsx", "csv"], default="xlsx")
+    parser.add_argument("--seed", type=int, default=SEED)
+    parser.add_argument("--first-fy", type=int, default=FIRST_FY)
+    parser.add_argument("--last-fy", type=int, default=LAST_FY)
+    parser.add_argument("--single-share", type=float, default=SINGLE_SHARE)
+    parser.add_argument("--combination-share", type=float, default=COMBINATION_SHARE)
+    parser.add_argument("--duplicate-share", type=float, default=DUPLICATE_SHARE)
+    parser.add_argument("--acb-dcb-share", type=float, default=ACB_DCB_SHARE)
+    parser.add_argument("--aliases", action="store_true", help="use alternate header spellings")
+    args = parser.parse_args()
+
+    invoice_path, payment_path, n_invoices, kinds = generate(
+        args.out, args.bills, args.format, args.seed, args.aliases,
+        first_fy=args.first_fy,
+        last_fy=args.last_fy,
+        single_share=args.single_share,
+        combination_share=args.combination_share,
+        duplicate_share=args.duplicate_share,
+        acb_dcb_share=args.acb_dcb_share
+    )
+    print(f"✅ {invoice_path} ({n_invoices} invoices)")
+    print(f"✅ {payment_path}")
+    print(f"📊 Bills by kind: {kinds}")
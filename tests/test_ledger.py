@@ -0,0 +1,51 @@
+import pandas as pd
+
+from ledger import Ledger
+
+JAN, MAR = pd.Timestamp("2024-01-10"), pd.Timestamp("2024-03-05")
+
+
+def add(ledger, rows):
+    bill_nos, amounts, dates = zip(*rows)
+    return ledger.add_bills(bill_nos, [2023] * len(rows), amounts, dates).tolist()
+
+
+def test_add_bills_keys_on_bill_not_date(tmp_path):
+    ledger = Ledger(str(tmp_path / "ledger.sqlite"))
+    first = add(ledger, [("CB-2", 500, MAR), ("CB-1", 100, JAN)])
+
+    # a newer export lists a bill passed before the latest one held
+    second = add(ledger, [("CB-3", 700, JAN), ("CB-2", 500, MAR), ("CB-1", 100, JAN), ("CB-3", 700, JAN)])
+
+    assert first == [1, 2]
+    assert second == [3, 1, 2, 3]
+    assert ledger.bills()["bill_no"].tolist() == ["CB-2", "CB-1", "CB-3"]
+
+
+def test_unpaid_bills_follow_the_export_order(tmp_path):
+    ledger = Ledger(str(tmp_path / "ledger.sqlite"))
+    add(ledger, [("CB-1", 100, JAN), ("CB-2", 500, MAR)])
+    ids = add(ledger, [("CB-3", 700, MAR), ("CB-1", 100, JAN)])
+
+    assert ledger.unpaid_bills(order=ids)["BILL_NO"].tolist() == ["CB-3", "CB-1", "CB-2"]
+
+
+def test_settled_invoices_come_from_the_ledger(tmp_path):
+    ledger = Ledger(str(tmp_path / "ledger.sqlite"))
+    (bill,) = add(ledger, [("CB-1", 150, MAR)])
+    ledger.add_invoices(["G-1", "G-2", "G-3"], [2023] * 3, [100, 50, 70], [JAN] * 3)
+    run_id = ledger.start_run("gem.xlsx", "pao.xlsx")
+    ledger.record(
+        run_id,
+        pd.DataFrame({"BILL": [bill], "MATCH_TYPE": ["AUTO_COMBINATION"], "MATCH_GROUP_ID": ["MG00007"]}),
+        pd.DataFrame({"INVOICE_KEY": ["G-1", "G-2"], "BILL": [bill] * 2, "MATCH_GROUP_ID": ["MG00007"] * 2})
+    )
+
+    settled = ledger.settled_invoices(["G-3", "G-2", "G-1"])
+
+    assert settled["GROUP_ID"].tolist()[1:] == ["MG00007"] * 2
+    assert settled["GROUP_ID"].isna().tolist() == [True, False, False]
+    assert settled.loc[1, "BILL_NO"] == "CB-1"
+    assert settled.loc[1, "MATCH_TYPE"] == "AUTO_COMBINATION"
+    assert settled.loc[1, "PASS_DATE"] == MAR
+    assert ledger.next_group() == 8
@@ -0,0 +1,25 @@
+import io
+import zipfile
+
+import pandas as pd
+from openpyxl import load_workbook
+
+from report_writer import write_workbook
+
+
+def test_workbook_keeps_formula_like_text_as_text():
+    # an export field starting with "=" must not run in the user's Excel
+    df = pd.DataFrame({
+        "SELLER": ['=HYPERLINK("http://example.com","x")', "Acme", None],
+        "AMOUNT": [1.5, 2.0, 3.0]
+    })
+    f = io.BytesIO()
+    write_workbook(f, {"matched_invoices": df})
+
+    sheet = zipfile.ZipFile(f).read("xl/worksheets/sheet1.xml").decode()
+    assert "<f>" not in sheet
+
+    ws = load_workbook(f)["matched_invoices"]
+    assert ws["A2"].value == '=HYPERLINK("http://example.com","x")'
+    assert ws["A2"].data_type == "s"
+    assert ws["A3"].value == "Acme"
@@ -0,0 +1,189 @@
+import random
+from itertools import combinations
+
+import numpy as np
+import pandas as pd
+
+from reconcile_core import reconcile
+from rules import AmountIndex, MatchState, bulk_exact_match, find_combination, match_bills
+
+# Two invoices of 100 on the same day and one of 50, against bills of
+# 100 and 150: the 100 bill takes one of the 100s, the 150 bill the
+# other 100 and the 50. Rows that share amount and date must still be
+# told apart by position.
+DAY = pd.Timestamp("2023-06-01")
+
+
+def test_find_combination_returns_distinct_positions():
+    combo = find_combination([100, 100, 50], 150, max_size=3)
+    assert len(set(combo)) == len(combo) == 2
+    assert sorted([100, 100, 50][i] for i in combo) == [50, 100]
+
+
+def brute_force_combination(amounts, target, max_size, tolerance=0):
+    # the loop find_combination replaces
+    for r in range(2, max_size + 1):
+        for combo in combinations(range(len(amounts)), r):
+            if abs(sum(amounts[i] for i in combo) - target) <= tolerance:
+                return list(combo)
+    return None
+
+
+def test_find_combination_matches_brute_force():
+    rng = random.Random(7)
+    for _ in range(2000):
+        low = rng.choice([0, -50])    # some lists carry credit notes
+        amounts = [rng.randint(low, 100) for _ in range(rng.randint(2, 9))]
+        target = rng.randint(-20, 250)
+        max_size = rng.randint(2, 5)
+        tolerance = rng.choice([0, 0, 1, 3])
+
+        expected = brute_force_combination(amounts, target, max_size, tolerance)
+        assert find_combination(amounts, target, max_size, tolerance=tolerance) == expected, (
+            amounts, target, max_size, tolerance
+        )
+
+
+def test_bill_loop_marks_each_invoice_once():
+    # the scripts' bill loop: exact match first, then a combination of
+    # the rows still unpaid
+    invoices = pd.DataFrame({
+        "CRAC_AMOUNT": pd.array([10000, 10000, 5000], dtype="Int64"),
+        "FY": 2023
+    })
+    amounts = invoices["CRAC_AMOUNT"].to_numpy("int64")
+    index = AmountIndex.from_frame(invoices)
+    state = MatchState(len(invoices))
+
+    pos = index.find(2023, 10000)
+    index.mark_paid(pos)
+    state.mark(pos, 0, "AUTO_SINGLE", "HIGH", DAY, "CB-1")
+
+    candidates = (~state.paid).nonzero()[0]
+    combo = find_combination(amounts[candidates], 15000, 3)
+    state.mark(candidates[combo], 1, "AUTO_COMBINATION", "MEDIUM", DAY, "CB-2")
+
+    assert state.paid.all()
+    assert state.bill.tolist() == [0, 1, 1]
+
+
+def test_match_bills_uses_each_invoice_once():
+    invoices = pd.DataFrame({
+        "CRAC_AMOUNT": pd.array([10000, 10000, 5000], dtype="Int64"),
+        "PRC_DATE": [DAY] * 3,
+        "FY": 2023
+    })
+    bills = pd.DataFrame({
+        "BILL_AMOUNT": pd.array([10000, 15000], dtype="Int64"),
+        "BILL_DATE": [DAY] * 2,
+        "FY": 2023
+    })
+
+    matched, unmatched, _ = match_bills(
+        invoices, bills, "BILL_AMOUNT", "BILL_DATE",
+        np.zeros(len(invoices), dtype=bool), 3, invoice_date_col="PRC_DATE"
+    )
+
+    assert unmatched == []
+    assert [bill for bill, _, _ in matched] == [0, 1]
+    positions = np.concatenate([rows for _, rows, _ in matched])
+    assert sorted(positions) == [0, 1, 2]
+
+    state = MatchState(len(invoices))
+    for bill, rows, match_type in matched:
+        state.mark(rows, bill, match_type, "HIGH", DAY, str(bill))
+    assert state.paid.all()
+    assert sorted(state.bill) == [0, 1, 1]
+
+
+
+def test_bulk_exact_match_pairs_by_rank():
+    # the k-th bill of a key, in processing order, takes the k-th invoice
+    # of that key in file order
+    invoices = pd.DataFrame({
+        "CRAC_AMOUNT": pd.array([10000, 5000, 10000, 10000], dtype="Int64"),
+        "FY": 2023
+    })
+    bills = pd.DataFrame({
+        "BILL_AMOUNT": pd.array([10000, 10000, 5000], dtype="Int64"),
+        "FY": 2023
+    }, index=[7, 3, 5])
+
+    pairs = bulk_exact_match(invoices, bills, "BILL_AMOUNT")
+
+    assert list(zip(pairs["BILL"], pairs["INVOICE"])) == [(7, 0), (3, 2), (5, 1)]
+
+
+def test_bulk_exact_match_stops_a_key_at_the_first_late_invoice():
+    # the second bill's invoice is dated after it: it and every later bill
+    # of the key are left to the bill loop
+    invoices = pd.DataFrame({
+        "CRAC_AMOUNT": pd.array([10000] * 3, dtype="Int64"),
+        "PRC_DATE": pd.to_datetime(["2023-06-01", "2023-06-20", "2023-06-02"]),
+        "FY": 2023
+    })
+    bills = pd.DataFrame({
+        "BILL_AMOUNT": pd.array([10000] * 3, dtype="Int64"),
+        "BILL_DATE": pd.to_datetime(["2023-06-10", "2023-06-10", "2023-06-30"]),
+        "FY": 2023
+    })
+
+    pairs = bulk_exact_match(
+        invoices, bills, "BILL_AMOUNT", invoice_date_col="PRC_DATE", bill_date_col="BILL_DATE"
+    )
+
+    assert list(zip(pairs["BILL"], pairs["INVOICE"])) == [(0, 0)]
+
+
+def test_crowded_keys_go_to_the_bill_loop_exact_first():
+    # 10000 and 10001 are within tolerance of each other, so neither key
+    # is joined; in the bill loop the 10001 bill still gets its exact
+    # invoice before the earlier 15000 bill searches for a combination
+    invoices = pd.DataFrame({
+        "CRAC_AMOUNT": pd.array([5000, 10001, 20000], dtype="Int64"),
+        "PRC_DATE": [DAY] * 3,
+        "FY": 2023
+    })
+    bills = pd.DataFrame({
+        "BILL_AMOUNT": pd.array([15000, 10000, 20000], dtype="Int64"),
+        "BILL_DATE": [DAY] * 3,
+        "FY": 2023
+    })
+
+    pairs = bulk_exact_match(invoices, bills, "BILL_AMOUNT", tolerance=1)
+    assert list(zip(pairs["BILL"], pairs["INVOICE"])) == [(2, 2)]
+
+    paid = np.zeros(len(invoices), dtype=bool)
+    paid[pairs["INVOICE"]] = True
+    matched, unmatched, _ = match_bills(
+        invoices, bills.drop(index=pairs["BILL"]), "BILL_AMOUNT", "BILL_DATE",
+        paid, 3, tolerance=1, invoice_date_col="PRC_DATE"
+    )
+
+    assert [(bill, rows.tolist(), match_type) for bill, rows, match_type in matched] == [
+        (1, [1], "AUTO_SINGLE")
+    ]
+    assert unmatched == [(0, "NO_MATCH")]
+
+def test_reconcile_settles_both_bills():
+    invoices = pd.DataFrame({
+        "PRC Date": ["01-06-2023"] * 3,
+        "CRAC Amount": [100, 100, 50],
+        "Paid Amount": [100, 100, 50]
+    })
+    payments = pd.DataFrame({
+        "BillNo": ["CB-1", "CB-2"],
+        "BillAmount": [100, 150],
+        "Pao Pass Date": ["01/06/2023"] * 2
+    })
+
+    result = reconcile(invoices, payments)
+
+    assert len(result.unmatched) == 0
+    assert sorted(result.payment_map["BILLNO"]) == ["CB-1", "CB-2"]
+    assert result.matched.index.is_unique
+    assert sorted(result.matched.index) == [0, 1, 2]
+    assert result.unpaid.empty
+    # the 150 bill is paid by one of the 100s and the 50
+    paid_150 = result.matched[result.matched["BILLNO"] == "CB-2"]
+    assert sorted(paid_150["CRAC_AMOUNT"]) == [50, 100]
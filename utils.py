@@ -0,0 +1,154 @@
+import json
+import os
+import time
+import warnings
+
+import pandas as pd
+from pandas.tseries.api import guess_datetime_format
+
+try:
+    import python_calamine  # noqa: F401
+    EXCEL_ENGINE = "calamine"
+except ImportError:
+    EXCEL_ENGINE = None    # pandas default: openpyxl in read-only (streaming) mode
+
+
+# ================= AMOUNTS =================
+# Amounts are held as integer paise from parsing to export, so sums are
+# exact and can be compared, hashed and indexed without a float tolerance.
+
+def to_paise(amount):
+    """Convert rupees (scalar or Series) to integer paise (Int64, <NA> kept)."""
+    if isinstance(amount, pd.Series):
+        return (amount * 100).round().astype("Int64")
+    return int(round(amount * 100))
+
+
+def to_rupees(paise):
+    """Convert integer paise (scalar or Series) back to rupees for reports."""
+    return paise / 100
+
+
+# ================= DATES =================
+DATE_SAMPLE_SIZE = 50
+
+
+def detect_date_format(series):
+    """Most common (day-first) format among a sample of the column's values."""
+    sample = series.dropna().astype(str).str.strip()
+    sample = sample[sample != ""].head(DATE_SAMPLE_SIZE)
+
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        formats = sample.map(lambda v: guess_datetime_format(v, dayfirst=True))
+
+    formats = formats.dropna()
+    return formats.mode().iloc[0] if not formats.empty else None
+
+
+def safe_to_date(series):
+    """
+    Parse a date column with one explicit format detected from a sample.
+    Only the rows that format cannot read go through the slow
+    per-element parser; anything still unreadable becomes NaT.
+    """
+    if pd.api.types.is_datetime64_any_dtype(series):
+        return series
+
+    fmt = detect_date_format(series)
+    if fmt is None:
+        return pd.to_datetime(series, errors="coerce", dayfirst=True, format="mixed")
+
+    dates = pd.to_datetime(series, errors="coerce", format=fmt)
+    retry = dates.isna() & series.notna()
+    if retry.any():
+        dates[retry] = pd.to_datetime(
+            series[retry], errors="coerce", dayfirst=True, format="mixed"
+        )
+    return dates
+
+
+def financial_year(dates):
+    """Financial year (Apr-Mar) of each date as its starting year; <NA> if no date."""
+    return (dates.dt.year - (dates.dt.month < 4)).astype("Int16")
+
+
+# ================= LOADING =================
+# Exports are read in two steps: the header row alone, so column aliases
+# can be resolved (and missing columns reported) before any data is
+# parsed, then only the columns the engine needs. Columns carried along
+# get compact dtypes.
+
+CATEGORY_MAX_SHARE = 0.5    # text with fewer distinct values than this share of rows -> categorical
+
+def _read(path, **kwargs):
+    if str(path).lower().endswith(".csv"):
+        return pd.read_csv(path, encoding="utf-8-sig", **kwargs)
+    elif str(path).lower().endswith((".xls", ".xlsx")):
+        return pd.read_excel(path, engine=EXCEL_ENGINE, **kwargs)
+    else:
+        raise ValueError(f"Unsupported file format: {path}")
+
+
+def read_header(path):
+    """Empty frame carrying only the file's header row."""
+    return _read(path, nrows=0)
+
+
+def read_columns(path, header, required, passthrough=None):
+    """
+    Parse the `required` columns plus whichever `passthrough` columns the
+    file has (None keeps every column). Names are as labelled in `header`,
+    which may have been normalized; the result is labelled the same way.
+    """
+    if passthrough is None:
+        columns = header.columns
+    else:
+        columns = list(required) + [c for c in passthrough if c in header.columns]
+
+    positions = sorted({header.columns.get_loc(c) for c in columns})
+    df = _read(path, usecols=positions)
+    df.columns = header.columns[positions]
+    return compact_columns(df, skip=required)
+
+
+def compact_columns(df, skip=()):
+    """
+    Narrowest integer dtype for integer columns and categoricals for
+    repetitive text, except the `skip` columns (parsed by the engine).
+    Floats keep their precision.
+    """
+    for name in df.columns:
+        if name in skip:
+            continue
+        s = df[name]
+        if pd.api.types.is_integer_dtype(s) and not pd.api.types.is_extension_array_dtype(s):
+            df[name] = pd.to_numeric(s, downcast="integer")
+        elif (isinstance(s.dtype, pd.StringDtype) or s.dtype == object) and len(s):
+            if s.nunique() < len(s) * CATEGORY_MAX_SHARE:
+                df[name] = s.astype("category")
+    return df
+
+
+# ================= TIMING =================
+# Scripts close each stage with timer.lap(stage); time spent in a stage
+# more than once (both files are loaded, say) is added up.
+
+class StageTimer:
+    def __init__(self):
+        self.laps = {}
+        self.last = time.perf_counter()
+
+    def lap(self, stage):
+        """Charge the time since the previous lap to `stage`."""
+        now = time.perf_counter()
+        self.laps[stage] = self.laps.get(stage, 0.0) + now - self.last
+        self.last = now
+
+    def report(self):
+        """Print the stage times; also write them as JSON to $STAGE_TIMINGS_FILE if set."""
+        print("⏱ " + " | ".join(f"{stage} {seconds:.2f}s" for stage, seconds in self.laps.items()))
+        path = os.environ.get("STAGE_TIMINGS_FILE")
+        if path:
+            with open(path, "w") as f:
+                json.dump(self.laps, f)
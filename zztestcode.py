@@ -1,12 +0,0 @@
-# for loop testfor i in range(8):  
-
-
-# for loop test
-for i in range(8):
-    # print(group_counter)
-
-    print("hello world")
-    group_counter += 1
-
-    print(group_counter)
-